@@ -18,6 +18,8 @@ from theano.compile.debugmode import DebugMode
 
 from theano.compile.monitormode import MonitorMode
 
+from theano.compile.tieredmode import TieredMode, TieredFunction
+
 from theano.compile.profiling import ProfileStats, ScanProfileStats
 
 from theano.compile.profilemode import ProfileMode
@@ -29,3 +31,5 @@ from theano.compile.pfunc import pfunc, Param, rebuild_collect_shared
 from theano.compile.builders import *
 
 from theano.compile.function import function, function_dump
+
+from theano.compile.executable import dump_executable, load_executable
@@ -0,0 +1,190 @@
+"""
+Save compiled functions so that they can be loaded without optimizing and
+compiling their graph again.
+
+A pickled `Function` keeps its optimized graph, but unpickling it
+re-optimizes it unless config.reoptimize_unpickled_function is False,
+and compiles the C code of its ops if it is not in the cache of the
+machine. `dump_executable` also saves the order in which the nodes are
+run and the C modules of the function, which `load_executable` adds to
+the cache, so that loading it only needs to link the thunks.
+"""
+import cPickle
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import zlib
+
+import numpy
+
+from theano import config, gof
+from theano.compile.function_module import (Function, _pickle_Function,
+                                            _constructor_Function)
+from theano.gof.op import ops_with_inner_function
+
+_logger = logging.getLogger('theano.compile.executable')
+
+format_version = 1
+"""Version of the format of the files written by `dump_executable`."""
+
+
+def platform_key():
+    """
+    Describe the platform the C modules are compiled for.
+
+    The C modules saved by `dump_executable` are only added to the cache
+    of a machine with the same key. The compilation flags, including the
+    processor features, are already part of the keys of the modules.
+    """
+    return (sys.platform, platform.machine(), sys.version_info[:2],
+            numpy.core.multiarray._get_ndarray_c_version())
+
+
+def function_cmodule_dirs(maker):
+    """
+    Return the directories of the module cache that hold the C modules of
+    the functions made by `maker`, including those of their inner
+    functions (e.g. Scan).
+
+    Only the modules that are in the cache are returned.
+    """
+    cache = gof.cc.get_module_cache()
+    fgraph = maker.fgraph
+    keys = [key for key, lnk in gof.cc._c_linkers(
+        fgraph.toposort(), getattr(maker.linker, 'no_recycling', []),
+        force_c_code=True)]
+    if isinstance(maker.linker, gof.CLinker):
+        keys.append(maker.linker.cmodule_key())
+    dirs = set()
+    for key in keys:
+        entry = cache.find_entry(key)
+        if entry is not None:
+            dirs.add(os.path.dirname(entry))
+    for node in fgraph.apply_nodes:
+        attr = ops_with_inner_function.get(type(node.op))
+        inner = getattr(node.op, attr, None) if attr else None
+        if isinstance(inner, Function):
+            dirs.update(function_cmodule_dirs(inner.maker))
+    return sorted(dirs)
+
+
+def _read_cmodule_dir(location):
+    """
+    Return the name of a module directory of the cache and the list of
+    its files, as (name, compressed content) pairs.
+
+    The source code is not needed to load the module, so it is left out.
+    """
+    files = []
+    for name in sorted(os.listdir(location)):
+        path = os.path.join(location, name)
+        if name in ('mod.cpp', 'mod.cu') or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            files.append((name, zlib.compress(f.read())))
+    return os.path.basename(location), files
+
+
+def _install_cmodule_dir(cache, dirname, files):
+    """
+    Add a module directory saved by `_read_cmodule_dir` to the cache.
+
+    Return True if it was added, False if the cache already has it.
+    """
+    location = os.path.join(cache.dirname, dirname)
+    if os.path.exists(location):
+        return False
+    tmp_location = tempfile.mkdtemp(dir=cache.dirname)
+    try:
+        # The key.pkl file is written last, so that `refresh` in another
+        # process ignores the directory until it is complete. It is then
+        # moved in place at once.
+        files = sorted(files, key=lambda (name, data): name == 'key.pkl')
+        for name, data in files:
+            with open(os.path.join(tmp_location, name), 'wb') as f:
+                f.write(zlib.decompress(data))
+        try:
+            os.rename(tmp_location, location)
+        except OSError:
+            if not os.path.exists(location):
+                raise
+            # Another process installed it first.
+            return False
+        return True
+    finally:
+        if os.path.exists(tmp_location):
+            shutil.rmtree(tmp_location, ignore_errors=True)
+
+
+def dump_executable(f, file, embed_cmodules=True):
+    """
+    Save the compiled function `f` to `file`, see `load_executable`.
+
+    :param f: a `Function`.
+
+    :param file: a file object opened for writing in binary mode.
+
+    :param embed_cmodules: if True, save the compiled C modules of `f`,
+        so that they do not have to be compiled again by a machine with
+        the same platform that loads the function.
+    """
+    maker = f.maker
+    cmodules = []
+    if embed_cmodules and config.cxx:
+        cmodules = [_read_cmodule_dir(location)
+                    for location in function_cmodule_dirs(maker)]
+    constructor, (maker, input_storage, inputs_data) = _pickle_Function(f)
+    # The order is pickled with the graph, so that it refers to its nodes.
+    order = maker.linker.schedule(maker.fgraph)
+    function = cPickle.dumps((maker, input_storage, inputs_data, order), -1)
+    cPickle.dump({'format_version': format_version,
+                  'platform': platform_key(),
+                  'cmodules': cmodules,
+                  'function': function}, file, -1)
+
+
+def load_executable(file):
+    """
+    Load a function saved by `dump_executable`.
+
+    The graph of the function is not optimized again, whatever the value
+    of config.reoptimize_unpickled_function, and its nodes are run in the
+    same order. The C modules saved with it are added to the module cache
+    if the platform is the same (see `platform_key`), the others are
+    compiled as needed.
+
+    :param file: a file object opened for reading in binary mode.
+
+    :returns: a `Function`, or None if config.unpickle_function is False.
+    """
+    data = cPickle.load(file)
+    if data.get('format_version') != format_version:
+        raise ValueError('Unsupported format version of the saved function',
+                         data.get('format_version'), format_version)
+    if data['cmodules']:
+        if data['platform'] != platform_key():
+            _logger.warning('The function was saved on another platform'
+                            ' (%s), its C modules will be compiled again.',
+                            data['platform'])
+        elif config.cxx:
+            cache = gof.cc.get_module_cache()
+            n_installed = sum(_install_cmodule_dir(cache, dirname, files)
+                              for dirname, files in data['cmodules'])
+            _logger.debug('Added %d C modules to the cache', n_installed)
+            if n_installed:
+                cache.refresh(cleanup=False)
+
+    reoptimize_orig = config.reoptimize_unpickled_function
+    try:
+        config.reoptimize_unpickled_function = False
+        maker, input_storage, inputs_data, order = cPickle.loads(
+            data['function'])
+    finally:
+        config.reoptimize_unpickled_function = reoptimize_orig
+    if maker is None:
+        return None
+    maker.linker.schedule = lambda fgraph: list(order)
+    return _constructor_Function(maker, input_storage, inputs_data)
@@ -19,7 +19,6 @@ import theano.compile.mode
 from theano.compile.io import (
     In, SymbolicInput, SymbolicInputKit, SymbolicOutput)
 from theano.compile.ops import deep_copy_op, view_op
-from theano.gof.graph import is_same_graph
 from theano.gof.op import ops_with_inner_function
 
 import logging
@@ -594,26 +593,7 @@ class Function(object):
         try:
             outputs = self.fn()
         except Exception:
-            if hasattr(self.fn, 'position_of_error'):
-                # this is a new vm-provided function or c linker
-                # they need this because the exception manipulation
-                # done by raise_with_op is not implemented in C.
-                if hasattr(self.fn, 'thunks'):
-                    # For the CVM
-                    gof.link.raise_with_op(
-                        self.fn.nodes[self.fn.position_of_error],
-                        self.fn.thunks[self.fn.position_of_error],
-                        storage_map=self.fn.storage_map)
-                else:
-                    # For the c linker We don't have access from
-                    # python to all the temps values So for now, we
-                    # just don't print the extra shapes/strides info
-                    gof.link.raise_with_op(
-                        self.fn.nodes[self.fn.position_of_error],
-                        storage_map=self.fn.storage_map)
-            else:
-                # old-style linkers raise their own exceptions
-                raise
+            self._reraise_fn_error()
 
         dt_fn = time.time() - t0_fn
         self.maker.mode.fn_time += dt_fn
@@ -678,6 +658,229 @@ class Function(object):
         else:
             return outputs
 
+    def _reraise_fn_error(self):
+        """Re-raise the exception raised by `self.fn`, with debug info."""
+        if hasattr(self.fn, 'position_of_error'):
+            # this is a new vm-provided function or c linker
+            # they need this because the exception manipulation
+            # done by raise_with_op is not implemented in C.
+            if hasattr(self.fn, 'thunks'):
+                # For the CVM
+                gof.link.raise_with_op(
+                    self.fn.nodes[self.fn.position_of_error],
+                    self.fn.thunks[self.fn.position_of_error],
+                    storage_map=self.fn.storage_map)
+            else:
+                # For the c linker We don't have access from
+                # python to all the temps values So for now, we
+                # just don't print the extra shapes/strides info
+                gof.link.raise_with_op(
+                    self.fn.nodes[self.fn.position_of_error],
+                    storage_map=self.fn.storage_map)
+        else:
+            # old-style linkers raise their own exceptions
+            raise
+
+    def map(self, args_iter):
+        """Generator of the results of the calls on each element of `args_iter`.
+
+        `args_iter` is an iterable of tuples (or lists) of positional
+        arguments, which must all have the same length. ``list(f.map(a))``
+        returns the same thing as ``[f(*args) for args in a]``, but the
+        checks that only depend on which inputs are given (missing, repeated
+        or implicit inputs) are done once, during the first call. The next
+        calls only filter the arguments, copy those that share memory with an
+        input the graph destroys in place, and run the graph.
+
+        The calls are done as the generator is iterated, so the results can
+        be consumed as they are computed.
+        """
+        args_iter = iter(args_iter)
+        for first in args_iter:
+            yield self(*first)
+            break
+        else:
+            return
+        n_args = len(first)
+
+        def check_n_args(args):
+            if len(args) != n_args:
+                raise TypeError(
+                    "All the calls of Function.map must have the same"
+                    " number of arguments (%d), got %d" %
+                    (n_args, len(args)))
+        if type(self).__call__.im_func is not Function.__call__.im_func:
+            # Subclasses may check more things.
+            for args in args_iter:
+                check_n_args(args)
+                yield self(*args)
+            return
+
+        # Everything that __call__ looks up at each call.
+        fn = self.fn
+        filters = []
+        for c in self.input_storage[:n_args]:
+            if self.trust_input:
+                filters.append((c.storage, None, None, None))
+            else:
+                filters.append((c.storage, c.type.filter, c.strict,
+                                c.allow_downcast))
+        required = [c.storage for c in self.input_storage if c.required]
+        gc_outputs = []
+        if getattr(fn, 'allow_gc', False):
+            gc_outputs = [c.storage for c, var in zip(
+                self.output_storage, self.maker.fgraph.outputs)
+                if var.owner is not None]
+        updated = None
+        if getattr(fn, 'need_update_inputs', True):
+            updated = [c for inp, c in reversed(zip(self.maker.expanded_inputs,
+                                                    self.input_storage))
+                       if inp.update is not None]
+        refeed = [(i, value)
+                  for i, (required_, refeed_, value) in enumerate(self.defaults)
+                  if refeed_]
+        # The inputs that the graph destroys in place, with the inputs whose
+        # value may be one of theirs: an argument aliased to a destroyed input
+        # (or a destroyed argument aliased to another input) is copied before
+        # the call, as __call__ does.
+        fgraph = self.maker.fgraph
+        destroyed = []
+        if (not self.trust_input and hasattr(fgraph, 'destroyers') and
+                getattr(self, '_check_for_aliased_inputs', True)):
+            for i, var in enumerate(fgraph.inputs):
+                if not fgraph.destroyers(var):
+                    continue
+                others = [(j, c.storage)
+                          for j, (c, var_j) in enumerate(zip(
+                              self.input_storage, fgraph.inputs))
+                          if j != i and type(var_j.type) is type(var.type) and
+                          hasattr(var.type, 'may_share_memory') and
+                          (i < n_args or j < n_args)]
+                if others:
+                    destroyed.append((i, self.input_storage[i].storage,
+                                      var.type.may_share_memory, others))
+        n_returned = self.n_returned_outputs
+        unpack_single = self.unpack_single and n_returned == 1
+
+        fn_time = call_time = 0.
+        n_calls = 0
+        try:
+            for args in args_iter:
+                t0 = time.time()
+                check_n_args(args)
+                for i, arg in enumerate(args):
+                    storage, filter, strict, allow_downcast = filters[i]
+                    if arg is None or filter is None:
+                        storage[0] = arg
+                        continue
+                    try:
+                        storage[0] = filter(arg, strict=strict,
+                                            allow_downcast=allow_downcast)
+                    except Exception, e:
+                        function_name = "theano function"
+                        if self.name:
+                            function_name += ' with name "' + self.name + '" '
+                        e.args = tuple(["Bad input argument to " +
+                                        function_name +
+                                        " at index %d(0-based)" % i] +
+                                       list(e.args))
+                        raise
+                for i, storage, may_share_memory, others in destroyed:
+                    for j, other in others:
+                        if (storage[0] is not None and
+                                other[0] is not None and
+                                may_share_memory(storage[0], other[0])):
+                            # Copy the argument, never the value of an
+                            # implicit input.
+                            if j < n_args:
+                                other[0] = copy.copy(other[0])
+                            else:
+                                storage[0] = copy.copy(storage[0])
+
+                t0_fn = time.time()
+                try:
+                    outputs = fn()
+                except Exception:
+                    self._reraise_fn_error()
+                fn_time += time.time() - t0_fn
+
+                if outputs is None:
+                    outputs = [x.data for x in self.output_storage]
+                for storage in required:
+                    storage[0] = None
+                for storage in gc_outputs:
+                    storage[0] = None
+                if updated is not None:
+                    for c in updated:
+                        c.data = outputs.pop()
+                else:
+                    outputs = outputs[:n_returned]
+                for i, value in refeed:
+                    if isinstance(value, gof.Container):
+                        value = value.storage[0]
+                    self[i] = value
+                call_time += time.time() - t0
+                n_calls += 1
+
+                if self.return_none:
+                    yield None
+                elif unpack_single:
+                    yield outputs[0]
+                else:
+                    yield outputs
+        finally:
+            # The time and profile of all the calls are added at once.
+            self.maker.mode.fn_time += fn_time
+            self.maker.mode.call_time += call_time
+            profile = self.profile
+            if profile:
+                profile.vm_call_time += fn_time
+                profile.fct_callcount += n_calls
+                profile.fct_call_time += call_time
+                if hasattr(fn, 'update_profile'):
+                    fn.update_profile(profile)
+
+    def call_many(self, args_list, stack=False):
+        """Return the list of the results of the calls on each element of
+        `args_list`.
+
+        See `map`, which this uses.
+
+        :param stack: if True, the values of each output are stacked in one
+            array whose first dimension indexes the calls (so a function
+            returning one output returns one array, and a function returning
+            several outputs returns a list of arrays). The values of an
+            output must have the same shape in all the calls. The arrays are
+            allocated after the first call and filled in place.
+        """
+        if not stack:
+            return list(self.map(args_list))
+        if self.return_none:
+            for _ in self.map(args_list):
+                pass
+            return None
+        single = self.unpack_single and self.n_returned_outputs == 1
+        n_calls = len(args_list)
+        stacked = None
+        for i, outputs in enumerate(self.map(args_list)):
+            if single:
+                outputs = [outputs]
+            if stacked is None:
+                stacked = []
+                for out in outputs:
+                    out = numpy.asarray(out)
+                    stacked.append(numpy.empty((n_calls,) + out.shape,
+                                               dtype=out.dtype))
+            for buf, out in zip(stacked, outputs):
+                buf[i] = out
+        if stacked is None:
+            # No call: we do not know the shape of the outputs.
+            stacked = [numpy.empty((0,)) for out in self.output_storage[
+                :self.n_returned_outputs]]
+        if single:
+            return stacked[0]
+        return stacked
+
     value = property(
         lambda self: self._value,
         None,  # this property itself is not settable
@@ -908,6 +1111,42 @@ def insert_deepcopy(fgraph, wrapped_inputs, wrapped_outputs):
 NODEFAULT = ['NODEFAULT']
 
 
+def _optimizer_cache_key(mode):
+    """
+    Return a string describing the optimizer of `mode` for the optimized
+    graph cache, or None if the optimizer can not be described in a way
+    that is stable across processes.
+
+    Only modes whose optimizer is a query of `optdb` are supported. The key
+    includes the names of all the registered optimizations, as importing a
+    module can register new ones.
+    """
+    query = mode.provided_optimizer
+    if not isinstance(query, gof.Query) or query.subquery:
+        return None
+
+    def db_names(db):
+        names = []
+        for name in sorted(db._names):
+            names.append(name)
+            for obj in db.__db__[name]:
+                if isinstance(obj, gof.DB):
+                    names.append('%s(%s)' % (name, ','.join(db_names(obj))))
+        return names
+
+    return '\n'.join([
+        'include:%s' % sorted(query.include),
+        'exclude:%s' % sorted(query.exclude),
+        'require:%s' % sorted(query.require),
+        'position_cutoff:%s' % query.position_cutoff,
+        'optimizer_including:%s' % theano.config.optimizer_including,
+        'optimizer_excluding:%s' % theano.config.optimizer_excluding,
+        'optimizer_requiring:%s' % theano.config.optimizer_requiring,
+        'optdb.position_cutoff:%s' % theano.config.optdb.position_cutoff,
+        'optdb.max_use_ratio:%s' % theano.config.optdb.max_use_ratio,
+        'optdb:%s' % ','.join(db_names(theano.compile.mode.optdb))])
+
+
 class FunctionMaker(object):
     """`FunctionMaker` is the class to `create` `Function` instances.
 
@@ -971,171 +1210,41 @@ class FunctionMaker(object):
         else:
             raise TypeError("Unknown output type: %s (%s)", type(output), output)
         
-    def optimize_graph_with_cache(self, optimizer, inputs, outputs):
-        # This function is not finished
-        from theano.gof.compilelock import get_lock, release_lock
-        import os.path
-
-        graph_db_file = os.path.join(theano.config.compiledir, 'optimized_graphs.pkl')
-
-        # the inputs, outputs, and size of the graph to be optimized
-        inputs_new = [inp.variable for inp in inputs]
-        outputs_new = [out.variable for out in outputs]
-        size_new = len(self.fgraph.apply_nodes)
-        need_optimize = False
-        get_lock()
-        key = None
-        #Beginning of cache optimizations.
-        #Could be refactored in different functions.
-        def load_graph_db():
-            if os.path.isfile(graph_db_file):
-                print 'graph_db already exists'
-            else:
-                # create graph_db
-                f = open(graph_db_file, 'wb')
-                print 'create new graph_db in %s' % graph_db_file
-                #file needs to be open and closed for every pickle
-                f.close()
-            # load the graph_db dictionary
-            try:
-                f = open(graph_db_file, 'rb')
-                #Temporary hack to allow theano.scan_module.tests.test_scan.T_Scan
-                #to finish. Should be changed in definitive version.
-                tmp = theano.config.unpickle_function
-                theano.config.unpickle_function = False
-                graph_db = cPickle.load(f)
-                
-                #hack end
-                f.close()
-                print 'graph_db loaded and it is not empty'
-            except EOFError, e:
-                # the file has nothing in it
-                print e
-                print 'graph_db loaded and it is empty'
-                graph_db = {}
-            finally:
-                theano.config.unpickle_function = tmp
-                
-            return graph_db
-
-        def find_same_graph_in_db(graph_db):
-            # If found_graph_in_db is None, then need to optimize.
-            # Otherwise, return the graph found.
-            found_graph_in_db = None
-            # The sole purpose of this loop is to set 'need_optimize' by
-            # going through graph_db, looking for graph that has the same
-            # computation performed. 
-            for graph_old, graph_optimized in graph_db.iteritems():
-                inputs_old = graph_old.inputs
-                outputs_old = graph_old.outputs
-                size_old = len(graph_old.apply_nodes)
-                # Some heuristics to check is the same graphs have
-                # already been optimized before.
-                if len(inputs_new) != len(inputs_old):
-                    # If the inputs are of different size,
-                    # two graphs are for sure different
-                    print 'need to optimize, because input size is different'
-                    continue
-                elif len(outputs_new) != len(outputs_old):
-                    # If the inputs are of different size,
-                    # two graphs are for sure different
-                    print 'need to optimize, because output size is different'
-                    continue
-                elif not all(input_new.type == input_old.type for
-                             input_new, input_old in zip(inputs_new, inputs_old)):
-                    print 'need to optimize, because inputs are of different types'
-                    continue
-                elif not all(output_new.type == output_old.type for
-                             output_new, output_old in zip(outputs_new, outputs_old)):
-                    print 'need to optimize, because outputs are of different types'
-                    continue
-                elif not size_old == size_new:
-                    print 'need to optimize, because numbers of nodes in graph are different'
-                    continue
+    def optimize_graph_with_cache(self, optimizer, inputs, outputs, mode):
+        """
+        Optimize self.fgraph in place, reusing the result of a previous
+        optimization of the same graph stored on disk if there is one.
+
+        See `theano.gof.optcache`. Return the profile of the optimizer, or
+        None if the optimized graph was found in the cache.
+        """
+        from theano.gof import optcache
+
+        cache = optcache.get_optimization_cache()
+        key = cache.key(self.fgraph, _optimizer_cache_key(mode),
+                        [getattr(inp, 'mutable', False) for inp in inputs])
+        if key is not None:
+            entry = cache.load(key)
+            if entry is not None:
+                try:
+                    optcache.restore_graph(self.fgraph, *entry)
+                except Exception, e:
+                    # The entry is not usable (it should not happen, as
+                    # the graph signatures match). Optimize normally.
+                    _logger.warning('Could not restore optimized graph from'
+                                    ' the cache, optimizing it: %s', e)
                 else:
-                    flags = []
-                    for output_new, output_old, i in zip(
-                            outputs_new, outputs_old, range(len(outputs_new))):
-                        print 'loop through outputs node for both graphs'
-                        graph_old.variables = set(gof.graph.variables(
-                            graph_old.inputs, graph_old.outputs))
-
-                        #using clone allowed to avoid a lot of errors
-                        #deep copy seemed to had.
-                        f2 = graph_old.clone(check_integrity=False)
-                        t1 = output_new
-                        t2 = f2.outputs[i]
-
-                        #Used to remove "already used by another graph error
-                        def removeAllFgraph(remove):
-                            if hasattr(remove, 'fgraph'):
-                                del remove.fgraph
-                            if hasattr(remove, 'owner'):
-                                if remove.owner is None:
-                                    pass
-                                else:
-                                    if hasattr(remove.owner, 'fgraph'):
-                                        del remove.owner.fgraph
-                                    if hasattr(remove.owner, 'inputs'):
-                                        remove.owner.inputs = [removeAllFgraph(
-                                            i) for i in remove.owner.inputs]
-                                        for o in remove.owner.outputs:
-                                            if hasattr(o, 'fgraph'):
-                                                del o.fgraph
-                            return remove
-
-                        t2 = removeAllFgraph(t2)
-
-                        givens = dict(zip(gof.graph.inputs([t1]),
-                                        gof.graph.inputs([t2])))
-
-                        temp = dict(zip(gof.graph.inputs([t1]),
-                                    gof.graph.inputs([t2])))
-
-                        #hack to remove inconstent entry in givens
-                        #seems to work that but source of inconsistency
-                        #could be worth investigating.
-                        for key, value in temp.iteritems():
-                            if key.type != value.type:
-                                del givens[key]
-
-                        flag = is_same_graph(t1, t2, givens=givens)
-
-                        flags.append(flag)
-
-                    is_same = all(flags)
-                    if is_same:
-                        # found the match
-                        print 'found a match, no need to optimize'
-                        found_graph_in_db = graph_optimized
-                        break
-            return found_graph_in_db
-                   
-        graph_db = load_graph_db()
-        print 'loaded graph_db from %s, size=%d' % (graph_db_file, len(graph_db))
-        found_graph = find_same_graph_in_db(graph_db)
-        if found_graph:
-            self.fgraph = found_graph
-            optimizer_profile = None
-        else:
-            # this is a brand new graph, optimize it, save it to graph_db
-            print 'graph not found in graph_db, optimizing the graph'
-            self.fgraph.variables = set(gof.graph.variables(
-                self.fgraph.inputs, self.fgraph.outputs))
-            #check_integrity parameters was added to ignore 
-            #"excess cached variables" errors. Works that way
-            #but once again the error couldbe worth
-            #investigating.
-            before_opt = self.fgraph.clone(check_integrity=False)
-            optimizer_profile = optimizer(self.fgraph)
-            graph_db.update({before_opt:self.fgraph})
-            f = open(graph_db_file, 'wb')
-            cPickle.dump(graph_db, f, -1)
-            f.close()
-            print 'new graph saved into graph_db'
-        release_lock()
+                    _logger.debug('Optimized graph found in the cache')
+                    if self.profile:
+                        self.profile.optimizer_cache_hit += 1
+                    return None
+        if self.profile:
+            self.profile.optimizer_cache_miss += 1
+        optimizer_profile = optimizer(self.fgraph)
+        if key is not None:
+            cache.store(key, self.fgraph.inputs, self.fgraph.outputs)
         return optimizer_profile
-                
+
     def __init__(self, inputs, outputs,
             mode=None, accept_inplace=False, function_builder=Function,
             profile=None, on_unused_input=None, fgraph=None):
@@ -1224,10 +1333,11 @@ class FunctionMaker(object):
             fgraph, additional_outputs = std_fgraph(inputs, outputs, accept_inplace)
             fgraph.profile = profile
         else:
-            # fgraph is already an optimized one
+            # fgraph is already an optimized one. Do not build the graph
+            # of the inputs again just for the update outputs.
             need_opt = False
-            _, additional_outputs = std_fgraph(inputs, outputs, accept_inplace)
-            pass
+            additional_outputs = [SymbolicOutput(i.update) for i in inputs
+                                  if i.update]
         
         self.fgraph = fgraph
 
@@ -1246,15 +1356,16 @@ class FunctionMaker(object):
                 # now optimize the graph
                 if theano.config.cache_optimizations:
                     optimizer_profile = self.optimize_graph_with_cache(
-                        optimizer, inputs, outputs)
-                else:    
+                        optimizer, inputs, outputs, mode)
+                else:
                     optimizer_profile = optimizer(fgraph)
-                    
+
                 end_optimizer = time.time()
                 opt_time = end_optimizer - start_optimizer
                 if profile:
                     profile.optimizer_time += opt_time
-                    if theano.config.profile_optimizer:
+                    if (theano.config.profile_optimizer and
+                            optimizer_profile is not None):
                         profile.optimizer_profile = (optimizer, optimizer_profile)
                 _logger.debug('Optimizing took %f seconds', opt_time)
 
@@ -1408,6 +1519,7 @@ class FunctionMaker(object):
         # Get a function instance
         start_linker = time.time()
         start_import_time = theano.gof.cmodule.import_time
+        start_lock_wait_time = theano.gof.compilelock.lock_wait_time
         limit_orig = theano.config.traceback.limit
         try:
             theano.config.traceback.limit = 0
@@ -1425,6 +1537,9 @@ class FunctionMaker(object):
             _fn.time_thunks = self.profile.flag_time_thunks
             import_time = theano.gof.cmodule.import_time - start_import_time
             self.profile.import_time += import_time
+            lock_wait_time = (theano.gof.compilelock.lock_wait_time -
+                              start_lock_wait_time)
+            self.profile.lock_wait_time += lock_wait_time
 
         fn = self.function_builder(_fn, _i, _o, self.indices, self.outputs,
                 defaults, self.unpack_single, self.return_none, self)
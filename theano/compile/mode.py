@@ -8,6 +8,7 @@ import numpy
 
 import  theano
 from theano import gof
+import theano.gof.sched
 import theano.gof.vm
 from theano.configparser import config, AddConfigVar, StrParam
 from theano.compile.ops import register_view_op_c_code, _output_guard
@@ -73,6 +74,11 @@ predefined_linkers = {
     'cvm': gof.vm.VM_Linker(use_cloop=True),  # Use allow_gc Theano flag
     'vm_nogc': gof.vm.VM_Linker(allow_gc=False, use_cloop=False),
     'cvm_nogc': gof.vm.VM_Linker(allow_gc=False, use_cloop=True),
+    # Order the nodes to lower the peak memory usage
+    'vm_lowmem': gof.vm.VM_Linker(use_cloop=False,
+                                  schedule=gof.sched.memory_schedule),
+    'cvm_lowmem': gof.vm.VM_Linker(use_cloop=True,
+                                   schedule=gof.sched.memory_schedule),
     }
 
 
@@ -104,7 +104,8 @@ def _atexit_print_fn():
         for ps in to_sum[1:]:
             for attr in ["compile_time", "fct_call_time", "fct_callcount",
                          "vm_call_time", "optimizer_time", "linker_time",
-                         "validate_time", "import_time"]:
+                         "validate_time", "import_time", "lock_wait_time",
+                         "optimizer_cache_hit", "optimizer_cache_miss"]:
                 setattr(cum, attr, getattr(cum, attr) + getattr(ps, attr))
 
             # merge dictonary
@@ -197,6 +198,10 @@ class ProfileStats(object):
     import_time = 0.0
     # time spent in importing compiled python module.
 
+    lock_wait_time = 0.0
+    # time spent waiting for locks of the compilation directory held by
+    # other processes (subset of linker_time).
+
     line_width = config.profiling.output_line_width
 
     nb_nodes = -1
@@ -207,6 +212,14 @@ class ProfileStats(object):
     optimizer_profile = None
     # None or tuple (the optimizer, the profile it returned)
 
+    optimizer_cache_hit = 0
+    # Number of graphs restored from the optimization cache
+    # (config.cache_optimizations) instead of being optimized.
+
+    optimizer_cache_miss = 0
+    # Number of graphs looked up in the optimization cache and optimized
+    # because they were not found.
+
     # param is called flag_time_thunks because most other attributes with time
     # in the name are times *of* something, rather than configuration flags.
     def __init__(self, atexit_print=True, flag_time_thunks=None, **kwargs):
@@ -645,14 +658,20 @@ class ProfileStats(object):
         print >> file, '    Number of Apply nodes: %d' % self.nb_nodes
         print >> file, '    Theano Optimizer time: %es' % self.optimizer_time
         print >> file, '       Theano validate time: %es' % self.validate_time
+        if self.optimizer_cache_hit or self.optimizer_cache_miss:
+            print >> file, ('       Optimization cache: %d hit(s), %d miss(es)'
+                            % (self.optimizer_cache_hit,
+                               self.optimizer_cache_miss))
         print >> file, ('    Theano Linker time (includes C,'
                         ' CUDA code generation/compiling): %es' %
                         self.linker_time)
         print >> file, '       Import time %es' % self.import_time
+        print >> file, '       Compile lock wait time %es' % (
+            self.lock_wait_time)
         print >> file, ''
 
         # The validation time is a subset of optimizer_time
-        assert self.validate_time < self.optimizer_time
+        assert self.validate_time <= self.optimizer_time
 
     def summary_globals(self, file):
         print >> file, 'Time in all call to theano.grad() %es' % theano.gradient.grad_time
@@ -0,0 +1,130 @@
+import cPickle
+import cStringIO
+import os
+import shutil
+import tempfile
+
+import numpy
+from nose.plugins.skip import SkipTest
+
+import theano
+import theano.tensor as T
+from theano.compile import dump_executable, load_executable
+from theano.compile import executable
+from theano.gof.cmodule import ModuleCache
+
+
+def dump_and_load(f, **kwargs):
+    s = cStringIO.StringIO()
+    dump_executable(f, s, **kwargs)
+    s.seek(0)
+    return load_executable(s)
+
+
+class CountingOptimizer(theano.gof.Optimizer):
+    n_calls = 0
+
+    def apply(self, fgraph):
+        CountingOptimizer.n_calls += 1
+
+
+def test_not_reoptimized():
+    x = T.dvector('x')
+    acc = theano.shared(numpy.zeros(3))
+    mode = theano.compile.Mode(optimizer=CountingOptimizer())
+    f = theano.function([x], T.exp(x) * 2, updates=[(acc, acc + x)],
+                        mode=mode)
+    assert CountingOptimizer.n_calls == 1
+    reoptimize = theano.config.reoptimize_unpickled_function
+    theano.config.reoptimize_unpickled_function = True
+    try:
+        g = dump_and_load(f)
+    finally:
+        theano.config.reoptimize_unpickled_function = reoptimize
+    assert CountingOptimizer.n_calls == 1
+    assert len(g.maker.fgraph.apply_nodes) == len(f.maker.fgraph.apply_nodes)
+    v = numpy.arange(3.)
+    assert numpy.allclose(g(v), numpy.exp(v) * 2)
+    # The shared variable is copied, like when pickling the function.
+    assert numpy.allclose(acc.get_value(), 0)
+    assert numpy.allclose(g.maker.inputs[1].variable.get_value(), v)
+
+
+def counting_schedule(fgraph):
+    counting_schedule.n_calls += 1
+    return fgraph.toposort()
+counting_schedule.n_calls = 0
+
+
+def test_order():
+    x = T.dvector('x')
+    out = T.exp(x) + T.log(x) * T.tanh(x)
+    mode = theano.compile.Mode(
+        linker=theano.gof.vm.VM_Linker(schedule=counting_schedule),
+        optimizer='fast_run')
+    f = theano.function([x], out, mode=mode)
+    n_calls = counting_schedule.n_calls
+    f_order = [str(node) for node in f.maker.fgraph.toposort()]
+    g = dump_and_load(f)
+    # The saved order is used.
+    assert counting_schedule.n_calls == n_calls + 1
+    g_order = [str(node) for node in g.maker.linker.schedule(
+        g.maker.fgraph)]
+    assert f_order == g_order
+    assert numpy.allclose(g([1., 2.]), f([1., 2.]))
+
+
+def test_cmodules_installed():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    x = T.dvector('x')
+    f = theano.function([x], T.exp(x) * 2 + 1, mode='FAST_RUN')
+    dirs = executable.function_cmodule_dirs(f.maker)
+    assert dirs
+    s = cStringIO.StringIO()
+    dump_executable(f, s)
+    s.seek(0)
+    data = cPickle.load(s)
+    assert len(data['cmodules']) == len(dirs)
+
+    # Add the modules to an empty cache, as on another machine.
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    try:
+        cache = ModuleCache(dirname)
+        for name, files in data['cmodules']:
+            assert executable._install_cmodule_dir(cache, name, files)
+            assert not executable._install_cmodule_dir(cache, name, files)
+        cache.refresh(cleanup=False)
+        assert len(cache.module_hash_to_key_data) == len(dirs)
+        for key, lnk in theano.gof.cc._c_linkers(
+                f.maker.fgraph.toposort(), [], force_c_code=True):
+            entry = cache.find_entry(key)
+            if entry is not None:
+                assert cache._get_module(entry) is not None
+    finally:
+        shutil.rmtree(dirname)
+
+    s.seek(0)
+    n_compiled = theano.gof.cc.get_module_cache().stats[2]
+    g = load_executable(s)
+    assert theano.gof.cc.get_module_cache().stats[2] == n_compiled
+    v = numpy.arange(3.)
+    assert numpy.allclose(g(v), numpy.exp(v) * 2 + 1)
+
+
+def test_other_platform():
+    x = T.dvector('x')
+    f = theano.function([x], T.exp(x) * 2 + 1, mode='FAST_RUN')
+    s = cStringIO.StringIO()
+    dump_executable(f, s)
+    s.seek(0)
+    data = cPickle.load(s)
+    data['platform'] = ('other', 'platform')
+    s = cStringIO.StringIO(cPickle.dumps(data, -1))
+    logger = executable._logger
+    logger.disabled = True
+    try:
+        g = load_executable(s)
+    finally:
+        logger.disabled = False
+    assert numpy.allclose(g(numpy.ones(2)), numpy.exp(1) * 2 + 1)
@@ -420,6 +420,103 @@ class T_function(unittest.TestCase):
             if not isinstance(key, theano.gof.Constant):
                 assert (val[0] == None)
 
+    def test_map(self):
+        x = T.dvector('x')
+        a = T.dscalar('a')
+        s = theano.shared(0.)
+        f = theano.function([x, theano.Param(a, default=2.)],
+                            [x * a, x.sum()],
+                            updates={s: s + 1})
+        args = [([1., 2.],), ([3., 4.],), ([5., 6.],)]
+        it = f.map(args)
+        out = it.next()
+        assert s.get_value() == 1
+        assert numpy.allclose(out[0], [2, 4])
+        assert [(list(o[0]), o[1]) for o in it] == [
+            ([6., 8.], 7.), ([10., 12.], 11.)]
+        assert s.get_value() == 3
+        assert [list(o[0]) for o in f.map([([1.], 3.), ([2.], 4.)])] == [
+            [3.], [8.]]
+        # The default value of a is used again after it was given.
+        assert [list(o[0]) for o in f.map([([1.],), ([2.],)])] == [
+            [2.], [4.]]
+        assert list(f.map([])) == []
+
+        # Bad arguments raise the same errors as __call__.
+        self.assertRaises(TypeError, list, f.map([([1.],), ([[1.]],)]))
+        self.assertRaises(TypeError, list, f.map([([1.],), ([1.], 1., 1.)]))
+        # All the calls must give the same number of arguments.
+        self.assertRaises(TypeError, list, f.map([([1.],), ([1.], 1.)]))
+        self.assertRaises(TypeError, list, f.map([([1.], 1.), ([1.],)]))
+
+    def test_map_mutable(self):
+        x = T.dvector('x')
+        f = function([In(x, mutable=True)], x * 2)
+        vals = [numpy.arange(3.), numpy.ones(3)]
+        expected = [v * 2 for v in vals]
+        for out, exp in zip(f.map((v,) for v in vals), expected):
+            assert numpy.allclose(out, exp)
+
+    def test_map_fast_path(self):
+        # Only the first call goes through __call__.
+        calls = []
+        orig_call = theano.compile.function_module.Function.__call__
+
+        def counting_call(self, *args, **kwargs):
+            calls.append(args)
+            return orig_call(self, *args, **kwargs)
+        x = T.dvector('x')
+        s = theano.shared(numpy.zeros(2))
+        vals = [numpy.arange(2.) + i for i in range(4)]
+        f = function([x], x * 2)
+        g = function([x], (x * s).sum(), updates={s: s + x})
+        theano.compile.function_module.Function.__call__ = counting_call
+        try:
+            out_f = list(f.map((v,) for v in vals))
+            out_g = list(g.map((v,) for v in vals))
+            self.assertRaises(TypeError, list, f.map([(vals[0],), ()]))
+        finally:
+            theano.compile.function_module.Function.__call__ = orig_call
+        assert len(calls) == 3
+        for out, v in zip(out_f, vals):
+            assert numpy.allclose(out, v * 2)
+        acc = numpy.zeros(2)
+        for out, v in zip(out_g, vals):
+            assert numpy.allclose(out, (v * acc).sum())
+            acc = acc + v
+        assert numpy.allclose(s.get_value(), acc)
+
+    def test_map_destroyed_input(self):
+        # An argument that shares memory with an input destroyed in place is
+        # copied before the call.
+        x = T.dvector('x')
+        y = T.dvector('y')
+        f = function([In(x, mutable=True), y], [x * 2, y * 3])
+        assert f.maker.fgraph.destroyers(f.maker.fgraph.inputs[0])
+        a = numpy.ones(3)
+        outs = list(f.map([(numpy.ones(3), numpy.ones(3)), (a, a), (a, a)]))
+        # x is destroyed, so the value of a doubles at each call.
+        for out, val in zip(outs, [1, 1, 2]):
+            assert numpy.allclose(out[0], val * 2)
+            assert numpy.allclose(out[1], val * 3)
+
+    def test_call_many(self):
+        x = T.dvector('x')
+        f = function([x], x * 2)
+        args = [([i, i + 1.],) for i in range(4)]
+        out = f.call_many(args)
+        assert len(out) == 4
+        assert numpy.allclose(out[3], [6, 8])
+        stacked = f.call_many(args, stack=True)
+        assert stacked.shape == (4, 2)
+        assert numpy.allclose(stacked, numpy.array(out))
+
+        g = function([x], [x * 2, x.sum()])
+        stacked = g.call_many(args, stack=True)
+        assert len(stacked) == 2
+        assert numpy.allclose(stacked[1], [1, 3, 5, 7])
+        assert f.call_many([], stack=True).shape == (0,)
+
 class T_picklefunction(unittest.TestCase):
 
     def test_deepcopy(self):
@@ -48,7 +48,8 @@ def test_profiling():
         lines1 = [l for l in the_string.split("\n") if "Max if linker" in l]
         lines2 = [l for l in the_string.split("\n") if "Minimum peak" in l]
         if theano.config.device == 'cpu':
-            assert "Max if linker=cvm(default): 4112KB (8204KB)" in the_string, (
+            # The execution order is the one of the CVM itself.
+            assert "Max if linker=cvm(default): 4104KB (8204KB)" in the_string, (
                 lines1, lines2)
             assert "Minimum peak from all valid apply node order is 4104KB" in the_string, (
                 lines1, lines2)
@@ -0,0 +1,68 @@
+import cPickle
+
+import numpy
+
+import theano
+import theano.tensor as T
+from theano.compile import TieredMode, TieredFunction
+
+
+def test_switch_to_full_version():
+    x = T.dvector('x')
+    f = theano.function([x], T.exp(x) * 2 + 1, mode=TieredMode())
+    assert isinstance(f, TieredFunction)
+    quick_maker = f.maker
+    v = numpy.arange(4.)
+    expected = numpy.exp(v) * 2 + 1
+    assert numpy.allclose(f(v), expected)
+
+    assert f.wait_full_version()
+    assert f.fully_optimized
+    assert f.maker is not quick_maker
+    assert f.maker.mode is theano.compile.mode.get_mode('FAST_RUN')
+    assert numpy.allclose(f(v), expected)
+    assert numpy.allclose(f(v + 1), numpy.exp(v + 1) * 2 + 1)
+
+
+def test_updates_and_defaults():
+    x = T.dscalar('x')
+    y = T.dscalar('y')
+    acc = theano.shared(0.)
+    f = theano.function([x, theano.Param(y, default=10.)], acc + x + y,
+                        updates=[(acc, acc + x)], mode='TIERED')
+    assert f(1) == 11
+    assert f(2, 1) == 4
+    assert acc.get_value() == 3
+    assert f.wait_full_version()
+    # The fully optimized version uses the same storage.
+    assert f(3) == 16
+    assert acc.get_value() == 6
+    assert f(4, 0) == 10
+    assert acc.get_value() == 10
+    assert list(f.map([(1,), (2,)])) == [21, 23]
+
+
+def test_full_compilation_failure():
+    class Failing(theano.gof.Optimizer):
+        def apply(self, fgraph):
+            raise ValueError('expected failure')
+    full_mode = theano.compile.Mode(linker='py', optimizer=Failing())
+    x = T.dvector('x')
+    f = theano.function([x], x + 1, mode=TieredMode(full_mode=full_mode))
+    logger = theano.compile.tieredmode._logger
+    logger.disabled = True
+    try:
+        assert not f.wait_full_version()
+    finally:
+        logger.disabled = False
+    assert numpy.allclose(f(numpy.ones(2)), 2)
+
+
+def test_pickle():
+    x = T.dvector('x')
+    f = theano.function([x], x * 3, mode=TieredMode())
+    g = cPickle.loads(cPickle.dumps(f, -1))
+    assert isinstance(g, TieredFunction)
+    assert numpy.allclose(g(numpy.ones(2)), 3)
+    assert g.wait_full_version()
+    assert numpy.allclose(g(numpy.ones(2)), 3)
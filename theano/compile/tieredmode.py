@@ -0,0 +1,174 @@
+"""
+TieredMode: make a function usable quickly, then make it fast.
+"""
+import copy_reg
+import logging
+import threading
+import time
+
+from theano.compile.mode import Mode, get_mode, register_mode
+from theano.compile.function_module import (Function, FunctionMaker,
+                                            ops_with_inner_function,
+                                            _pickle_Function)
+
+_logger = logging.getLogger('theano.compile.tieredmode')
+
+
+class TieredMode(Mode):
+    """
+    `TieredMode` compiles a function twice.
+
+    The function is first compiled with `linker` and `optimizer`, by
+    default the Python linker and the 'fast_compile' optimizations, which
+    is cheap: it can be called right away. A background thread then
+    compiles it again with `full_mode` (FAST_RUN by default), and the
+    function switches to that version as soon as it is ready.
+
+    This gives a low latency before the first call and the speed of
+    `full_mode` afterward. The functions created with this mode are
+    `TieredFunction` instances.
+    """
+
+    def __init__(self, linker='py', optimizer='fast_compile',
+                 full_mode='FAST_RUN'):
+        """
+        :param linker: The linker of the quickly compiled version.
+
+        :param optimizer: The optimizer of the quickly compiled version.
+
+        :param full_mode: The mode (or the name of the mode) of the fully
+            optimized version.
+        """
+        self.__setstate__((linker, optimizer, full_mode))
+
+    def __getstate__(self):
+        return (self.provided_linker, self.provided_optimizer,
+                self.full_mode)
+
+    def __setstate__(self, state):
+        linker, optimizer, full_mode = state
+        self.full_mode = full_mode
+        super(TieredMode, self).__setstate__((linker, optimizer))
+
+    def __str__(self):
+        return "%s(linker = %s, optimizer = %s, full_mode = %s)" % (
+            self.__class__.__name__, self.provided_linker,
+            self.provided_optimizer, self.full_mode)
+
+    def function_maker(self, i, o, m, *args, **kwargs):
+        """Return a `FunctionMaker` that creates `TieredFunction`s."""
+        assert m is self
+        kwargs['function_builder'] = TieredFunction
+        return FunctionMaker(i, o, self, *args, **kwargs)
+
+    def including(self, *tags):
+        ret = super(TieredMode, self).including(*tags)
+        ret.full_mode = get_mode(self.full_mode).including(*tags)
+        return ret
+
+    def excluding(self, *tags):
+        ret = super(TieredMode, self).excluding(*tags)
+        ret.full_mode = get_mode(self.full_mode).excluding(*tags)
+        return ret
+
+    def requiring(self, *tags):
+        ret = super(TieredMode, self).requiring(*tags)
+        ret.full_mode = get_mode(self.full_mode).requiring(*tags)
+        return ret
+
+
+class TieredFunction(Function):
+    """
+    `Function` that switches to a fully optimized version of itself.
+
+    When its maker uses a `TieredMode`, a background thread compiles the
+    graph with the `full_mode` of that mode. The fully optimized version
+    shares the input storage of this function, and it is installed at the
+    beginning of the first call made once it is ready, so that a call is
+    always done entirely by one version. After that, `maker` is the
+    `FunctionMaker` of the fully optimized version.
+
+    If the full compilation fails, a warning is logged and the function
+    keeps using the quickly compiled version.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TieredFunction, self).__init__(*args, **kwargs)
+        # (maker, fn, output_storage) of the fully optimized version, once
+        # it is compiled and until it is installed.
+        self._full_version = None
+        self._full_thread = None
+        self.fully_optimized = False
+        if isinstance(self.maker.mode, TieredMode):
+            self._full_thread = threading.Thread(
+                target=self._compile_full_version,
+                args=(self.maker, get_mode(self.maker.mode.full_mode)))
+            self._full_thread.daemon = True
+            self._full_thread.start()
+
+    def _compile_full_version(self, quick_maker, mode):
+        t0 = time.time()
+        try:
+            maker = FunctionMaker(quick_maker.inputs,
+                                  quick_maker.orig_outputs,
+                                  mode,
+                                  accept_inplace=quick_maker.accept_inplace,
+                                  profile=quick_maker.profile,
+                                  on_unused_input='ignore')
+            # The thunk reads and updates the same storage cells as the
+            # quickly compiled version.
+            fn, _, output_storage = maker.linker.make_thunk(
+                input_storage=[c.storage for c in self.input_storage])
+        except Exception:
+            _logger.warning('Compilation of the fully optimized version of'
+                            ' function %s failed. It will keep using the'
+                            ' quickly compiled version.', self.name,
+                            exc_info=True)
+            return
+        if maker.profile:
+            fn.time_thunks = maker.profile.flag_time_thunks
+        _logger.debug('Fully optimized version of function %s compiled in'
+                      ' %f seconds', self.name, time.time() - t0)
+        self._full_version = (maker, fn, output_storage)
+
+    def _install_full_version(self):
+        maker, fn, output_storage = self._full_version
+        self._full_version = None
+        self.maker = maker
+        self.fn = fn
+        self.output_storage = output_storage
+        self.nodes_with_inner_function = [
+            node.op for node in maker.fgraph.apply_nodes
+            if node.op in ops_with_inner_function]
+        self.fully_optimized = True
+
+    def wait_full_version(self, timeout=None):
+        """
+        Wait for the fully optimized version, and switch to it.
+
+        :param timeout: The maximum time to wait, in seconds. None means
+            to wait until the compilation ends.
+
+        :returns: True if the function now uses the fully optimized version.
+        """
+        if self._full_thread is not None:
+            self._full_thread.join(timeout)
+        if self._full_version is not None:
+            self._install_full_version()
+        return self.fully_optimized
+
+    def __call__(self, *args, **kwargs):
+        if self._full_version is not None:
+            self._install_full_version()
+        return super(TieredFunction, self).__call__(*args, **kwargs)
+
+    def map(self, args_iter):
+        if self._full_version is not None:
+            self._install_full_version()
+        return super(TieredFunction, self).map(args_iter)
+
+
+copy_reg.pickle(TieredFunction, _pickle_Function)
+
+
+register_mode('TIERED', TieredMode())
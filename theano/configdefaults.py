@@ -173,7 +173,7 @@ if rc == 0 and config.cxx != "":
                  ("Default linker used if the theano flags mode is Mode "
                   "or ProfileMode(deprecated)"),
                  EnumStr('cvm', 'c|py', 'py', 'c', 'c|py_nogc', 'c&py',
-                     'vm', 'vm_nogc', 'cvm_nogc'),
+                     'vm', 'vm_nogc', 'cvm_nogc', 'vm_lowmem', 'cvm_lowmem'),
                  in_c_key=False)
 else:
     # g++ is not present or the user disabled it,
@@ -181,7 +181,7 @@ else:
     AddConfigVar('linker',
                  ("Default linker used if the theano flags mode is Mode "
                   "or ProfileMode(deprecated)"),
-                 EnumStr('vm', 'py', 'vm_nogc'),
+                 EnumStr('vm', 'py', 'vm_nogc', 'vm_lowmem'),
                  in_c_key=False)
     try:
         # If the user provided an empty value for cxx, do not warn.
@@ -574,9 +574,15 @@ AddConfigVar('check_input',
              BoolParam(True))
 
 AddConfigVar('cache_optimizations',
-             "WARNING: work in progress, does not work yet. "
-             "Specify if the optimization cache should be used. This cache will "
-             "any optimized graph and its optimization. Actually slow downs a lot "
-             "the first optimization, and could possibly still contains some bugs. "
-             "Use at your own risks.",
+             "Specify if the optimization cache should be used. When True, "
+             "the optimized graph of each compiled function is stored in "
+             "the compiledir, and compiling the same graph again (in any "
+             "process using the same compiledir and config) reuses it "
+             "instead of running the optimizer.",
              BoolParam(False))
+
+AddConfigVar('cache_optimizations_max_entries',
+             "Maximum number of optimized graphs kept in the optimization "
+             "cache. The least recently used ones are deleted first.",
+             IntParam(1000, lambda i: i > 0),
+             in_c_key=False)
@@ -86,3 +86,10 @@ import theano
 
 if theano.config.cmodule.preload_cache:
     cc.get_module_cache()
+
+# Make graph.py use the C implementation of the graph traversals, if it can
+# be compiled. Otherwise, its Python implementation is used.
+try:
+    import theano.gof.graph_c
+except (ImportError, OSError, cmodule.MissingGXX):
+    pass
@@ -84,6 +84,95 @@ def get_module_cache(init_args=None):
     return cmodule.get_module_cache(config.compiledir, init_args=init_args)
 
 
+def _c_linkers(nodes, no_recycling, force_c_code):
+    """
+    Return the list of (key, CLinker) pairs of the C modules that
+    `Op.make_thunk` will use for `nodes`, without duplicated keys.
+    """
+    from theano.gof.op import Op, OpenMPOp
+    default_make_thunk = (Op.make_thunk.im_func, OpenMPOp.make_thunk.im_func)
+    keys = set()
+    keys_and_linkers = []
+    for node in nodes:
+        op = node.op
+        # Ops that define their own make_thunk may not use a CLinker.
+        if (not isinstance(op, Op) or
+                type(op).make_thunk.im_func not in default_make_thunk or
+                not (force_c_code or op._op_use_c_code)):
+            continue
+        if isinstance(op, OpenMPOp):
+            op.update_self_openmp()
+        try:
+            lnk = op.make_c_linker(node, no_recycling)
+            key = lnk.cmodule_key()
+        except (KeyError, NotImplementedError, utils.MethodNotDefined):
+            continue
+        if key is None or key in keys:
+            continue
+        keys.add(key)
+        keys_and_linkers.append((key, lnk))
+    return keys_and_linkers
+
+
+def load_combined_cmodules(nodes, no_recycling, force_c_code=False):
+    """
+    Load the C modules that `Op.make_thunk` will need for `nodes` from a
+    single shared library, if config.cmodule.combine_modules is True.
+
+    Only the modules that are already in the cache are considered. See
+    `ModuleCache.load_combined`.
+
+    :param no_recycling: the list of Variables passed to `make_thunk`.
+
+    :param force_c_code: if True, also consider the ops whose
+        `_op_use_c_code` attribute is False.
+    """
+    if not config.cxx or not config.cmodule.combine_modules:
+        return
+    cache = get_module_cache()
+    entries = []
+    for key, lnk in _c_linkers(nodes, no_recycling, force_c_code):
+        entry = cache.find_entry(key)
+        if entry is not None:
+            entries.append(entry)
+    cache.load_combined(entries)
+
+
+def precompile_cmodules(nodes, no_recycling, force_c_code=False):
+    """
+    Compile concurrently the C modules that `Op.make_thunk` will need for
+    `nodes` and that are not in the cache yet.
+
+    The thunks still have to be made by `make_thunk`, but their modules will
+    be found in the cache. This does nothing if
+    config.cmodule.compile_workers is 1.
+
+    :param no_recycling: the list of Variables passed to `make_thunk`.
+
+    :param force_c_code: if True, also consider the ops whose
+        `_op_use_c_code` attribute is False.
+    """
+    if not config.cxx or config.cmodule.compile_workers <= 1:
+        return
+    cache = get_module_cache()
+    keys_and_linkers = [(key, lnk) for key, lnk in
+                        _c_linkers(nodes, no_recycling, force_c_code)
+                        if key not in cache.entry_from_key]
+    if len(keys_and_linkers) <= 1:
+        # Nothing to do in parallel.
+        return
+    to_compile = []
+    for key, lnk in keys_and_linkers:
+        try:
+            # This generates the code, it fails if there is no C code.
+            lnk.get_src_code()
+        except (NotImplementedError, utils.MethodNotDefined):
+            # make_thunk will fall back on perform.
+            continue
+        to_compile.append((key, lnk))
+    cache.module_from_keys(to_compile)
+
+
 _persistent_module_cache = None
 
 
@@ -1339,8 +1428,8 @@ class CLinker(link.Linker):
                 preargs.remove('-DREPLACE_WITH_AMDLIBM')
             if 'amdlibm' in libs:
                 libs.remove('amdlibm')
-        src_code = mod.code()
-        get_lock()
+        # The caller is responsible for locking: `location` is a new
+        # directory that belongs to this compilation only.
         try:
             _logger.debug("LOCATION %s", str(location))
             module = c_compiler.compile_str(
@@ -1354,8 +1443,6 @@ class CLinker(link.Linker):
         except Exception, e:
             e.args += (str(self.fgraph),)
             raise
-        finally:
-            release_lock()
         return module
 
     def get_dynamic_module(self):
@@ -1434,7 +1521,8 @@ class CLinker(link.Linker):
         except KeyError:
             key = None
         if key is None:
-            # If we can't get a key, then forget the cache mechanism.
+            # If we can't get a key, then forget the cache mechanism. No
+            # lock is needed: the module is compiled in a new directory.
             module = self.compile_cmodule()
         else:
             module = get_module_cache().module_from_key(
@@ -1600,10 +1688,10 @@ class OpWiseCLinker(link.LocalLinker):
 
     def make_all(self, profiler=None, input_storage=None, output_storage=None):
 
-        # The lock will be acquired when we compile the first
-        # C code. We will keep the lock untill all the function
-        # compilation will be finished. This allow to don't
-        # require the lock when all c code are already compiled!
+        # C modules are locked individually while they are compiled, but
+        # the lock on the compilation directory can still be taken (e.g. to
+        # compile code that can not be cached). We will keep it untill all
+        # the function compilation will be finished.
         orig_n_lock = getattr(get_lock, "n_lock", 0)
         try:
 
@@ -1623,6 +1711,9 @@ class OpWiseCLinker(link.LocalLinker):
             for k in storage_map:
                 compute_map[k] = [k.owner is None]
 
+            precompile_cmodules(order, no_recycling, force_c_code=True)
+            load_combined_cmodules(order, no_recycling, force_c_code=True)
+
             thunks = []
             for node in order:
                 # Maker sure we use the C version of the code whenever
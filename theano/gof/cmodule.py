@@ -11,9 +11,11 @@ import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import distutils.sysconfig
+from contextlib import contextmanager
 
 importlib = None
 try:
@@ -36,7 +38,7 @@ from theano.misc.windows import (subprocess_Popen, call_subprocess_Popen,
 from theano.gof import compilelock
 from theano.gof.compiledir import gcc_version_str, local_bitwidth
 
-from theano.configparser import AddConfigVar, BoolParam
+from theano.configparser import AddConfigVar, BoolParam, IntParam
 
 AddConfigVar('cmodule.mac_framework_link',
         "If set to True, breaks certain MacOS installations with the infamous "
@@ -67,12 +69,51 @@ AddConfigVar('cmodule.preload_cache',
              BoolParam(False, allow_override=False),
              in_c_key=False)
 
+
+AddConfigVar('cmodule.precompiled_headers',
+             "If True, the system headers included at the beginning of the "
+             "generated C++ code (Python, numpy and the C++ standard "
+             "library) are precompiled once in the compiledir and reused "
+             "for all the modules compiled by g++.",
+             BoolParam(True),
+             in_c_key=False)
+
+
+AddConfigVar('cmodule.combine_modules',
+             "If True, the C modules of the ops of a function are linked "
+             "into a single shared library the first time all of them are "
+             "in the cache, and the next processes load this library "
+             "instead of one library per op. This needs g++ and objcopy.",
+             BoolParam(False),
+             in_c_key=False)
+
+
+def _compile_workers_default():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+AddConfigVar('cmodule.compile_workers',
+             "Maximum number of C modules compiled at the same time when "
+             "compiling a function. Defaults to the number of CPUs.",
+             IntParam(_compile_workers_default, lambda i: i > 0),
+             in_c_key=False)
+
 _logger = logging.getLogger("theano.gof.cmodule")
 
 METH_VARARGS = "METH_VARARGS"
 METH_NOARGS = "METH_NOARGS"
 # global variable that represent the total time spent in importing module.
 import_time = 0
+# dlimport temporarily modifies sys.path, modules compiled in different
+# threads must be imported one at a time.
+_dlimport_lock = threading.Lock()
+# The dictionaries of the module caches are shared by the threads of the
+# process (e.g. a function compiled in the background). They are only used
+# with this lock held, see `ModuleCache._lock`.
+_module_cache_lock = threading.RLock()
 
 
 class MissingGXX(Exception):
@@ -283,8 +324,9 @@ def dlimport(fullpath, suffix=None):
     _logger.debug("WORKDIR %s", workdir)
     _logger.debug("module_name %s", module_name)
 
-    sys.path[0:0] = [workdir]  # insert workdir at beginning (temporarily)
     global import_time
+    _dlimport_lock.acquire()
+    sys.path[0:0] = [workdir]  # insert workdir at beginning (temporarily)
     try:
         if importlib is not None:
             if hasattr(importlib, "invalidate_caches"):
@@ -297,6 +339,7 @@ def dlimport(fullpath, suffix=None):
             raise Exception('__import__ failed', fullpath)
     finally:
         del sys.path[0]
+        _dlimport_lock.release()
 
     assert fullpath.startswith(rval.__file__)
     return rval
@@ -412,6 +455,31 @@ def get_module_hash(src_code, key):
     return hash_from_code('\n'.join(to_hash))
 
 
+def key_digest(key):
+    """
+    Return a hash of `key` that is stable across processes, or None if it
+    can not be computed.
+
+    It is used by the index of the `ModuleCache` to find the module of a key
+    without loading all the key.pkl files. Ops and types are represented by
+    their class and their string, so different keys may have the same
+    digest: the keys found this way must still be compared with `key`.
+    """
+    def canonical(obj):
+        if isinstance(obj, (tuple, list)):
+            return '(%s)' % ','.join(canonical(o) for o in obj)
+        elif isinstance(obj, (basestring, int, long, float, bool,
+                              type(None))):
+            return repr(obj)
+        else:
+            return '%s.%s{%s}' % (type(obj).__module__, type(obj).__name__,
+                                  obj)
+    try:
+        return hash_from_code(canonical(key))
+    except Exception:
+        return None
+
+
 def get_safe_part(key):
     """
     Return a tuple containing a subset of `key`, to be used to find equal keys.
@@ -479,15 +547,29 @@ class KeyData(object):
         May raise a cPickle.PicklingError if such an exception is raised at
         pickle time (in which case a warning is also displayed).
         """
+        # The file is written under another name, then renamed: other
+        # processes read it without lock, and consider the module directory
+        # as complete as soon as it exists.
         # Note that writing in binary mode is important under Windows.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.key_pkl),
+                                   prefix='key.pkl.', suffix='.tmp')
         try:
-            with open(self.key_pkl, 'wb') as f:
+            with os.fdopen(fd, 'wb') as f:
                 cPickle.dump(self, f, protocol=cPickle.HIGHEST_PROTOCOL)
         except cPickle.PicklingError:
             _logger.warning("Cache leak due to unpickle-able key data %s",
                             self.keys)
-            os.remove(self.key_pkl)
+            os.remove(tmp)
+            if os.path.exists(self.key_pkl):
+                os.remove(self.key_pkl)
             raise
+        except Exception:
+            os.remove(tmp)
+            raise
+        if sys.platform == 'win32' and os.path.exists(self.key_pkl):
+            # os.rename does not replace existing files on Windows.
+            os.remove(self.key_pkl)
+        os.rename(tmp, self.key_pkl)
 
     def get_entry(self):
         """Return path to the module file."""
@@ -518,6 +600,19 @@ class KeyData(object):
                 del entry_from_key[key]
 
 
+def _locked(method):
+    """
+    Decorate a method of ModuleCache so that it runs with the `_lock` of
+    the cache held.
+    """
+    def locked_method(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    locked_method.__name__ = method.__name__
+    locked_method.__doc__ = method.__doc__
+    return locked_method
+
+
 class ModuleCache(object):
     """Interface to the cache of dynamically compiled modules on disk
 
@@ -612,10 +707,64 @@ class ModuleCache(object):
         self.check_for_broken_eq = check_for_broken_eq
         self.loaded_key_pkl = set()
         self.time_spent_in_check_key = 0
+        # The lock of the dictionaries of the cache. It is taken after the
+        # locks of the modules and the one of the compilation directory (no
+        # thread waits for them while it holds it), and before the lock of
+        # the index.
+        self._lock = _module_cache_lock
+        # The attribute `held_module_locks` of this object is the set of the
+        # modules locked by the current thread (see `_module_lock`).
+        self._thread_state = threading.local()
+        # Module hash -> index entry, for the modules of the index.
+        self._index = {}
+        # Key digest -> set of module hashes, for the modules of the index.
+        self._hash_from_digest = {}
+        # Content of the index file, and the stat of the file it was read
+        # from, to avoid reading it again if it did not change.
+        self._index_read = {}
+        self._index_stamp = None
+        # Module hash -> index entry, for the entries not written yet to the
+        # index file (see _update_index).
+        self._index_pending = {}
 
         if do_refresh:
             self.refresh()
 
+    index_filename = 'module_index.pkl'
+    """
+    Name of the file of `dirname` that indexes the modules of the cache.
+
+    It maps each module hash to the directory of the module, the name of
+    the module file, the digests (see `key_digest`) of its keys and the
+    modification time of its key.pkl file. It lets `refresh` skip loading
+    the key.pkl files until they are needed.
+    """
+
+    index_version = 1
+    """Version of the format of the index file."""
+
+    index_max_pending = 100
+    """Number of delayed index entries that makes the index file be
+    written (see `_update_index`)."""
+
+    combined_dirname = 'combined'
+    """
+    Name of the directory of `dirname` where the modules of several ops are
+    linked into one shared library (see `load_combined`).
+    """
+
+    module_lock_dirname = 'module_locks'
+    """
+    Name of the sub-directory of `dirname` that holds the locks of the
+    modules being compiled (see `_module_lock`).
+    """
+
+    age_thresh_empty = 60 * 60    # 1 hour
+    """
+    Empty module directories younger than this (in seconds) are not
+    deleted by ``refresh``, as they may be in use by a compilation.
+    """
+
     age_thresh_use = 60 * 60 * 24 * 24    # 24 days
     """
     The default age threshold (in seconds) for cache files we want to use.
@@ -623,6 +772,7 @@ class ModuleCache(object):
     Older modules will be deleted in ``clear_old``.
     """
 
+    @_locked
     def _get_module(self, name):
         """
         Fetch a compiled module from the loaded cache or the disk.
@@ -636,10 +786,68 @@ class ModuleCache(object):
             self.stats[0] += 1
         return self.module_from_name[name]
 
+    @_locked
+    def load_combined(self, entries):
+        """
+        Load the modules `entries` (paths of modules of the cache, as
+        returned by `find_entry`) from a single shared library, linking it
+        if needed.
+
+        The library is identified by the set of `entries`, normally all the
+        modules needed by a function, and kept in the `combined_dirname`
+        directory. The modules loaded from it are then returned by
+        `module_from_key`, without loading their own library.
+        The modules that are already loaded are not loaded again. Nothing is
+        done if some module was compiled without
+        config.cmodule.combine_modules, or if another process is linking
+        the same library.
+
+        :returns: the number of modules loaded from the combined library.
+        """
+        entries = sorted(set(entries))
+        to_load = [entry for entry in entries
+                   if entry not in self.module_from_name]
+        if len(entries) < 2 or not to_load:
+            return 0
+        key = hash_from_code('\n'.join(os.path.relpath(entry, self.dirname)
+                                       for entry in entries))
+        base_dir = os.path.join(self.dirname, self.combined_dirname)
+        location = os.path.join(base_dir, 'combined_' + key)
+        if not os.path.isdir(location):
+            lock_dir = os.path.join(base_dir, key + '.lock')
+            if not compilelock.lock(lock_dir, blocking=False):
+                return 0
+            try:
+                if (not os.path.isdir(location) and
+                        not link_combined(entries, location)):
+                    return 0
+            finally:
+                compilelock.remove_lock(lock_dir)
+        try:
+            os.utime(os.path.join(location,
+                                  'combined.%s' % get_lib_extension()), None)
+        except OSError:
+            pass
+        for entry in to_load:
+            name = os.path.join(location, os.path.basename(entry))
+            _logger.debug('loading name %s', name)
+            self.module_from_name[entry] = dlimport(name)
+            self.stats[1] += 1
+            try:
+                # clear_old() deletes the modules that are not accessed.
+                os.utime(entry, None)
+            except OSError:
+                pass
+        return len(to_load)
+
     def refresh(self, age_thresh_use=None, delete_if_problem=False, cleanup=True):
         """Update cache data by walking the cache directory structure.
 
-        Load key.pkl files that have not been loaded yet.
+        Modules listed in the index (see `index_filename`) are only
+        registered: their key.pkl file is loaded on demand, when one of
+        their keys or their module hash is looked up. Load the key.pkl
+        files of the other directories that have not been loaded yet, and
+        add them to the index.
         Remove entries which have been removed from the filesystem.
         Also, remove malformed cache directories.
 
@@ -655,7 +863,25 @@ class ModuleCache(object):
         :param cleanup: Do a cleanup of the cache removing expired and
         broken modules.
 
-        :returns: a list of modules of age higher than age_thresh_use.
+        :returns: a list of modules of age higher than age_thresh_use
+        (among the modules whose key.pkl file was loaded).
+        """
+        too_old_to_use, to_delete = self._refresh(
+            age_thresh_use, delete_if_problem, cleanup)
+        if to_delete:
+            # Without the lock of the cache, see `_lock`.
+            with compilelock.lock_ctx():
+                for a, kw in to_delete:
+                    _rmtree(*a, **kw)
+        return too_old_to_use
+
+    @_locked
+    def _refresh(self, age_thresh_use, delete_if_problem, cleanup):
+        """
+        Do the work of `refresh`, except deleting the directories.
+
+        :returns: the modules too old to use, and the list of the
+        (args, kwargs) of the calls to `_rmtree` to do.
         """
         if age_thresh_use is None:
             age_thresh_use = self.age_thresh_use
@@ -667,6 +893,12 @@ class ModuleCache(object):
             if cleanup:
                 to_delete.append((args, kwargs))
 
+        index = self._read_index()
+        # Directory name -> module hash, for the modules in the index.
+        indexed_dirs = dict((index_entry[0], module_hash)
+                            for module_hash, index_entry in index.iteritems())
+        new_index_entries = {}
+
         # add entries that are not in the entry_from_key dictionary
         time_now = time.time()
         # Go through directories in alphabetical order to ensure consistent
@@ -675,185 +907,56 @@ class ModuleCache(object):
         files, root = None, None  # To make sure the "del" below works
         for subdirs_elem in subdirs:
             # Never clean/remove lock_dir
-            if subdirs_elem == 'lock_dir':
+            if subdirs_elem in ('lock_dir', self.module_lock_dirname,
+                                self.index_filename, self.combined_dirname):
                 continue
             root = os.path.join(self.dirname, subdirs_elem)
             key_pkl = os.path.join(root, 'key.pkl')
             if key_pkl in self.loaded_key_pkl:
                 continue
+            if subdirs_elem in indexed_dirs:
+                self._register_index_entry(indexed_dirs[subdirs_elem],
+                                           index[indexed_dirs[subdirs_elem]])
+                continue
             if not os.path.isdir(root):
                 continue
             files = os.listdir(root)
-            if not files or 'delete.me' in files:
+            if 'delete.me' in files:
                 rmtree(root, ignore_nocleanup=True,
                        msg="delete.me found in dir")
                 continue
-            elif 'key.pkl' in files:
-                try:
-                    entry = module_name_from_dir(root, files=files)
-                except ValueError:  # there is a key but no dll!
-                    if not root.startswith("/tmp"):
-                        # Under /tmp, file are removed periodically by the
-                        # os. So it is normal that this happens from time
-                        # to time.
-                        _logger.warning("ModuleCache.refresh() Found key "
-                                        "without dll in cache, deleting it. %s",
-                                        key_pkl)
+            elif not files:
+                # Another process may be about to compile a module in
+                # this directory (it only holds the lock of that module).
+                if time_now - last_access_time(root) > self.age_thresh_empty:
                     rmtree(root, ignore_nocleanup=True,
-                           msg="missing module file", level=logging.INFO)
-                    continue
-                if (time_now - last_access_time(entry)) < age_thresh_use:
-                    _logger.debug('refresh adding %s', key_pkl)
-
-                    def unpickle_failure():
-                        _logger.info("ModuleCache.refresh() Failed to "
-                                     "unpickle cache file %s", key_pkl)
-
-                    try:
-                        with open(key_pkl, 'rb') as f:
-                            key_data = cPickle.load(f)
-                    except EOFError:
-                        # Happened once... not sure why (would be worth
-                        # investigating if it ever happens again).
-                        unpickle_failure()
-                        rmtree(root, ignore_nocleanup=True,
-                               msg='broken cache directory [EOF]',
-                               level=logging.WARNING)
-                        continue
-                    except ValueError:
-                        # This can happen when we have bad config value
-                        # in the cuda.nvcc_compiler.py file.
-                        # We should not hide it here, as this will cause
-                        # an unrelated error to appear.
-                        raise
-                    except Exception:
-                        unpickle_failure()
-                        if delete_if_problem:
-                            rmtree(root, ignore_nocleanup=True,
-                                   msg='broken cache directory',
-                                   level=logging.INFO)
-                        else:
-                            # This exception is often triggered by keys
-                            # that contain references to classes that have
-                            # not yet been imported (e.g. when running two
-                            # different Theano-based scripts). They are not
-                            # necessarily broken, but we cannot load them
-                            # now. They will be loaded later if needed.
-                            pass
-                        continue
-
-                    if not isinstance(key_data, KeyData):
-                        # This is some old cache data, that does not fit
-                        # the new cache format. It would be possible to
-                        # update it, but it is not entirely safe since we
-                        # do not know the config options that were used.
-                        # As a result, we delete it instead (which is also
-                        # simpler to implement).
-                        rmtree(root, ignore_nocleanup=True,
-                               msg=(
-                                'invalid cache entry format -- this '
-                                'should not happen unless your cache '
-                                'was really old'),
-                               level=logging.WARN)
-                        continue
-
-                    # Check the path to the module stored in the KeyData
-                    # object matches the path to `entry`. There may be
-                    # a mismatch e.g. due to symlinks, or some directory
-                    # being renamed since last time cache was created.
-                    kd_entry = key_data.get_entry()
-                    if kd_entry != entry:
-                        if is_same_entry(entry, kd_entry):
-                            # Update KeyData object. Note that we also need
-                            # to update the key_pkl field, because it is
-                            # likely to be incorrect if the entry itself
-                            # was wrong.
-                            key_data.entry = entry
-                            key_data.key_pkl = key_pkl
-                        else:
-                            # This is suspicious. Better get rid of it.
-                            rmtree(root, ignore_nocleanup=True,
-                                   msg='module file path mismatch',
-                                   level=logging.INFO)
-                            continue
-
-                    # Find unversioned keys from other processes.
-                    # TODO: check if this can happen at all
-                    to_del = [key for key in key_data.keys if not key[0]]
-                    if to_del:
-                        _logger.warning(
-                            "ModuleCache.refresh() Found unversioned "
-                            "key in cache, removing it. %s", key_pkl)
-                        # Since the version is in the module hash, all
-                        # keys should be unversioned.
-                        if len(to_del) != len(key_data.keys):
-                            _logger.warning(
-                                'Found a mix of unversioned and '
-                                'versioned keys for the same '
-                                'module %s', key_pkl)
-                        rmtree(root, ignore_nocleanup=True,
-                               msg="unversioned key(s) in cache",
-                               level=logging.INFO)
-                        continue
-
-                    mod_hash = key_data.module_hash
-                    if mod_hash in self.module_hash_to_key_data:
-                        # This may happen when two processes running
-                        # simultaneously compiled the same module, one
-                        # after the other. We delete one once it is old
-                        # enough (to be confident there is no other process
-                        # using it), or if `delete_if_problem` is True.
-                        # Note that it is important to walk through
-                        # directories in alphabetical order so as to make
-                        # sure all new processes only use the first one.
-                        if cleanup:
-                            age = time.time() - last_access_time(entry)
-                            if delete_if_problem or age > self.age_thresh_del:
-                                rmtree(root, ignore_nocleanup=True,
-                                       msg='duplicated module',
-                                       level=logging.DEBUG)
-                            else:
-                                _logger.debug('Found duplicated module not '
-                                              'old enough yet to be deleted '
-                                              '(age: %s): %s',
-                                              age, entry)
-                        continue
-
-                    # Remember the map from a module's hash to the KeyData
-                    # object associated with it.
-                    self.module_hash_to_key_data[mod_hash] = key_data
-
-                    for key in key_data.keys:
-                        if key not in self.entry_from_key:
-                            self.entry_from_key[key] = entry
-                            # Assert that we have not already got this
-                            # entry somehow.
-                            assert entry not in self.module_from_name
-                            # Store safe part of versioned keys.
-                            if key[0]:
-                                self.similar_keys.setdefault(
-                                    get_safe_part(key),
-                                    []).append(key)
-                        else:
-                            _logger.warning(
-                                "The same cache key is associated to "
-                                "different modules (%s and %s). This "
-                                "is not supposed to happen! You may "
-                                "need to manually delete your cache "
-                                "directory to fix this.",
-                                self.entry_from_key[key],
-                                entry)
-                    # Clean up the name space to prevent bug.
-                    if key_data.keys:
-                        del key
-                    self.loaded_key_pkl.add(key_pkl)
-                else:
-                    too_old_to_use.append(entry)
+                           msg="empty dir")
+                continue
+            elif 'key.pkl' in files:
+                key_data, too_old = self._load_key_data(
+                    root, files, rmtree, age_thresh_use=age_thresh_use,
+                    delete_if_problem=delete_if_problem, cleanup=cleanup,
+                    time_now=time_now)
+                if too_old is not None:
+                    too_old_to_use.append(too_old)
+                if key_data is not None and key_data.keys:
+                    new_index_entries[key_data.module_hash] = (
+                        self._make_index_entry(key_data))
 
             # If the compilation failed, no key.pkl is in that
             # directory, but a mod.* should be there.
             # We do nothing here.
 
+        # Index entries whose directory was deleted.
+        subdirs_set = set(subdirs)
+        gone_from_index = [module_hash
+                           for module_hash, index_entry in index.iteritems()
+                           if index_entry[0] not in subdirs_set]
+        for module_hash in gone_from_index:
+            self._unregister_index_entry(module_hash)
+        if new_index_entries or gone_from_index:
+            self._update_index(new_index_entries, gone_from_index)
+
         # Clean up the name space to prevent bug.
         del root, files, subdirs
 
@@ -900,16 +1003,387 @@ class ModuleCache(object):
                                         pkl_file_to_remove)
                     self.loaded_key_pkl.remove(pkl_file_to_remove)
 
-        if to_delete:
-            with compilelock.lock_ctx():
-                for a, kw in to_delete:
-                    _rmtree(*a, **kw)
-
         _logger.debug('Time needed to refresh cache: %s',
                       (time.time() - start_time))
 
-        return too_old_to_use
+        return too_old_to_use, to_delete
 
+    def _index_path(self):
+        return os.path.join(self.dirname, self.index_filename)
+
+    def _read_index(self):
+        """
+        Return the content of the index file: a dict module hash -> index
+        entry (see `_make_index_entry`). It must not be modified.
+        """
+        path = self._index_path()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        if stamp == self._index_stamp:
+            return self._index_read
+        try:
+            with open(path, 'rb') as f:
+                data = cPickle.load(f)
+            if (not isinstance(data, dict) or
+                    data.get('version') != self.index_version):
+                raise ValueError('unknown index format')
+            modules = data['modules']
+        except Exception, e:
+            # It will be rebuilt by refresh().
+            _logger.warning('Ignoring broken module cache index %s: %s',
+                            path, e)
+            return {}
+        self._index_read = modules
+        self._index_stamp = stamp
+        return modules
+
+    @staticmethod
+    def _merge_index_entries(old, new):
+        """Return `new`, with the key digests of `old` if it is the entry
+        of the same directory."""
+        if old is not None and old[0] == new[0]:
+            return new[:2] + (old[2] | new[2],) + new[3:]
+        return new
+
+    @_locked
+    def _update_index(self, add, remove, delay=False):
+        """
+        Add entries to the index file and remove some from it.
+
+        :param add: dict module hash -> index entry. The key digests are
+            merged with the ones in the index.
+        :param remove: list of module hashes to remove, if their directory
+            did not change in the index.
+        :param delay: if True, only remember the entries of `add`. They are
+            written with the next update that is not delayed, once
+            `index_max_pending` of them are waiting, or when the process
+            exits. Until then, the other processes find these keys by
+            loading the key.pkl files.
+        """
+        if delay and not remove:
+            for module_hash, index_entry in add.iteritems():
+                self._index_pending[module_hash] = self._merge_index_entries(
+                    self._index_pending.get(module_hash), index_entry)
+                self._register_index_entry(
+                    module_hash, self._merge_index_entries(
+                        self._index.get(module_hash), index_entry))
+            if len(self._index_pending) < self.index_max_pending:
+                return
+            add = {}
+        if self._index_pending:
+            pending = self._index_pending
+            self._index_pending = {}
+            for module_hash, index_entry in add.iteritems():
+                pending[module_hash] = self._merge_index_entries(
+                    pending.get(module_hash), index_entry)
+            add = pending
+        lock_dir = os.path.join(self.dirname, self.module_lock_dirname,
+                                'index')
+        removed = dict((module_hash, self._index.get(module_hash))
+                       for module_hash in remove)
+        try:
+            with compilelock.dir_lock_ctx(lock_dir, min_wait=0.1,
+                                          max_wait=0.3):
+                modules = dict(self._read_index())
+                for module_hash, index_entry in add.iteritems():
+                    modules[module_hash] = self._merge_index_entries(
+                        modules.get(module_hash), index_entry)
+                for module_hash in remove:
+                    old = modules.get(module_hash)
+                    if (old is not None and (removed[module_hash] is None or
+                                             old[0] == removed[module_hash][0])):
+                        del modules[module_hash]
+                fd, tmp = tempfile.mkstemp(dir=self.dirname,
+                                           prefix=self.index_filename + '.',
+                                           suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        cPickle.dump({'version': self.index_version,
+                                      'modules': modules},
+                                     f, protocol=cPickle.HIGHEST_PROTOCOL)
+                    os.rename(tmp, self._index_path())
+                except Exception:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+        except Exception, e:
+            # The index is only an optimization: refresh() will load the
+            # directories that are not in it.
+            _logger.warning('Could not update the module cache index: %s',
+                            e)
+            return
+        for module_hash, index_entry in add.iteritems():
+            # A delayed entry may be removed by the same update, when the
+            # directory of its module was deleted.
+            if module_hash in modules:
+                self._register_index_entry(module_hash, modules[module_hash])
+
+    def _make_index_entry(self, key_data, keys=None):
+        """Return the index entry of a KeyData.
+
+        :param keys: the keys whose digests are put in the entry. By
+            default, all the keys of key_data.
+        """
+        root = os.path.dirname(key_data.key_pkl)
+        if keys is None:
+            keys = key_data.keys
+        digests = frozenset(d for d in (key_digest(key)
+                                        for key in keys if key[0])
+                            if d is not None)
+        try:
+            mtime = os.path.getmtime(key_data.key_pkl)
+        except OSError:
+            mtime = 0
+        return (os.path.basename(root),
+                os.path.basename(key_data.get_entry()),
+                digests, mtime)
+
+    def _register_index_entry(self, module_hash, index_entry):
+        if self._index.get(module_hash) == index_entry:
+            return
+        self._unregister_index_entry(module_hash)
+        self._index[module_hash] = index_entry
+        for digest in index_entry[2]:
+            self._hash_from_digest.setdefault(digest, set()).add(module_hash)
+
+    def _unregister_index_entry(self, module_hash):
+        index_entry = self._index.pop(module_hash, None)
+        if index_entry is not None:
+            for digest in index_entry[2]:
+                hashes = self._hash_from_digest.get(digest)
+                if hashes is not None:
+                    hashes.discard(module_hash)
+                    if not hashes:
+                        del self._hash_from_digest[digest]
+
+    def _load_indexed(self, module_hash):
+        """
+        Load the key.pkl file of a module registered from the index.
+
+        If it was already loaded, add the keys that other processes may
+        have added since then.
+        """
+        index_entry = self._index.get(module_hash)
+        if index_entry is None:
+            return
+        root = os.path.join(self.dirname, index_entry[0])
+        key_data = self.module_hash_to_key_data.get(module_hash)
+        if key_data is not None:
+            if os.path.dirname(key_data.key_pkl) != root:
+                return
+            try:
+                with open(key_data.key_pkl, 'rb') as f:
+                    disk_key_data = cPickle.load(f)
+            except Exception:
+                return
+            entry = key_data.get_entry()
+            for key in disk_key_data.keys:
+                if key not in self.entry_from_key:
+                    key_data.keys.add(key)
+                    self.entry_from_key[key] = entry
+                    if key[0]:
+                        self.similar_keys.setdefault(get_safe_part(key),
+                                                     []).append(key)
+            return
+        try:
+            files = os.listdir(root)
+        except OSError:
+            # Deleted by another process.
+            self._unregister_index_entry(module_hash)
+            return
+        if 'key.pkl' not in files or 'delete.me' in files:
+            self._unregister_index_entry(module_hash)
+            return
+        self._load_key_data(root, files, rmtree=lambda *a, **kw: None,
+                            age_thresh_use=self.age_thresh_use,
+                            delete_if_problem=False, cleanup=False,
+                            time_now=time.time())
+
+    def _load_key_data(self, root, files, rmtree, age_thresh_use,
+                       delete_if_problem, cleanup, time_now):
+        """
+        Load the key.pkl file of the module directory `root` and register
+        its keys.
+
+        :param files: the list of files in `root`.
+
+        :param rmtree: function called with the arguments of `_rmtree` to
+            delete `root` if it is broken.
+
+        See `refresh` for the other parameters.
+
+        :returns: a pair (key_data, too_old_entry). key_data is the loaded
+            KeyData, or None if it was not loaded. too_old_entry is the
+            path to the module if it is older than age_thresh_use, or None.
+        """
+        key_pkl = os.path.join(root, 'key.pkl')
+        try:
+            entry = module_name_from_dir(root, files=files)
+        except ValueError:  # there is a key but no dll!
+            if not root.startswith("/tmp"):
+                # Under /tmp, file are removed periodically by the
+                # os. So it is normal that this happens from time
+                # to time.
+                _logger.warning("ModuleCache.refresh() Found key "
+                                "without dll in cache, deleting it. %s",
+                                key_pkl)
+            rmtree(root, ignore_nocleanup=True,
+                   msg="missing module file", level=logging.INFO)
+            return None, None
+        if (time_now - last_access_time(entry)) < age_thresh_use:
+            _logger.debug('refresh adding %s', key_pkl)
+
+            def unpickle_failure():
+                _logger.info("ModuleCache.refresh() Failed to "
+                             "unpickle cache file %s", key_pkl)
+
+            try:
+                with open(key_pkl, 'rb') as f:
+                    key_data = cPickle.load(f)
+            except EOFError:
+                # Happened once... not sure why (would be worth
+                # investigating if it ever happens again).
+                unpickle_failure()
+                rmtree(root, ignore_nocleanup=True,
+                       msg='broken cache directory [EOF]',
+                       level=logging.WARNING)
+                return None, None
+            except ValueError:
+                # This can happen when we have bad config value
+                # in the cuda.nvcc_compiler.py file.
+                # We should not hide it here, as this will cause
+                # an unrelated error to appear.
+                raise
+            except Exception:
+                unpickle_failure()
+                if delete_if_problem:
+                    rmtree(root, ignore_nocleanup=True,
+                           msg='broken cache directory',
+                           level=logging.INFO)
+                else:
+                    # This exception is often triggered by keys
+                    # that contain references to classes that have
+                    # not yet been imported (e.g. when running two
+                    # different Theano-based scripts). They are not
+                    # necessarily broken, but we cannot load them
+                    # now. They will be loaded later if needed.
+                    pass
+                return None, None
+
+            if not isinstance(key_data, KeyData):
+                # This is some old cache data, that does not fit
+                # the new cache format. It would be possible to
+                # update it, but it is not entirely safe since we
+                # do not know the config options that were used.
+                # As a result, we delete it instead (which is also
+                # simpler to implement).
+                rmtree(root, ignore_nocleanup=True,
+                       msg=(
+                        'invalid cache entry format -- this '
+                        'should not happen unless your cache '
+                        'was really old'),
+                       level=logging.WARN)
+                return None, None
+
+            # Check the path to the module stored in the KeyData
+            # object matches the path to `entry`. There may be
+            # a mismatch e.g. due to symlinks, or some directory
+            # being renamed since last time cache was created.
+            kd_entry = key_data.get_entry()
+            if kd_entry != entry:
+                if is_same_entry(entry, kd_entry):
+                    # Update KeyData object. Note that we also need
+                    # to update the key_pkl field, because it is
+                    # likely to be incorrect if the entry itself
+                    # was wrong.
+                    key_data.entry = entry
+                    key_data.key_pkl = key_pkl
+                else:
+                    # This is suspicious. Better get rid of it.
+                    rmtree(root, ignore_nocleanup=True,
+                           msg='module file path mismatch',
+                           level=logging.INFO)
+                    return None, None
+
+            # Find unversioned keys from other processes.
+            # TODO: check if this can happen at all
+            to_del = [key for key in key_data.keys if not key[0]]
+            if to_del:
+                _logger.warning(
+                    "ModuleCache.refresh() Found unversioned "
+                    "key in cache, removing it. %s", key_pkl)
+                # Since the version is in the module hash, all
+                # keys should be unversioned.
+                if len(to_del) != len(key_data.keys):
+                    _logger.warning(
+                        'Found a mix of unversioned and '
+                        'versioned keys for the same '
+                        'module %s', key_pkl)
+                rmtree(root, ignore_nocleanup=True,
+                       msg="unversioned key(s) in cache",
+                       level=logging.INFO)
+                return None, None
+
+            mod_hash = key_data.module_hash
+            if (mod_hash in self.module_hash_to_key_data or
+                    (mod_hash in self._index and
+                     self._index[mod_hash][0] != os.path.basename(root))):
+                # This may happen when two processes running
+                # simultaneously compiled the same module, one
+                # after the other. We delete one once it is old
+                # enough (to be confident there is no other process
+                # using it), or if `delete_if_problem` is True.
+                # Note that it is important to walk through
+                # directories in alphabetical order so as to make
+                # sure all new processes only use the first one.
+                if cleanup:
+                    age = time.time() - last_access_time(entry)
+                    if delete_if_problem or age > self.age_thresh_del:
+                        rmtree(root, ignore_nocleanup=True,
+                               msg='duplicated module',
+                               level=logging.DEBUG)
+                    else:
+                        _logger.debug('Found duplicated module not '
+                                      'old enough yet to be deleted '
+                                      '(age: %s): %s',
+                                      age, entry)
+                return None, None
+
+            # Remember the map from a module's hash to the KeyData
+            # object associated with it.
+            self.module_hash_to_key_data[mod_hash] = key_data
+
+            for key in key_data.keys:
+                if key not in self.entry_from_key:
+                    self.entry_from_key[key] = entry
+                    # Assert that we have not already got this
+                    # entry somehow.
+                    assert entry not in self.module_from_name
+                    # Store safe part of versioned keys.
+                    if key[0]:
+                        self.similar_keys.setdefault(
+                            get_safe_part(key),
+                            []).append(key)
+                else:
+                    _logger.warning(
+                        "The same cache key is associated to "
+                        "different modules (%s and %s). This "
+                        "is not supposed to happen! You may "
+                        "need to manually delete your cache "
+                        "directory to fix this.",
+                        self.entry_from_key[key],
+                        entry)
+            self.loaded_key_pkl.add(key_pkl)
+            return key_data, None
+        else:
+            return None, entry
+
+
+
+    @_locked
     def _get_from_key(self, key, key_data=None):
         """
         Returns a module if the passed-in key is found in the cache
@@ -917,16 +1391,9 @@ class ModuleCache(object):
 
         May raise ValueError if the key is malformed.
         """
-        name = None
         if key is not None:
             assert key_data is None
-            try:
-                _version, _rest = key
-            except (TypeError, ValueError):
-                raise ValueError(
-                    "Invalid key. key must have form (version, rest)", key)
-            if key in self.entry_from_key:
-                name = self.entry_from_key[key]
+            name = self.find_entry(key)
         else:
             assert key_data is not None
             name = key_data.get_entry()
@@ -934,24 +1401,110 @@ class ModuleCache(object):
             return None
         return self._get_module(name)
 
+    @_locked
+    def find_entry(self, key):
+        """
+        Return the path of the module of `key` if it is in the cache, and
+        None otherwise. The module is not loaded.
+
+        May raise ValueError if the key is malformed.
+        """
+        try:
+            _version, _rest = key
+        except (TypeError, ValueError):
+            raise ValueError(
+                "Invalid key. key must have form (version, rest)", key)
+        name = self.entry_from_key.get(key)
+        if name is None and self._hash_from_digest:
+            # It may be in a key.pkl file that was not loaded yet.
+            for module_hash in sorted(
+                    self._hash_from_digest.get(key_digest(key), ())):
+                self._load_indexed(module_hash)
+                name = self.entry_from_key.get(key)
+                if name is not None:
+                    break
+        return name
+
+    def _module_lock(self, module_hash):
+        """
+        Return a context manager locking the module `module_hash`.
+
+        Only processes compiling or adding keys to the same module wait for
+        each other. The lock is re-entrant within a thread.
+        """
+        if module_hash in self._held_module_locks():
+            return _null_ctx()
+        return self._acquire_module_lock(module_hash)
+
+    @contextmanager
+    def _lock_all(self):
+        """
+        Lock the compilation directory, then the cache (see `_lock`).
+        """
+        with compilelock.lock_ctx():
+            with self._lock:
+                yield
+
+    def _held_module_locks(self):
+        """Return the set of the modules locked by the current thread."""
+        held = getattr(self._thread_state, 'held_module_locks', None)
+        if held is None:
+            held = self._thread_state.held_module_locks = set()
+        return held
+
+    @contextmanager
+    def _acquire_module_lock(self, module_hash):
+        lock_dir = os.path.join(self.dirname, self.module_lock_dirname,
+                                module_hash)
+        with compilelock.dir_lock_ctx(lock_dir):
+            held = self._held_module_locks()
+            held.add(module_hash)
+            try:
+                yield
+            finally:
+                held.remove(module_hash)
+
     def _get_from_hash(self, module_hash, key, keep_lock=False):
-        if module_hash in self.module_hash_to_key_data:
-            key_data = self.module_hash_to_key_data[module_hash]
+        with self._lock:
+            if (module_hash not in self.module_hash_to_key_data and
+                    module_hash in self._index):
+                self._load_indexed(module_hash)
+                if key in self.entry_from_key:
+                    # The key was already in the key.pkl file.
+                    return self._get_from_key(key)
+            key_data = self.module_hash_to_key_data.get(module_hash)
+            if key_data is None:
+                return None
             module = self._get_from_key(None, key_data)
-            with compilelock.lock_ctx(keep_lock=keep_lock):
+        # The lock of the module is taken without the lock of the cache,
+        # see `_lock`.
+        with self._module_lock(module_hash):
+            with self._lock:
+                if key in key_data.keys:
+                    # Another thread added it in the meantime.
+                    return module
                 try:
                     key_data.add_key(key, save_pkl=bool(key[0]))
                     key_broken = False
                 except cPickle.PicklingError:
                     key_data.remove_key(key)
                     key_broken = True
-            if (key[0] and not key_broken and
-                self.check_for_broken_eq):
-                self.check_key(key, key_data.key_pkl)
-            self._update_mappings(key, key_data, module.__file__, check_in_keys=not key_broken)
-            return module
-        else:
-            return None
+                if (key[0] and not key_broken and
+                    self.check_for_broken_eq):
+                    self.check_key(key, key_data.key_pkl)
+                self._update_mappings(key, key_data, module.__file__,
+                                      check_in_keys=not key_broken)
+                if key[0] and not key_broken:
+                    # Only the digest of the new key is added: the index
+                    # entry already has the other ones. Processes often add
+                    # many keys to existing modules (e.g. for constant
+                    # folding), so the index file is not rewritten for each
+                    # of them.
+                    self._update_index(
+                        {module_hash: self._make_index_entry(key_data,
+                                                             [key])},
+                        [], delay=True)
+        return module
 
     def _update_mappings(self, key, key_data, name, check_in_keys):
         all_keys = key_data.keys
@@ -968,9 +1521,10 @@ class ModuleCache(object):
                     self.similar_keys.setdefault(get_safe_part(k),
                                                  []).append(key)
 
+    @_locked
     def _add_to_cache(self, module, key, module_hash):
         """
-        This function expects the compile lock to be held.
+        This function expects the lock of `module_hash` to be held.
         """
         name = module.__file__
         _logger.debug("Adding module to cache %s %s",
@@ -1000,6 +1554,9 @@ class ModuleCache(object):
             if not key_broken and self.check_for_broken_eq:
                 self.check_key(key, key_pkl)
             self.loaded_key_pkl.add(key_pkl)
+            if not key_broken:
+                self._update_index(
+                    {module_hash: self._make_index_entry(key_data)}, [])
         elif config.cmodule.warn_no_version:
             key_flat = flatten(key)
             ops = [k for k in key_flat if isinstance(k, theano.Op)]
@@ -1024,68 +1581,107 @@ class ModuleCache(object):
                     load/compile and the second performs the actual
                     compilation.
 
-        :param keep_lock: If True, the compilation lock will not be
-                          released if taken.
+        :param keep_lock: Not used anymore, as modules are locked
+                          individually while they are compiled.
         """
-        # Is the module in the cache?
-        module = self._get_from_key(key)
-        if module is not None:
-            return module
-
-        lock_taken = False
-
-        src_code = lnk.get_src_code()
-        # Is the source code already in the cache?
-        module_hash = get_module_hash(src_code, key)
-        module = self._get_from_hash(module_hash, key, keep_lock=keep_lock)
-        if module is not None:
-            return module
-
-        with compilelock.lock_ctx(keep_lock=keep_lock):
-            # Maybe somebody else compiled it for us while we
-            # where waiting for the lock. Try to load it again
-            self.refresh(cleanup=False)
+        return self.module_from_keys([(key, lnk)], n_workers=1)[0]
 
-            module = self._get_from_key(key)
-            if module is not None:
-                return module
-
-            module = self._get_from_hash(module_hash, key)
-            if module is not None:
-                return module
+    def module_from_keys(self, keys_and_linkers, n_workers=None):
+        """
+        Return the modules for several keys, compiling the missing ones
+        concurrently.
 
-            hash_key = hash(key)
+        :param keys_and_linkers: list of (key, lnk) pairs, see
+            `module_from_key`.
 
-            nocleanup = False
-            try:
-                location = dlimport_workdir(self.dirname)
-                module = lnk.compile_cmodule(location)
-                name = module.__file__
-                assert name.startswith(location)
-                assert name not in self.module_from_name
-                self.module_from_name[name] = module
-                nocleanup = True
-            except OSError, e:
-                _logger.error(e)
-                if e.errno == 31:
-                    _logger.error('There are %i files in %s',
-                                  len(os.listdir(config.compiledir)),
-                                  config.compiledir)
-                raise
-            finally:
-                if not nocleanup:
-                    _rmtree(location, ignore_if_missing=True,
-                            msg='exception during compilation')
+        :param n_workers: maximum number of modules compiled at the same
+            time. Defaults to config.cmodule.compile_workers.
 
-            # Changing the hash of the key is not allowed during
-            # compilation.
-            assert hash(key) == hash_key
+        :returns: the list of the modules, in the same order as
+            `keys_and_linkers`.
 
-            key_data = self._add_to_cache(module, key, module_hash)
-            self.module_hash_to_key_data[module_hash] = key_data
-
-        self.stats[2] += 1
-        return module
+        Only the modules that need to be compiled are locked (see
+        `_module_lock`), so other processes can compile other modules at
+        the same time.
+        """
+        if n_workers is None:
+            n_workers = config.cmodule.compile_workers
+        modules = [None] * len(keys_and_linkers)
+        # module hash -> list of (index, key, lnk) that are not in the cache
+        missing = {}
+        for idx, (key, lnk) in enumerate(keys_and_linkers):
+            # Is the module in the cache?
+            module = self._get_from_key(key)
+            if module is None:
+                src_code = lnk.get_src_code()
+                # Is the source code already in the cache?
+                module_hash = get_module_hash(src_code, key)
+                module = self._get_from_hash(module_hash, key)
+                if module is None:
+                    missing.setdefault(module_hash, []).append(
+                        (idx, key, lnk))
+                    continue
+            modules[idx] = module
+        if not missing:
+            return modules
+
+        # Lock in a consistent order to avoid dead locks between processes.
+        locks = [self._module_lock(module_hash)
+                 for module_hash in sorted(missing)]
+        entered = []
+        try:
+            for lock in locks:
+                lock.__enter__()
+                entered.append(lock)
+            # Maybe somebody else compiled some of them for us while we
+            # where waiting for the locks. Try to load them again.
+            self.refresh(cleanup=False)
+            to_compile = []
+            for module_hash, entries in sorted(missing.iteritems()):
+                for idx, key, lnk in entries:
+                    module = self._get_from_key(key)
+                    if module is None:
+                        # We hold the lock of module_hash.
+                        module = self._get_from_hash(module_hash, key)
+                    modules[idx] = module
+                if modules[entries[0][0]] is None:
+                    to_compile.append(module_hash)
+
+            results = _compile_many(
+                [(self.dirname, missing[module_hash][0][2])
+                 for module_hash in to_compile], n_workers)
+
+            error = None
+            for module_hash, (module, exc_info) in zip(to_compile, results):
+                if exc_info is not None:
+                    if error is None:
+                        error = exc_info
+                    continue
+                entries = missing[module_hash]
+                idx, key, lnk = entries[0]
+                hash_key = hash(key)
+                name = module.__file__
+                with self._lock:
+                    assert name not in self.module_from_name
+                    self.module_from_name[name] = module
+                    # Changing the hash of the key is not allowed during
+                    # compilation.
+                    assert hash(key) == hash_key
+
+                    key_data = self._add_to_cache(module, key, module_hash)
+                    self.module_hash_to_key_data[module_hash] = key_data
+                    self.stats[2] += 1
+                modules[idx] = module
+                # Other keys that gave the same source code.
+                for idx, key, lnk in entries[1:]:
+                    modules[idx] = (self._get_from_key(key) or
+                                    self._get_from_hash(module_hash, key))
+            if error is not None:
+                raise error[0], error[1], error[2]
+        finally:
+            while entered:
+                entered.pop().__exit__(None, None, None)
+        return modules
 
     def check_key(self, key, key_pkl):
         """
@@ -1165,13 +1761,29 @@ class ModuleCache(object):
         else:
             age_thresh_use = None
 
-        with compilelock.lock_ctx():
+        with self._lock_all():
             # Update the age of modules that have been accessed by other
             # processes and get all module that are too old to use
             # (not loaded in self.entry_from_key).
             too_old_to_use = self.refresh(
                     age_thresh_use=age_thresh_use,
                     delete_if_problem=delete_if_problem)
+            if age_thresh_use is None:
+                age_thresh_use = self.age_thresh_use
+            # The modules of the index whose key.pkl was not loaded.
+            time_now = time.time()
+            for module_hash, index_entry in self._index.items():
+                if module_hash in self.module_hash_to_key_data:
+                    continue
+                entry = os.path.join(self.dirname, index_entry[0],
+                                     index_entry[1])
+                try:
+                    age = time_now - last_access_time(entry)
+                except OSError:
+                    continue
+                if age >= age_thresh_use:
+                    too_old_to_use.append(entry)
+                    self._unregister_index_entry(module_hash)
 
             for entry in too_old_to_use:
                 # TODO: we are assuming that modules that haven't been
@@ -1184,6 +1796,21 @@ class ModuleCache(object):
                 _rmtree(parent, msg='old cache directory', level=logging.INFO,
                         ignore_nocleanup=True)
 
+            # Combined libraries that were not used recently.
+            base_dir = os.path.join(self.dirname, self.combined_dirname)
+            if os.path.isdir(base_dir):
+                for name in os.listdir(base_dir):
+                    lib = os.path.join(base_dir, name,
+                                       'combined.%s' % get_lib_extension())
+                    try:
+                        age = time_now - last_access_time(lib)
+                    except OSError:
+                        continue
+                    if age > age_thresh_del:
+                        _rmtree(os.path.join(base_dir, name),
+                                msg='old combined library',
+                                level=logging.INFO, ignore_nocleanup=True)
+
     def clear(self, unversioned_min_age=None, clear_base_files=False,
               delete_if_problem=False):
         """
@@ -1194,8 +1821,9 @@ class ModuleCache(object):
         cached modules regardless of their age.
 
         :param clear_base_files: If True, then delete base directories
-        'cuda_ndarray', 'cutils_ext', 'lazylinker_ext' and 'scan_perform'
-        if they are present.
+        'cuda_ndarray', 'cutils_ext', 'lazylinker_ext', 'graph_ext',
+        'scan_perform', 'scan_loop', 'precompiled_headers' and 'combined' if
+        they are present.
         If False, those directories are left intact.
 
         :param delete_if_problem: See help of refresh() method.
@@ -1210,8 +1838,9 @@ class ModuleCache(object):
 
     def clear_base_files(self):
         """
-        Remove base directories 'cuda_ndarray', 'cutils_ext', 'lazylinker_ext'
-        and 'scan_perform' if present.
+        Remove base directories 'cuda_ndarray', 'cutils_ext', 'lazylinker_ext',
+        'graph_ext', 'scan_perform', 'scan_loop', 'precompiled_headers' and
+        'combined' if present.
 
         Note that we do not delete them outright because it may not work on
         some systems due to these modules being currently in use. Instead we
@@ -1220,7 +1849,9 @@ class ModuleCache(object):
         """
         with compilelock.lock_ctx():
             for base_dir in ('cuda_ndarray', 'cutils_ext', 'lazylinker_ext',
-                             'scan_perform'):
+                             'graph_ext', 'scan_perform', 'scan_loop',
+                             'precompiled_headers',
+                             self.combined_dirname):
                 to_delete = os.path.join(self.dirname, base_dir + '.delete.me')
                 if os.path.isdir(to_delete):
                     try:
@@ -1250,7 +1881,7 @@ class ModuleCache(object):
         if min_age is None:
             min_age = self.age_thresh_del_unversioned
 
-        with compilelock.lock_ctx():
+        with self._lock_all():
             all_key_datas = self.module_hash_to_key_data.values()
             for key_data in all_key_datas:
                 if not key_data.keys:
@@ -1326,14 +1957,87 @@ class ModuleCache(object):
                                     ignore_nocleanup=True)
 
     def _on_atexit(self):
-        # Note: no need to call refresh() since it is called by clear_old().
-        with compilelock.lock_ctx():
-            self.clear_old()
-            self.clear_unversioned()
+        if self._index_pending:
+            self._update_index({}, [])
+        # If another process is cleaning up the cache, do not wait for it:
+        # this cleanup can be done by the next process that exits.
+        if compilelock.get_lock(blocking=False):
+            try:
+                # Note: no need to call refresh() since it is called by
+                # clear_old().
+                self.clear_old()
+                self.clear_unversioned()
+            finally:
+                compilelock.release_lock()
         _logger.debug('Time spent checking keys: %s',
                       self.time_spent_in_check_key)
 
 
+@contextmanager
+def _null_ctx():
+    yield
+
+
+def _compile_one(dirname, lnk):
+    """
+    Compile the module of `lnk` in a new directory of `dirname`.
+
+    Return (module, None), or (None, exc_info) if the compilation failed.
+    """
+    location = None
+    try:
+        location = dlimport_workdir(dirname)
+        module = lnk.compile_cmodule(location)
+        assert module.__file__.startswith(location)
+        return module, None
+    except Exception, e:
+        if isinstance(e, OSError):
+            _logger.error(e)
+            if e.errno == 31:
+                _logger.error('There are %i files in %s',
+                              len(os.listdir(config.compiledir)),
+                              config.compiledir)
+        if location is not None:
+            _rmtree(location, ignore_if_missing=True,
+                    msg='exception during compilation')
+        return None, sys.exc_info()
+
+
+def _compile_many(jobs, n_workers):
+    """
+    Call `_compile_one` on each (dirname, lnk) of `jobs`, running at most
+    `n_workers` compilations at the same time.
+
+    The compilations run in threads: the time is spent in the compiler
+    processes, which do not hold the GIL.
+
+    Return the list of the results of `_compile_one`.
+    """
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [_compile_one(*job) for job in jobs]
+    results = [None] * len(jobs)
+    remaining = list(enumerate(jobs))
+    remaining.reverse()
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with remaining_lock:
+                if not remaining:
+                    return
+                idx, job = remaining.pop()
+            results[idx] = _compile_one(*job)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(n_workers, len(jobs)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
 def _rmtree(parent, ignore_nocleanup=False, msg='', level=logging.DEBUG,
             ignore_if_missing=False):
     # On NFS filesystems, it is impossible to delete a directory with open
@@ -1912,54 +2616,75 @@ class GCC_compiler(object):
                                     (module_name, get_lib_extension()))
 
         _logger.debug('Generating shared lib %s', lib_filename)
-        cmd = [theano.config.cxx, get_gcc_shared_library_arg(), '-g']
-
         if config.cmodule.remove_gxx_opt:
-            cmd.extend(p for p in preargs if not p.startswith('-O'))
+            preargs = [p for p in preargs if not p.startswith('-O')]
+        compile_args = list(preargs)
+        header = get_precompiled_header(src_code, preargs, include_dirs)
+        if header is not None:
+            compile_args.extend(['-include', header])
+        compile_args.extend('-I%s' % idir for idir in include_dirs)
+        link_args = ['-L%s' % ldir for ldir in lib_dirs]
+        link_args.extend(['-l%s' % l for l in libs])
+
+        combine = (config.cmodule.combine_modules and py_module and
+                   hasattr(os, 'symlink'))
+        if combine:
+            # Keep the object file, to link it with the ones of other
+            # modules (see ModuleCache.load_combined).
+            obj_filename = os.path.join(location, 'mod.o')
+            link_preargs = combined_link_preargs(preargs)
+            cmds = [[theano.config.cxx, '-c', '-g'] + compile_args +
+                    ['-o', obj_filename, cppfilename],
+                    [theano.config.cxx, get_gcc_shared_library_arg(),
+                     '-g'] + link_preargs +
+                    ['-o', lib_filename, obj_filename] + link_args]
         else:
-            cmd.extend(preargs)
-        cmd.extend('-I%s' % idir for idir in include_dirs)
-        cmd.extend(['-o', lib_filename])
-        cmd.append(cppfilename)
-        cmd.extend(['-L%s' % ldir for ldir in lib_dirs])
-        cmd.extend(['-l%s' % l for l in libs])
-        #print >> sys.stderr, 'COMPILING W CMD', cmd
-        _logger.debug('Running cmd: %s', ' '.join(cmd))
+            cmds = [[theano.config.cxx, get_gcc_shared_library_arg(),
+                     '-g'] + compile_args +
+                    ['-o', lib_filename, cppfilename] + link_args]
 
-        def print_command_line_error():
-            # Print command line when a problem occurred.
-            print >> sys.stderr, (
-                    "Problem occurred during compilation with the "
-                    "command line below:")
-            print >> sys.stderr, ' '.join(cmd)
+        for cmd in cmds:
+            #print >> sys.stderr, 'COMPILING W CMD', cmd
+            _logger.debug('Running cmd: %s', ' '.join(cmd))
 
-        try:
-            p_out = output_subprocess_Popen(cmd)
-            compile_stderr = decode(p_out[1])
-        except Exception:
-            # An exception can occur e.g. if `g++` is not found.
-            print_command_line_error()
-            raise
+            def print_command_line_error():
+                # Print command line when a problem occurred.
+                print >> sys.stderr, (
+                        "Problem occurred during compilation with the "
+                        "command line below:")
+                print >> sys.stderr, ' '.join(cmd)
 
-        status = p_out[2]
+            try:
+                p_out = output_subprocess_Popen(cmd)
+                compile_stderr = decode(p_out[1])
+            except Exception:
+                # An exception can occur e.g. if `g++` is not found.
+                print_command_line_error()
+                raise
 
-        if status:
-            print '==============================='
-            for i, l in enumerate(src_code.split('\n')):
-                #gcc put its messages to stderr, so we add ours now
-                print >> sys.stderr, '%05i\t%s' % (i + 1, l)
-            print '==============================='
-            print_command_line_error()
-            # Print errors just below the command line.
-            print compile_stderr
-            # We replace '\n' by '. ' in the error message because when Python
-            # prints the exception, having '\n' in the text makes it more
-            # difficult to read.
-            raise Exception('Compilation failed (return status=%s): %s' %
-                            (status, compile_stderr.replace('\n', '. ')))
-        elif config.cmodule.compilation_warning and compile_stderr:
-            # Print errors just below the command line.
-            print compile_stderr
+            status = p_out[2]
+
+            if status:
+                print '==============================='
+                for i, l in enumerate(src_code.split('\n')):
+                    #gcc put its messages to stderr, so we add ours now
+                    print >> sys.stderr, '%05i\t%s' % (i + 1, l)
+                print '==============================='
+                print_command_line_error()
+                # Print errors just below the command line.
+                print compile_stderr
+                # We replace '\n' by '. ' in the error message because when
+                # Python prints the exception, having '\n' in the text makes
+                # it more difficult to read.
+                raise Exception('Compilation failed (return status=%s): %s' %
+                                (status, compile_stderr.replace('\n', '. ')))
+            elif config.cmodule.compilation_warning and compile_stderr:
+                # Print errors just below the command line.
+                print compile_stderr
+
+        if combine:
+            prepare_combined_object(obj_filename, module_name,
+                                    link_preargs, link_args)
 
         if py_module:
             #touch the __init__ file
@@ -1968,5 +2693,206 @@ class GCC_compiler(object):
             return dlimport(lib_filename)
 
 
+def combined_link_preargs(preargs):
+    """
+    Return the compiler arguments of `preargs` that are needed to link
+    object files into a shared library.
+    """
+    return [p for p in preargs
+            if p.startswith('-f') or p.startswith('-m') or
+            p.startswith('-Wl,') or p == '-pthread']
+
+
+def prepare_combined_object(obj_filename, module_name, link_preargs,
+                            link_args):
+    """
+    Prepare the object file of a module to be linked with other modules in
+    a single shared library (see `ModuleCache.load_combined`).
+
+    All its symbols but the initialization function of the Python module
+    are made local with objcopy, so that the support code of different
+    modules can not conflict. Its COMDAT groups (inline functions and
+    templates) are removed too, so that the linker keeps the code of each
+    module instead of discarding the code of the local symbols. The
+    arguments needed to link it are saved in 'mod.link' next to it. If
+    objcopy fails, the object file is removed and the module will not be
+    combined.
+    """
+    if PY3:
+        init_name = 'PyInit_' + module_name
+    else:
+        init_name = 'init' + module_name
+    try:
+        p_out = output_subprocess_Popen(
+            ['objcopy', '--remove-section=.group',
+             '--keep-global-symbol=' + init_name, obj_filename])
+        status = p_out[2]
+        err = decode(p_out[1])
+    except OSError, e:
+        status, err = -1, str(e)
+    if status:
+        _logger.info('Could not localize the symbols of %s: %s',
+                     obj_filename, err)
+        os.remove(obj_filename)
+        return
+    with open(os.path.join(os.path.dirname(obj_filename), 'mod.link'),
+              'wb') as f:
+        cPickle.dump((link_preargs, link_args), f,
+                     protocol=cPickle.HIGHEST_PROTOCOL)
+
+
+def link_combined(entries, location):
+    """
+    Link the object files of the modules `entries` into the shared library
+    `location`/combined.so.
+
+    `location` also gets a symbolic link to that library for each module,
+    with the name of the module file, so that each module can be imported
+    from it. It is created atomically, by renaming a temporary directory.
+
+    Return False if some module has no object file (see
+    `prepare_combined_object`) or if the link failed.
+    """
+    objects = []
+    preargs = []
+    link_args = []
+    for entry in entries:
+        root = os.path.dirname(entry)
+        obj_filename = os.path.join(root, 'mod.o')
+        try:
+            with open(os.path.join(root, 'mod.link'), 'rb') as f:
+                mod_preargs, mod_link_args = cPickle.load(f)
+        except (IOError, OSError, EOFError):
+            _logger.debug('Module %s can not be combined', entry)
+            return False
+        if not os.path.exists(obj_filename):
+            return False
+        objects.append(obj_filename)
+        for arg in mod_preargs:
+            if arg not in preargs:
+                preargs.append(arg)
+        for arg in mod_link_args:
+            if arg not in link_args:
+                link_args.append(arg)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(location))
+    try:
+        lib_name = 'combined.%s' % get_lib_extension()
+        cmd = ([theano.config.cxx, get_gcc_shared_library_arg(), '-g'] +
+               preargs + ['-o', os.path.join(tmp_dir, lib_name)] +
+               objects + link_args)
+        _logger.debug('Running cmd: %s', ' '.join(cmd))
+        p_out = output_subprocess_Popen(cmd)
+        if p_out[2]:
+            _logger.warning('Could not link the modules %s together: %s',
+                            entries, decode(p_out[1]))
+            return False
+        open(os.path.join(tmp_dir, '__init__.py'), 'w').close()
+        for entry in entries:
+            os.symlink(lib_name,
+                       os.path.join(tmp_dir, os.path.basename(entry)))
+        os.rename(tmp_dir, location)
+        tmp_dir = None
+        return True
+    finally:
+        if tmp_dir is not None:
+            _rmtree(tmp_dir, ignore_if_missing=True)
+
+
+# Serialize the creation of the precompiled headers by the threads of
+# this process (the other processes are excluded by a directory lock).
+_precompiled_header_lock = threading.Lock()
+
+_include_re = re.compile(r'#include\s*<[^>]+>$')
+
+
+def get_precompiled_header(src_code, preargs, include_dirs):
+    """
+    Return the path of a header to pass to g++ with `-include` to use a
+    precompiled version of the system headers included at the beginning of
+    `src_code`, or None.
+
+    The headers included before any other line (that is, most of the time,
+    Python.h, numpy and the C++ standard library) are the same for most
+    modules, but g++ parses them again for every module, which is often
+    more than half of the compilation time of a small module. They are put
+    in a header that is precompiled in the `precompiled_headers` directory
+    of the compiledir, for each set of compilation flags. As g++ ignores an
+    invalid precompiled header, and the headers are include-guarded, the
+    result of the compilation does not change.
+
+    The precompiled header is created the first time it is needed. If it
+    is being created by another process or thread, None is returned
+    instead of waiting.
+    """
+    if not config.cmodule.precompiled_headers or gcc_llvm():
+        return None
+    headers = []
+    for line in src_code.splitlines():
+        line = line.strip()
+        if not _include_re.match(line):
+            break
+        headers.append(line)
+    if len(headers) < 2:
+        return None
+    key = hash_from_code('\n'.join(
+        [theano.config.cxx, gcc_version_str] + list(preargs) +
+        ['-I%s' % idir for idir in include_dirs] + headers))
+    base_dir = os.path.join(config.compiledir, 'precompiled_headers')
+    location = os.path.join(base_dir, key)
+    header = os.path.join(location, 'theano_pch.h')
+    if os.path.exists(header + '.gch'):
+        return header
+    if os.path.exists(os.path.join(location, 'failed')):
+        return None
+    if not _precompiled_header_lock.acquire(False):
+        return None
+    try:
+        lock_dir = os.path.join(base_dir, key + '.lock')
+        if not compilelock.lock(lock_dir, blocking=False):
+            return None
+        try:
+            return _compile_precompiled_header(location, header, headers,
+                                               preargs, include_dirs)
+        finally:
+            compilelock.remove_lock(lock_dir)
+    finally:
+        _precompiled_header_lock.release()
+
+
+def _compile_precompiled_header(location, header, headers, preargs,
+                                include_dirs):
+    if os.path.exists(header + '.gch'):
+        # Created by another process while we were getting the lock.
+        return header
+    if os.path.exists(os.path.join(location, 'failed')):
+        return None
+    if not os.path.isdir(location):
+        os.makedirs(location)
+    with open(header, 'w') as f:
+        f.write('\n'.join(headers) + '\n')
+    # g++ uses `header`.gch only when it is complete.
+    tmp_gch = os.path.join(location, 'tmp.gch')
+    cmd = [theano.config.cxx, '-g', '-x', 'c++-header']
+    cmd.extend(preargs)
+    cmd.extend('-I%s' % idir for idir in include_dirs)
+    cmd.extend(['-o', tmp_gch, header])
+    _logger.debug('Precompiling headers: %s', ' '.join(cmd))
+    try:
+        p_out = output_subprocess_Popen(cmd)
+        status = p_out[2]
+        compile_stderr = decode(p_out[1])
+    except OSError, e:
+        status, compile_stderr = -1, str(e)
+    if status:
+        # Do not try again: the modules are compiled without it.
+        _logger.info('Could not precompile the headers %s: %s',
+                     header, compile_stderr)
+        with open(os.path.join(location, 'failed'), 'w') as f:
+            f.write(compile_stderr)
+        return None
+    os.rename(tmp_gch, header + '.gch')
+    return header
+
+
 def icc_module_compile_str(*args):
     raise NotImplementedError()
@@ -5,6 +5,7 @@ import atexit
 import os
 import random
 import socket  # only used for gethostname()
+import threading
 import time
 import logging
 
@@ -40,6 +41,11 @@ period for running processes.""",
 
 hostname = socket.gethostname()
 
+# Total time spent waiting for locks held by other processes, and number of
+# lock acquisitions that had to wait. They are used by the profiler.
+lock_wait_time = 0
+lock_wait_count = 0
+
 
 def force_unlock():
     """
@@ -57,6 +63,32 @@ def lock_ctx(lock_dir=None, keep_lock=False, **kw):
         release_lock()
 
 
+@contextmanager
+def dir_lock_ctx(lock_dir, **kw):
+    """
+    Lock `lock_dir`, independently of the lock on the compilation directory
+    managed by `get_lock` and `release_lock`.
+
+    This is used to lock a single module of the cache, so that processes
+    compiling different modules do not wait for each other. It is not
+    re-entrant.
+
+    :param kw: Additional arguments to be forwarded to the `lock` function.
+    """
+    lock(lock_dir, **kw)
+    try:
+        yield
+    finally:
+        remove_lock(lock_dir)
+
+
+# The lock on the compilation directory is held by a process, and
+# `get_lock.n_lock` counts the requests made while it is held. This makes
+# the threads of the process take it in turn, so that a thread compiling in
+# the background does not share the lock of another thread.
+_thread_lock = threading.RLock()
+
+
 def get_lock(lock_dir=None, **kw):
     """
     Obtain lock on compilation directory.
@@ -64,8 +96,25 @@ def get_lock(lock_dir=None, **kw):
     :param kw: Additional arguments to be forwarded to the `lock` function when
     acquiring the lock.
 
+    :returns: False if `blocking` is False in `kw` and another process (or
+    another thread of this process) owns the lock (in which case
+    `release_lock` must not be called), else True.
+
     :note: We can lock only on 1 directory at a time.
     """
+    if not _thread_lock.acquire(kw.get('blocking', True)):
+        return False
+    try:
+        got_lock = _get_lock(lock_dir, **kw)
+    except Exception:
+        _thread_lock.release()
+        raise
+    if not got_lock:
+        _thread_lock.release()
+    return got_lock
+
+
+def _get_lock(lock_dir=None, **kw):
     if lock_dir is None:
         lock_dir = os.path.join(config.compiledir, 'lock_dir')
     if not hasattr(get_lock, 'n_lock'):
@@ -88,7 +137,8 @@ def get_lock(lock_dir=None, **kw):
     if get_lock.lock_is_enabled:
         # Only really try to acquire the lock if we do not have it already.
         if get_lock.n_lock == 0:
-            lock(get_lock.lock_dir, **kw)
+            if not lock(get_lock.lock_dir, **kw):
+                return False
             atexit.register(Unlocker.unlock, get_lock.unlocker)
             # Store time at which the lock was set.
             get_lock.start_time = time.time()
@@ -111,6 +161,7 @@ def get_lock(lock_dir=None, **kw):
                 refresh_lock(lockpath)
                 get_lock.start_time = now
     get_lock.n_lock += 1
+    return True
 
 
 def release_lock():
@@ -123,6 +174,7 @@ def release_lock():
     if get_lock.lock_is_enabled and get_lock.n_lock == 0:
         get_lock.start_time = None
         get_lock.unlocker.unlock()
+    _thread_lock.release()
 
 
 def set_lock_status(use_lock):
@@ -140,7 +192,8 @@ def set_lock_status(use_lock):
 notset = object()
 
 
-def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
+def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1,
+         blocking=True):
     """
     Obtain lock access by creating a given temporary directory (whose base will
     be created if needed, but will not be deleted after the lock is removed).
@@ -153,7 +206,9 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
     a random string).
 
     When there is already a lock, the process sleeps for a random amount of
-    time between min_wait and max_wait seconds before trying again.
+    time between min_wait and max_wait seconds before trying again. The first
+    retries are done sooner (the waiting time doubles at each retry), as
+    most locks are only held for a short time.
 
     If 'verbosity' is >= 1, then a message will be displayed when we need to
     wait for the lock. If it is set to a value >1, then this message will be
@@ -176,6 +231,13 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
                          (default 2 * min_wait)
 
     :param int verbosity: amount of feedback displayed to screen (default 1)
+
+    :param bool blocking: if False, return False instead of waiting when
+                          the lock is owned by another (live) process
+
+    :returns: True when the lock was obtained
+
+    The time spent waiting is added to `lock_wait_time`.
     """
     if min_wait is None:
         min_wait = config.compile.wait
@@ -206,6 +268,7 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
     # Used to don't display it the first time to display it less frequently.
     # And so don't get as much email about this!
     nb_wait = 0
+    wait_start = time.time()
     # Acquire lock.
     while True:
         try:
@@ -238,7 +301,7 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
                         msg = "process '%s'" % read_owner.split('_')[0]
                         _logger.warning("Overriding existing lock by dead %s "
                                         "(I am process '%s')", msg, my_pid)
-                    get_lock.unlocker.unlock()
+                    remove_lock(tmp_dir)
                     continue
                 if last_owner == read_owner:
                     if (timeout is not None and
@@ -251,7 +314,7 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
                                 msg = "process '%s'" % read_owner.split('_')[0]
                             _logger.warning("Overriding existing lock by %s "
                                             "(I am process '%s')", msg, my_pid)
-                        get_lock.unlocker.unlock()
+                        remove_lock(tmp_dir)
                         continue
                 else:
                     last_owner = read_owner
@@ -268,8 +331,12 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
                                  tmp_dir)
                     if verbosity <= 1:
                         no_display = True
+                if not blocking:
+                    return False
+                # Exponential backoff, up to [min_wait, max_wait].
+                backoff = min(1., 0.05 * 2 ** nb_wait)
                 nb_wait += 1
-                time.sleep(random.uniform(min_wait, max_wait))
+                time.sleep(random.uniform(min_wait, max_wait) * backoff)
 
             try:
                 os.mkdir(tmp_dir)
@@ -297,7 +364,9 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
                 continue
             else:
                 # We got the lock, hoorray!
-                return
+                if nb_wait > 0:
+                    _record_wait(tmp_dir, time.time() - wait_start)
+                return True
 
         except Exception, e:
             # If something wrong happened, we try again.
@@ -309,6 +378,13 @@ def lock(tmp_dir, timeout=notset, min_wait=None, max_wait=None, verbosity=1):
             continue
 
 
+def _record_wait(tmp_dir, wait_time):
+    global lock_wait_time, lock_wait_count
+    lock_wait_time += wait_time
+    lock_wait_count += 1
+    _logger.debug('Waited %.3fs for lock %s', wait_time, tmp_dir)
+
+
 def refresh_lock(lock_file):
     """
     'Refresh' an existing lock by re-writing the file containing the owner's
@@ -335,6 +411,23 @@ def refresh_lock(lock_file):
     return unique_id
 
 
+def remove_lock(tmp_dir):
+    """
+    Remove the lock `tmp_dir`, whoever owns it.
+
+    See `Unlocker.unlock`: this does not crash if the lock can not be
+    deleted.
+    """
+    try:
+        os.remove(os.path.join(tmp_dir, 'lock'))
+    except Exception:
+        pass
+    try:
+        os.rmdir(tmp_dir)
+    except Exception:
+        pass
+
+
 class Unlocker(object):
     """
     Class wrapper around release mechanism so that the lock is automatically
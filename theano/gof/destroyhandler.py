@@ -182,6 +182,156 @@ def _contains_cycle(fgraph, orderings):
     return visited != len(parent_counts)
 
 
+class IncrementalToposort(object):
+    """
+    Topological order of a graph of Apply nodes, maintained as edges are
+    added and removed.
+
+    This is the dynamic topological sort of Pearce and Kelly: every node
+    has an integer position `ord[node]` such that `ord[u] < ord[v]` for
+    every edge u -> v. Adding an edge that already respects the order is
+    O(1). Otherwise, only the nodes whose position lies between the two
+    ends of the new edge and that are connected to them are visited and
+    moved, and a cycle is detected if the search from the destination of
+    the edge reaches its source.
+
+    The edges are counted, so the same dependency can be added several
+    times (e.g. an Apply using the same variable twice) and must be removed
+    as many times.
+
+    An edge that would close a cycle is not put in the order but kept in
+    `self.pending`. Those edges are added again by `has_cycle`, as the
+    cycle may have been broken by the removal of other edges since.
+    """
+
+    def __init__(self):
+        # node -> position in the topological order
+        self.ord = {}
+        # node -> {successor: number of edges}
+        self.succ = {}
+        # node -> {predecessor: number of edges}
+        self.pred = {}
+        # (u, v) -> number of edges u -> v not in the order
+        self.pending = {}
+        self.next_ord = 0
+
+    def add_node(self, node):
+        """Add `node` without any edge, after all the other nodes."""
+        self.ord[node] = self.next_ord
+        self.next_ord += 1
+        self.succ[node] = {}
+        self.pred[node] = {}
+
+    def remove_node(self, node):
+        """Remove `node` and all the edges to and from it."""
+        for v in self.succ.pop(node):
+            del self.pred[v][node]
+        for u in self.pred.pop(node):
+            del self.succ[u][node]
+        if self.pending:
+            for edge in self.pending.keys():
+                if node in edge:
+                    del self.pending[edge]
+        del self.ord[node]
+
+    def add_edge(self, u, v):
+        """Add the edge u -> v.
+
+        Return False if it closes a cycle (the edge is then kept pending),
+        True otherwise.
+        """
+        if (u, v) in self.pending:
+            self.pending[(u, v)] += 1
+            return False
+        succ_u = self.succ[u]
+        if v in succ_u:
+            succ_u[v] += 1
+            self.pred[v][u] += 1
+            return True
+        if not self._insert(u, v):
+            self.pending[(u, v)] = 1
+            return False
+        succ_u[v] = 1
+        self.pred[v][u] = 1
+        return True
+
+    def remove_edge(self, u, v):
+        """Remove one edge u -> v."""
+        edge = (u, v)
+        if edge in self.pending:
+            self.pending[edge] -= 1
+            if not self.pending[edge]:
+                del self.pending[edge]
+            return
+        succ_u = self.succ[u]
+        succ_u[v] -= 1
+        if succ_u[v]:
+            self.pred[v][u] -= 1
+        else:
+            del succ_u[v]
+            del self.pred[v][u]
+
+    def has_cycle(self):
+        """Return True if the graph contains a cycle."""
+        for edge, count in self.pending.items():
+            u, v = edge
+            if self._insert(u, v):
+                del self.pending[edge]
+                self.succ[u][v] = count
+                self.pred[v][u] = count
+        return bool(self.pending)
+
+    def _insert(self, u, v):
+        """Reorder the nodes so that u -> v can be added.
+
+        Return False if there is already a path from v to u.
+        """
+        ord = self.ord
+        lb = ord[v]
+        ub = ord[u]
+        if ub < lb:
+            return True
+        if u is v:
+            return False
+
+        # Nodes reachable from v that are before u in the order.
+        # If u is one of them, u -> v closes a cycle.
+        delta_f = [v]
+        seen = set(delta_f)
+        stack = [v]
+        while stack:
+            for w in self.succ[stack.pop()]:
+                if w is u:
+                    return False
+                if w not in seen and ord[w] < ub:
+                    seen.add(w)
+                    delta_f.append(w)
+                    stack.append(w)
+
+        # Nodes that reach u and are after v in the order.
+        delta_b = [u]
+        seen = set(delta_b)
+        stack = [u]
+        while stack:
+            for w in self.pred[stack.pop()]:
+                if w not in seen and lb < ord[w]:
+                    seen.add(w)
+                    delta_b.append(w)
+                    stack.append(w)
+
+        # Give the positions of the visited nodes to the ancestors of u
+        # first, then to the descendants of v, keeping the relative order
+        # within each group.
+        key = ord.__getitem__
+        delta_b.sort(key=key)
+        delta_f.sort(key=key)
+        nodes = delta_b + delta_f
+        positions = sorted(map(key, nodes))
+        for node, pos in zip(nodes, positions):
+            ord[node] = pos
+        return True
+
+
 def getroot(r, view_i):
     """
     TODO: what is view_i ? based on add_impact's docstring, IG is guessing
@@ -657,7 +807,11 @@ class DestroyHandler(toolbox.Bookkeeper):
 
     It is a work in progress. The following data structures have been
     converted to use the incremental strategy:
-        <none>
+        toposort: the topological order of the Apply nodes, including the
+            orderings imposed by the destroyers, used to detect cycles in
+            validate(). It is built the first time validate() is called
+            with destroyers in the graph, and then kept up to date by
+            on_import, on_prune, on_change_input and validate.
 
     The following data structures remain to be converted:
         <unknown>
@@ -731,6 +885,13 @@ class DestroyHandler(toolbox.Bookkeeper):
         #clients: how many times does an apply use a given variable
         self.clients = OrderedDict() # variable -> apply -> ninputs
         self.stale_droot = True
+        # IncrementalToposort, None until the first validation with
+        # destroyers in the graph.
+        self.toposort = None
+        # set of (prerequisite, destroyer) pairs returned by orderings()
+        # at the last validation, and the Apply nodes they contain.
+        self.ordering_edges = set()
+        self.ordering_nodes = set()
 
         self.debug_all_apps = OrderedSet()
         if self.do_imports_on_attach:
@@ -787,6 +948,9 @@ class DestroyHandler(toolbox.Bookkeeper):
         del self.view_o
         del self.clients
         del self.stale_droot
+        del self.toposort
+        del self.ordering_edges
+        del self.ordering_nodes
         assert self.fgraph.destroyer_handler is self
         delattr(self.fgraph, 'destroyers')
         delattr(self.fgraph, 'destroy_handler')
@@ -824,6 +988,21 @@ class DestroyHandler(toolbox.Bookkeeper):
         for i, output in enumerate(app.outputs):
             self.clients.setdefault(output, OrderedDict())
 
+        if self.toposort is not None:
+            toposort = self.toposort
+            toposort.add_node(app)
+            for input in app.inputs:
+                owner = input.owner
+                if owner is not None and owner in toposort.ord:
+                    toposort.add_edge(owner, app)
+            # Clients imported before app (this happens when app is
+            # imported by a change_input).
+            for output in app.outputs:
+                for client, n in self.clients[output].items():
+                    if client is not app:
+                        for k in xrange(n):
+                            toposort.add_edge(app, client)
+
         self.stale_droot = True
 
     def on_prune(self, fgraph, app, reason):
@@ -858,6 +1037,13 @@ class DestroyHandler(toolbox.Bookkeeper):
             if not self.view_o[i]:
                 del self.view_o[i]
 
+        if self.toposort is not None:
+            self.toposort.remove_node(app)
+            if app in self.ordering_nodes:
+                self.ordering_edges = set(
+                    e for e in self.ordering_edges if app not in e)
+                self.ordering_nodes.remove(app)
+
         self.stale_droot = True
 
     def on_change_input(self, fgraph, app, i, old_r, new_r, reason):
@@ -898,6 +1084,13 @@ class DestroyHandler(toolbox.Bookkeeper):
 
                     self.view_o.setdefault(new_r, OrderedSet()).add(output)
 
+            if self.toposort is not None:
+                toposort = self.toposort
+                if old_r.owner is not None and old_r.owner in toposort.ord:
+                    toposort.remove_edge(old_r.owner, app)
+                if new_r.owner is not None and new_r.owner in toposort.ord:
+                    toposort.add_edge(new_r.owner, app)
+
         self.stale_droot = True
 
     def validate(self, fgraph):
@@ -912,9 +1105,14 @@ class DestroyHandler(toolbox.Bookkeeper):
         if self.destroyers:
             ords = self.orderings(fgraph)
 
-            if _contains_cycle(fgraph, ords):
+            if self.toposort is None:
+                self.build_toposort()
+            self.update_ordering_edges(ords)
+            if self.toposort.has_cycle():
                 raise InconsistencyError("Dependency graph contains cycles")
         else:
+            if self.ordering_edges:
+                self.update_ordering_edges({})
             #James's Conjecture:
             #If there are no destructive ops, then there can be no cycles.
 
@@ -928,6 +1126,51 @@ class DestroyHandler(toolbox.Bookkeeper):
             pass
         return True
 
+    def build_toposort(self):
+        """Build self.toposort from the Apply nodes imported so far."""
+        apps = self.debug_all_apps
+        try:
+            order = graph.io_toposort(self.fgraph.inputs, self.fgraph.outputs)
+        except ValueError:
+            # The graph contains a cycle.
+            order = apps
+        toposort = IncrementalToposort()
+        for app in order:
+            if app in apps:
+                toposort.add_node(app)
+        for app in apps:
+            if app not in toposort.ord:
+                toposort.add_node(app)
+        for app in apps:
+            for input in app.inputs:
+                owner = input.owner
+                if owner is not None and owner in toposort.ord:
+                    toposort.add_edge(owner, app)
+        self.toposort = toposort
+        self.ordering_edges = set()
+        self.ordering_nodes = set()
+
+    def update_ordering_edges(self, ords):
+        """Replace the orderings edges of self.toposort by those of `ords`.
+
+        Only the edges that changed since the last call are removed from or
+        added to the order.
+        """
+        edges = set()
+        nodes = set()
+        for app, prereqs in ords.iteritems():
+            nodes.add(app)
+            for prereq in prereqs:
+                edges.add((prereq, app))
+                nodes.add(prereq)
+        toposort = self.toposort
+        for u, v in self.ordering_edges - edges:
+            toposort.remove_edge(u, v)
+        for u, v in edges - self.ordering_edges:
+            toposort.add_edge(u, v)
+        self.ordering_edges = edges
+        self.ordering_nodes = nodes
+
     def orderings(self, fgraph):
         """Return orderings induced by destructive operations.
 
@@ -173,7 +173,6 @@ class FunctionGraph(utils.object2):
                             " the values must be tuples or lists." % (
                                 str(node.op), str(node.op.destroy_map)))
         node.fgraph = self
-        node.deps = {}
         #self.execute_callbacks('on_setup_node', node)
 
     def disown(self):
@@ -189,7 +188,6 @@ class FunctionGraph(utils.object2):
         """
         for apply_node in self.apply_nodes:
             del apply_node.fgraph
-            del apply_node.deps
         for variable in self.variables:
             del variable.fgraph
             del variable.clients
@@ -208,20 +206,23 @@ class FunctionGraph(utils.object2):
         """
         return r.clients
 
-    def __add_clients__(self, r, new_clients):
+    def __add_clients__(self, r, new_clients, check=True):
         """ WRITEME
         r -> variable
         new_clients -> list of (node, i) pairs such that node.inputs[i] is r.
+        check -> if False, new_clients are known not to be clients of r yet
+                 (e.g. their nodes are being imported), so this is not
+                 checked. The check is linear in the number of clients of r.
 
         Updates the list of clients of r with new_clients.
         """
-        if set(r.clients).intersection(set(new_clients)):
+        if check and any(entry in r.clients for entry in new_clients):
             print >> sys.stderr, 'ERROR: clients intersect!'
             print >> sys.stderr, '  RCLIENTS of', r, [(n, i, type(n), id(n))
                                                       for n, i in r.clients]
             print >> sys.stderr, '  NCLIENTS of', r, [(n, i, type(n), id(n))
                                                       for n, i in new_clients]
-        assert not set(r.clients).intersection(set(new_clients))
+            raise AssertionError('clients intersect')
         r.clients += new_clients
 
     def __remove_clients__(self, r, clients_to_remove,
@@ -256,7 +257,8 @@ class FunctionGraph(utils.object2):
             if apply_node not in self.apply_nodes:
                 self.__import__(apply_node, reason=reason)
         for r in variables:
-            if r.owner is None and not isinstance(r, graph.Constant) and r not in self.inputs:
+            if (r.owner is None and not isinstance(r, graph.Constant) and
+                    r not in self.variables and r not in self.inputs):
                 if isinstance(r.type, NullType):
                     raise TypeError("Computation graph contains a NaN. " +
                                     r.type.why_null)
@@ -283,6 +285,7 @@ class FunctionGraph(utils.object2):
                         raise Exception("%s is already owned by another fgraph" % r)
                     if (r.owner is None and
                         not isinstance(r, graph.Constant) and
+                        r not in self.variables and
                         r not in self.inputs):
 
                         #Verbose error message
@@ -372,7 +375,8 @@ class FunctionGraph(utils.object2):
                 if input not in self.variables:
                     self.__setup_r__(input)
                     self.variables.add(input)
-                self.__add_clients__(input, [(node, i)])
+                # node was not in the graph, so it is not a client yet.
+                self.__add_clients__(input, [(node, i)], check=False)
             assert node.fgraph is self
             self.execute_callbacks('on_import', node, reason)
 
@@ -23,6 +23,10 @@ from theano.misc.ordered_set import OrderedSet
 is_same_graph_with_merge = None
 equal_computations = None
 
+# C implementation of ancestors, general_toposort and io_toposort. It is
+# set when theano.gof.graph_c is imported, if it could be compiled.
+c_traversals = None
+
 NoContext = object()
 
 class Node(utils.object2):
@@ -575,6 +579,9 @@ def ancestors(variable_list, blockers=None):
         started at the nodes in `variable_list`.
 
     """
+    if c_traversals is not None:
+        return c_traversals.ancestors(variable_list, blockers)
+
     def expand(r):
         if r.owner and (not blockers or r not in blockers):
             return reversed(r.owner.inputs)
@@ -757,6 +764,11 @@ def general_toposort(r_out, deps, debug_print=False):
     :note:
         The order of the return value list is determined by the order of nodes returned by the deps() function.
     """
+    assert isinstance(r_out, (tuple, list, deque))
+    if c_traversals is not None and not debug_print:
+        return c_traversals.general_toposort(r_out, deps,
+                                             (list, OrderedSet))
+
     deps_cache = {}
 
     def _deps(io):
@@ -773,8 +785,6 @@ def general_toposort(r_out, deps, debug_print=False):
         else:
             return deps_cache[io]
 
-    assert isinstance(r_out, (tuple, list, deque))
-
     reachable, clients = stack_search(deque(r_out), _deps, 'dfs', True)
     sources = deque([r for r in reachable if not deps_cache.get(r, None)])
 
@@ -803,7 +813,8 @@ def general_toposort(r_out, deps, debug_print=False):
 def io_toposort(inputs, outputs, orderings=None):
     """WRITEME
 
-    inputs: a list or tuple of Variable instances
+    inputs: a list, tuple or set of Variable instances. A set is not
+            copied, so it must not change during the call.
     outputs: a list or tuple of Apply instances
 
     orderings: a dictionary
@@ -817,9 +828,15 @@ def io_toposort(inputs, outputs, orderings=None):
     """
     if orderings is None:
         orderings = {}
+    if c_traversals is not None:
+        return c_traversals.io_toposort(inputs, outputs, orderings,
+                                        Variable, Apply)
 
     #the inputs are used only here in the function that decides what 'predecessors' to explore
-    iset = set(inputs)
+    if isinstance(inputs, (set, frozenset)):
+        iset = inputs
+    else:
+        iset = set(inputs)
 
     def deps(obj):
         rval = []
@@ -0,0 +1,582 @@
+/*
+ * C implementation of the graph traversals of theano/gof/graph.py.
+ *
+ * The nodes of the graph (Variable and Apply instances, or any object for
+ * toposort) are numbered in the order they are found, with a hash table
+ * keyed on their address (they are hashed by id in graph.py too), and the
+ * topological sort works on integer arrays. The results are the same, in
+ * the same order, as the ones of the Python implementation.
+ */
+#include <Python.h>
+#include <string.h>
+
+#if PY_VERSION_HEX < 0x02050000
+typedef int Py_ssize_t;
+#endif
+
+static PyObject *owner_str = NULL;
+static PyObject *inputs_str = NULL;
+
+/*
+ * Open addressing hash table mapping an object address to its index.
+ * The objects are not owned by the table.
+ */
+typedef struct {
+    PyObject **keys;
+    Py_ssize_t *values;
+    size_t mask;
+    Py_ssize_t size;
+} IndexTable;
+
+static int
+table_init(IndexTable *t)
+{
+    t->mask = 255;
+    t->size = 0;
+    t->keys = (PyObject **)calloc(t->mask + 1, sizeof(PyObject *));
+    t->values = (Py_ssize_t *)malloc((t->mask + 1) * sizeof(Py_ssize_t));
+    if (!t->keys || !t->values) {
+        free(t->keys);
+        free(t->values);
+        PyErr_NoMemory();
+        return -1;
+    }
+    return 0;
+}
+
+static void
+table_free(IndexTable *t)
+{
+    free(t->keys);
+    free(t->values);
+}
+
+static size_t
+table_slot(const IndexTable *t, PyObject *key)
+{
+    size_t h = ((size_t)key >> 4) * (size_t)2654435761UL;
+    size_t i = h & t->mask;
+    while (t->keys[i] && t->keys[i] != key)
+        i = (i + 1) & t->mask;
+    return i;
+}
+
+/* Index of key, or -1 if it is not in the table. */
+static Py_ssize_t
+table_get(const IndexTable *t, PyObject *key)
+{
+    size_t i = table_slot(t, key);
+    return t->keys[i] ? t->values[i] : -1;
+}
+
+static int
+table_set(IndexTable *t, PyObject *key, Py_ssize_t value)
+{
+    size_t i;
+    if ((size_t)(t->size + 1) * 2 > t->mask + 1) {
+        IndexTable bigger;
+        size_t j;
+        bigger.mask = t->mask * 2 + 1;
+        bigger.size = t->size;
+        bigger.keys = (PyObject **)calloc(bigger.mask + 1,
+                                          sizeof(PyObject *));
+        bigger.values = (Py_ssize_t *)malloc((bigger.mask + 1) *
+                                             sizeof(Py_ssize_t));
+        if (!bigger.keys || !bigger.values) {
+            table_free(&bigger);
+            PyErr_NoMemory();
+            return -1;
+        }
+        for (j = 0; j <= t->mask; ++j) {
+            if (t->keys[j]) {
+                size_t k = table_slot(&bigger, t->keys[j]);
+                bigger.keys[k] = t->keys[j];
+                bigger.values[k] = t->values[j];
+            }
+        }
+        table_free(t);
+        *t = bigger;
+    }
+    i = table_slot(t, key);
+    if (!t->keys[i])
+        t->size++;
+    t->keys[i] = key;
+    t->values[i] = value;
+    return 0;
+}
+
+/* Growable array of Py_ssize_t. */
+typedef struct {
+    Py_ssize_t *data;
+    Py_ssize_t len;
+    Py_ssize_t cap;
+} IntArray;
+
+static int
+intarray_append(IntArray *a, Py_ssize_t v)
+{
+    if (a->len == a->cap) {
+        Py_ssize_t cap = a->cap ? a->cap * 2 : 64;
+        Py_ssize_t *data = (Py_ssize_t *)realloc(a->data,
+                                                 cap * sizeof(Py_ssize_t));
+        if (!data) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        a->data = data;
+        a->cap = cap;
+    }
+    a->data[a->len++] = v;
+    return 0;
+}
+
+/*
+ * How the dependencies of a node are computed: by calling a Python
+ * function (general_toposort), or like the deps function of io_toposort.
+ */
+typedef struct {
+    PyObject *deps;         /* callable, or NULL */
+    PyObject *seq_types;    /* types allowed for the result of deps */
+    PyObject *inputs;       /* io_toposort: set of inputs */
+    PyObject *orderings;    /* io_toposort: dict node -> prerequisites */
+    PyObject *variable_cls;
+    PyObject *apply_cls;
+} DepsSpec;
+
+/* New reference to the list of the dependencies of obj, or NULL. */
+static PyObject *
+get_deps(const DepsSpec *spec, PyObject *obj)
+{
+    PyObject *rval;
+    PyObject *ords = NULL;
+    int is_input, r;
+
+    if (spec->deps) {
+        PyObject *d = PyObject_CallFunctionObjArgs(spec->deps, obj, NULL);
+        if (!d)
+            return NULL;
+        r = PyObject_IsTrue(d);
+        if (r <= 0) {
+            Py_DECREF(d);
+            return r < 0 ? NULL : PyList_New(0);
+        }
+        r = PyObject_IsInstance(d, spec->seq_types);
+        if (r <= 0) {
+            Py_DECREF(d);
+            if (r == 0)
+                PyErr_SetString(PyExc_TypeError,
+                                "Non-deterministic collections here make"
+                                " toposort non-deterministic.");
+            return NULL;
+        }
+        rval = PySequence_List(d);
+        Py_DECREF(d);
+        return rval;
+    }
+
+    rval = PyList_New(0);
+    if (!rval)
+        return NULL;
+    if (PyDict_Check(spec->orderings)) {
+        if (PyDict_Size(spec->orderings))
+            ords = PyDict_GetItem(spec->orderings, obj);
+        Py_XINCREF(ords);
+    } else {
+        ords = PyObject_CallMethod(spec->orderings, "get", "OO", obj,
+                                   Py_None);
+        if (!ords)
+            goto fail;
+        if (ords == Py_None) {
+            Py_DECREF(ords);
+            ords = NULL;
+        }
+    }
+    is_input = PySet_Contains(spec->inputs, obj);
+    if (is_input < 0)
+        goto fail;
+    if (is_input) {
+        if (ords) {
+            r = PyObject_IsTrue(ords);
+            if (r < 0)
+                goto fail;
+            if (r) {
+                PyErr_SetString(PyExc_AssertionError,
+                                "An input of the graph has orderings.");
+                goto fail;
+            }
+        }
+    } else {
+        r = PyObject_IsInstance(obj, spec->variable_cls);
+        if (r < 0)
+            goto fail;
+        if (r) {
+            PyObject *owner = PyObject_GetAttr(obj, owner_str);
+            if (!owner)
+                goto fail;
+            r = PyObject_IsTrue(owner);
+            if (r > 0)
+                r = PyList_Append(rval, owner);
+            Py_DECREF(owner);
+            if (r < 0)
+                goto fail;
+        } else {
+            r = PyObject_IsInstance(obj, spec->apply_cls);
+            if (r < 0)
+                goto fail;
+            if (r) {
+                PyObject *inputs = PyObject_GetAttr(obj, inputs_str);
+                PyObject *tmp;
+                if (!inputs)
+                    goto fail;
+                tmp = _PyList_Extend((PyListObject *)rval, inputs);
+                Py_DECREF(inputs);
+                if (!tmp)
+                    goto fail;
+                Py_DECREF(tmp);
+            }
+        }
+        if (ords) {
+            PyObject *tmp = _PyList_Extend((PyListObject *)rval, ords);
+            if (!tmp)
+                goto fail;
+            Py_DECREF(tmp);
+        }
+    }
+    Py_XDECREF(ords);
+    return rval;
+
+fail:
+    Py_XDECREF(ords);
+    Py_DECREF(rval);
+    return NULL;
+}
+
+/*
+ * Topological sort of the nodes reachable from outputs, like
+ * general_toposort in graph.py: a depth-first search finds the reachable
+ * nodes and their dependencies, then the nodes without dependencies are
+ * emitted first, and each node is emitted once all its dependencies are.
+ *
+ * If only_cls is not NULL, only the instances of it are returned.
+ */
+static PyObject *
+toposort(PyObject *outputs, const DepsSpec *spec, PyObject *only_cls)
+{
+    IndexTable table;
+    PyObject *reachable = NULL;  /* list of the nodes, by index */
+    PyObject *all_deps = NULL;   /* list of their dependencies, by index */
+    PyObject *stack = NULL;
+    PyObject *rval = NULL;
+    Py_ssize_t *n_deps = NULL;   /* number of distinct dependencies */
+    Py_ssize_t *mark = NULL;
+    Py_ssize_t *client_start = NULL;
+    Py_ssize_t *clients = NULL;
+    char *emitted = NULL;
+    IntArray queue = {NULL, 0, 0};
+    Py_ssize_t n, i, j, head, n_emitted, n_edges;
+
+    if (table_init(&table) < 0)
+        return NULL;
+    reachable = PyList_New(0);
+    all_deps = PyList_New(0);
+    stack = PySequence_List(outputs);
+    if (!reachable || !all_deps || !stack)
+        goto done;
+
+    /* Depth-first search, in the order of stack_search. */
+    while (PyList_GET_SIZE(stack)) {
+        Py_ssize_t last = PyList_GET_SIZE(stack) - 1;
+        PyObject *node = PyList_GET_ITEM(stack, last);
+        PyObject *deps;
+        Py_INCREF(node);
+        if (PyList_SetSlice(stack, last, last + 1, NULL) < 0) {
+            Py_DECREF(node);
+            goto done;
+        }
+        if (table_get(&table, node) >= 0) {
+            Py_DECREF(node);
+            continue;
+        }
+        if (table_set(&table, node, PyList_GET_SIZE(reachable)) < 0 ||
+                PyList_Append(reachable, node) < 0) {
+            Py_DECREF(node);
+            goto done;
+        }
+        Py_DECREF(node);
+        deps = get_deps(spec, node);
+        if (!deps)
+            goto done;
+        if (PyList_Append(all_deps, deps) < 0 ||
+                PyList_SetSlice(stack, PyList_GET_SIZE(stack),
+                                PyList_GET_SIZE(stack), deps) < 0) {
+            Py_DECREF(deps);
+            goto done;
+        }
+        Py_DECREF(deps);
+    }
+
+    /* Clients of each node, in CSR form, without duplicates. */
+    n = PyList_GET_SIZE(reachable);
+    n_deps = (Py_ssize_t *)calloc(n + 1, sizeof(Py_ssize_t));
+    mark = (Py_ssize_t *)malloc((n + 1) * sizeof(Py_ssize_t));
+    client_start = (Py_ssize_t *)calloc(n + 2, sizeof(Py_ssize_t));
+    emitted = (char *)calloc(n + 1, 1);
+    if (!n_deps || !mark || !client_start || !emitted) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < n; ++i)
+        mark[i] = -1;
+    n_edges = 0;
+    for (i = 0; i < n; ++i) {
+        PyObject *deps = PyList_GET_ITEM(all_deps, i);
+        for (j = 0; j < PyList_GET_SIZE(deps); ++j) {
+            Py_ssize_t d = table_get(&table, PyList_GET_ITEM(deps, j));
+            assert(d >= 0);
+            if (mark[d] != i) {
+                mark[d] = i;
+                n_deps[i]++;
+                client_start[d + 1]++;
+                n_edges++;
+            }
+        }
+    }
+    for (i = 0; i < n; ++i)
+        client_start[i + 1] += client_start[i];
+    clients = (Py_ssize_t *)malloc((n_edges + 1) * sizeof(Py_ssize_t));
+    if (!clients) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < n; ++i)
+        mark[i] = -1;
+    {
+        /* Fill the clients of each node in the order they were found. */
+        Py_ssize_t *fill = (Py_ssize_t *)malloc((n + 1) *
+                                                sizeof(Py_ssize_t));
+        if (!fill) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        memcpy(fill, client_start, n * sizeof(Py_ssize_t));
+        for (i = 0; i < n; ++i) {
+            PyObject *deps = PyList_GET_ITEM(all_deps, i);
+            for (j = 0; j < PyList_GET_SIZE(deps); ++j) {
+                Py_ssize_t d = table_get(&table, PyList_GET_ITEM(deps, j));
+                if (mark[d] != i) {
+                    mark[d] = i;
+                    clients[fill[d]++] = i;
+                }
+            }
+        }
+        free(fill);
+    }
+
+    /* Emit the nodes once all their dependencies are emitted. */
+    for (i = 0; i < n; ++i) {
+        if (!n_deps[i] && intarray_append(&queue, i) < 0)
+            goto done;
+    }
+    rval = PyList_New(0);
+    if (!rval)
+        goto done;
+    n_emitted = 0;
+    for (head = 0; head < queue.len; ++head) {
+        Py_ssize_t node = queue.data[head];
+        PyObject *obj;
+        if (emitted[node])
+            continue;
+        emitted[node] = 1;
+        n_emitted++;
+        obj = PyList_GET_ITEM(reachable, node);
+        if (only_cls) {
+            int r = PyObject_IsInstance(obj, only_cls);
+            if (r < 0 || (r && PyList_Append(rval, obj) < 0)) {
+                Py_CLEAR(rval);
+                goto done;
+            }
+        } else if (PyList_Append(rval, obj) < 0) {
+            Py_CLEAR(rval);
+            goto done;
+        }
+        for (j = client_start[node]; j < client_start[node + 1]; ++j) {
+            Py_ssize_t c = clients[j];
+            if (--n_deps[c] == 0 && intarray_append(&queue, c) < 0) {
+                Py_CLEAR(rval);
+                goto done;
+            }
+        }
+    }
+    if (n_emitted != n) {
+        Py_CLEAR(rval);
+        PyErr_SetString(PyExc_ValueError, "graph contains cycles");
+    }
+
+done:
+    table_free(&table);
+    free(n_deps);
+    free(mark);
+    free(client_start);
+    free(clients);
+    free(emitted);
+    free(queue.data);
+    Py_XDECREF(reachable);
+    Py_XDECREF(all_deps);
+    Py_XDECREF(stack);
+    return rval;
+}
+
+static PyObject *
+graph_general_toposort(PyObject *self, PyObject *args)
+{
+    DepsSpec spec;
+    PyObject *outputs;
+    memset(&spec, 0, sizeof(spec));
+    if (!PyArg_ParseTuple(args, "OOO", &outputs, &spec.deps,
+                          &spec.seq_types))
+        return NULL;
+    return toposort(outputs, &spec, NULL);
+}
+
+static PyObject *
+graph_io_toposort(PyObject *self, PyObject *args)
+{
+    DepsSpec spec;
+    PyObject *inputs, *outputs, *rval;
+    memset(&spec, 0, sizeof(spec));
+    if (!PyArg_ParseTuple(args, "OOOOO", &inputs, &outputs,
+                          &spec.orderings, &spec.variable_cls,
+                          &spec.apply_cls))
+        return NULL;
+    /* A set (e.g. FunctionGraph.variables) is used as is: copying it at
+     * each call would make the import of a graph quadratic. */
+    if (PyAnySet_Check(inputs)) {
+        Py_INCREF(inputs);
+        spec.inputs = inputs;
+    }
+    else {
+        spec.inputs = PySet_New(inputs);
+        if (!spec.inputs)
+            return NULL;
+    }
+    rval = toposort(outputs, &spec, spec.apply_cls);
+    Py_DECREF(spec.inputs);
+    return rval;
+}
+
+/*
+ * Like ancestors in graph.py: the variables found by a left-recursive
+ * depth-first search from variable_list, that does not go through the
+ * owner of the blockers.
+ */
+static PyObject *
+graph_ancestors(PyObject *self, PyObject *args)
+{
+    PyObject *variable_list, *blockers;
+    PyObject *stack, *rval = NULL;
+    IndexTable table;
+    int use_blockers;
+
+    if (!PyArg_ParseTuple(args, "OO", &variable_list, &blockers))
+        return NULL;
+    use_blockers = PyObject_IsTrue(blockers);
+    if (use_blockers < 0)
+        return NULL;
+    if (table_init(&table) < 0)
+        return NULL;
+    stack = PySequence_List(variable_list);
+    if (!stack)
+        goto fail;
+    rval = PyList_New(0);
+    if (!rval)
+        goto fail;
+
+    while (PyList_GET_SIZE(stack)) {
+        Py_ssize_t last = PyList_GET_SIZE(stack) - 1;
+        PyObject *var = PyList_GET_ITEM(stack, last);
+        PyObject *owner;
+        int r;
+        Py_INCREF(var);
+        if (PyList_SetSlice(stack, last, last + 1, NULL) < 0) {
+            Py_DECREF(var);
+            goto fail;
+        }
+        if (table_get(&table, var) >= 0) {
+            Py_DECREF(var);
+            continue;
+        }
+        /* rval keeps var alive, so that its address stays valid. */
+        if (table_set(&table, var, 0) < 0 || PyList_Append(rval, var) < 0) {
+            Py_DECREF(var);
+            goto fail;
+        }
+        Py_DECREF(var);
+        owner = PyObject_GetAttr(var, owner_str);
+        if (!owner)
+            goto fail;
+        r = PyObject_IsTrue(owner);
+        if (r > 0 && use_blockers) {
+            r = PySequence_Contains(blockers, var);
+            if (r >= 0)
+                r = !r;
+        }
+        if (r > 0) {
+            PyObject *inputs = PyObject_GetAttr(owner, inputs_str);
+            PyObject *seq;
+            Py_ssize_t i, n_inputs;
+            if (!inputs) {
+                Py_DECREF(owner);
+                goto fail;
+            }
+            seq = PySequence_Fast(inputs, "inputs must be a sequence");
+            Py_DECREF(inputs);
+            if (!seq) {
+                Py_DECREF(owner);
+                goto fail;
+            }
+            n_inputs = PySequence_Fast_GET_SIZE(seq);
+            for (i = n_inputs - 1; i >= 0 && r >= 0; --i)
+                r = PyList_Append(stack, PySequence_Fast_GET_ITEM(seq, i));
+            Py_DECREF(seq);
+        }
+        Py_DECREF(owner);
+        if (r < 0)
+            goto fail;
+    }
+    Py_DECREF(stack);
+    table_free(&table);
+    return rval;
+
+fail:
+    Py_XDECREF(stack);
+    Py_XDECREF(rval);
+    table_free(&table);
+    return NULL;
+}
+
+static PyObject *
+get_version(PyObject *self, PyObject *args)
+{
+    return PyFloat_FromDouble(0.11);
+}
+
+static PyMethodDef graph_methods[] = {
+    {"general_toposort", graph_general_toposort, METH_VARARGS,
+     "general_toposort(outputs, deps, seq_types)"},
+    {"io_toposort", graph_io_toposort, METH_VARARGS,
+     "io_toposort(inputs, outputs, orderings, Variable, Apply)"},
+    {"ancestors", graph_ancestors, METH_VARARGS,
+     "ancestors(variable_list, blockers)"},
+    {"get_version", get_version, METH_VARARGS, "Get extension version."},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+initgraph_ext(void)
+{
+    owner_str = PyString_InternFromString("owner");
+    inputs_str = PyString_InternFromString("inputs");
+    if (!owner_str || !inputs_str)
+        return;
+    Py_InitModule("graph_ext", graph_methods);
+}
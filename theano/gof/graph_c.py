@@ -0,0 +1,102 @@
+"""
+Load (compiling it if needed) the C implementation of the graph
+traversals of graph.py.
+
+Importing this module makes graph.py use it. See graph_c.c.
+"""
+import errno
+import logging
+import os
+import sys
+
+import theano
+from theano import config
+from theano.compat import reload
+from theano.gof.compilelock import get_lock, release_lock
+from theano.gof import cmodule
+from theano.gof import graph
+
+_logger = logging.getLogger('theano.gof.graph_c')
+
+force_compile = False
+version = 0.11  # must match constant returned in function get_version()
+
+
+def try_import():
+    global graph_ext
+    sys.path[0:0] = [config.compiledir]
+    import graph_ext
+    del sys.path[0]
+
+
+def try_reload():
+    sys.path[0:0] = [config.compiledir]
+    reload(graph_ext)
+    del sys.path[0]
+
+# See lazylinker_c.py for why the module is put in a package of the
+# compiledir, with an __init__.py file.
+location = os.path.join(config.compiledir, 'graph_ext')
+if not os.path.exists(location):
+    try:
+        os.mkdir(location)
+    except OSError, e:
+        assert e.errno == errno.EEXIST
+        assert os.path.isdir(location)
+
+if not os.path.exists(os.path.join(location, '__init__.py')):
+    open(os.path.join(location, '__init__.py'), 'w').close()
+
+try:
+    _need_reload = False
+    if force_compile:
+        raise ImportError()
+    try_import()
+    _need_reload = True
+    if version != getattr(graph_ext, '_version', None):
+        raise ImportError()
+except ImportError:
+    get_lock()
+    try:
+        # Maybe someone else already finished compiling it while we were
+        # waiting for the lock?
+        try:
+            if force_compile:
+                raise ImportError()
+            if _need_reload:
+                try_reload()
+            else:
+                try_import()
+                _need_reload = True
+            if version != getattr(graph_ext, '_version', None):
+                raise ImportError()
+        except ImportError:
+            if not theano.config.cxx:
+                raise
+            cfile = os.path.join(theano.__path__[0], 'gof', 'graph_c.c')
+            if not os.path.exists(cfile):
+                raise ImportError("The file graph_c.c is not available.")
+            _logger.info("Compiling the C graph traversals")
+            code = open(cfile).read()
+            args = cmodule.GCC_compiler.compile_args()
+            cmodule.GCC_compiler.compile_str('graph_ext', code,
+                                             location=location,
+                                             preargs=args)
+            # Save version into the __init__.py file.
+            init_py = os.path.join(location, '__init__.py')
+            open(init_py, 'w').write('_version = %s\n' % version)
+            # Do not reload an outdated __init__.pyc below.
+            init_pyc = os.path.join(location, '__init__.pyc')
+            if os.path.isfile(init_pyc):
+                os.remove(init_pyc)
+            try_import()
+            try_reload()
+            from graph_ext import graph_ext as graph_c
+            assert graph_ext._version == graph_c.get_version()
+    finally:
+        release_lock()
+
+from graph_ext.graph_ext import *
+assert force_compile or (version == get_version())
+
+graph.c_traversals = sys.modules['graph_ext.graph_ext']
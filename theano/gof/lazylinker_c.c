@@ -30,8 +30,6 @@ TODO:
 - Check max supported depth of recursion
 - CLazyLinker should add context information to errors caught during evaluation. Say what node we were on, add the traceback attached to the node.
 - Clear containers of fully-useed intermediate results if allow_gc is 1
-- Add timers for profiling
-- Add support for profiling space used.
 
 
   */
@@ -124,6 +122,16 @@ typedef struct {
     int do_timing;
     int need_update_inputs;
     int position_of_error; // -1 for no error, otw the index into `thunks` that failed.
+
+    PyObject * callback; // called after each thunk, or NULL
+    PyObject * callback_input; // dict of the other arguments of callback
+
+    // Memory profiling, all NULL unless `variables` was given.
+    PyObject * variables; // python list of the variables, indexed like var_*
+    PyObject ** var_shape_info; // var.type.get_shape_info or NULL
+    PyObject * variable_shape; // dict var -> shape
+    PyObject * variable_strides; // dict var -> strides or 'c'
+    PyObject * node_executed_order; // list of nodes, in call order
 } CLazyLinker;
 
 
@@ -178,6 +186,21 @@ CLazyLinker_dealloc(PyObject* _self)
   free(self->var_value_cells);
   free(self->output_vars);
 
+  if (self->var_shape_info)
+    {
+      for (int i = 0; i < self->n_vars; ++i)
+        {
+          Py_XDECREF(self->var_shape_info[i]);
+        }
+    }
+  free(self->var_shape_info);
+  Py_XDECREF(self->variables);
+  Py_XDECREF(self->variable_shape);
+  Py_XDECREF(self->variable_strides);
+  Py_XDECREF(self->node_executed_order);
+  Py_XDECREF(self->callback);
+  Py_XDECREF(self->callback_input);
+
   Py_XDECREF(self->nodes);
   Py_XDECREF(self->thunks);
   Py_XDECREF(self->call_times);
@@ -232,6 +255,15 @@ CLazyLinker_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 
       self->need_update_inputs = 0;
       self->position_of_error = -1;
+
+      self->callback = NULL;
+      self->callback_input = NULL;
+
+      self->variables = NULL;
+      self->var_shape_info = NULL;
+      self->variable_shape = NULL;
+      self->variable_strides = NULL;
+      self->node_executed_order = NULL;
     }
     return (PyObject *)self;
 }
@@ -260,6 +292,9 @@ CLazyLinker_init(CLazyLinker *self, PyObject *args, PyObject *kwds)
       (char*)"node_output_size",
       (char*)"update_storage",
       (char*)"dependencies",
+      (char*)"callback",
+      (char*)"callback_input",
+      (char*)"variables",
       NULL};
 
     PyObject *compute_map_list=NULL,
@@ -275,10 +310,13 @@ CLazyLinker_init(CLazyLinker *self, PyObject *args, PyObject *kwds)
              *node_prereqs=NULL,
              *node_output_size=NULL,
              *update_storage=NULL,
-             *dependencies=NULL;
+             *dependencies=NULL,
+             *callback=Py_None,
+             *callback_input=Py_None,
+             *variables=Py_None;
 
     assert(!self->nodes);
-    if (! PyArg_ParseTupleAndKeywords(args, kwds, "OOOiOOOOOOOOOOOOOOOO", kwlist,
+    if (! PyArg_ParseTupleAndKeywords(args, kwds, "OOOiOOOOOOOOOOOOOOOO|OOO", kwlist,
                                       &self->nodes,
                                       &self->thunks,
                                       &self->pre_call_clear,
@@ -298,7 +336,10 @@ CLazyLinker_init(CLazyLinker *self, PyObject *args, PyObject *kwds)
                                       &node_prereqs,
                                       &node_output_size,
                                       &update_storage,
-                                      &dependencies
+                                      &dependencies,
+                                      &callback,
+                                      &callback_input,
+                                      &variables
                                       ))
         return -1;
     Py_INCREF(self->nodes);
@@ -478,6 +519,50 @@ CLazyLinker_init(CLazyLinker *self, PyObject *args, PyObject *kwds)
     if (unpack_list_of_ssize_t(update_storage, &self->update_storage, &self->n_updates,
                                "updates_storage"))
       return -1;
+
+    if (callback != Py_None)
+      {
+        if (!PyDict_Check(callback_input))
+          {
+            PyErr_SetString(PyExc_TypeError,
+                            "callback_input must be a dict when a callback is given");
+            return -1;
+          }
+        Py_INCREF(callback);
+        self->callback = callback;
+        Py_INCREF(callback_input);
+        self->callback_input = callback_input;
+      }
+
+    if (variables != Py_None)
+      {
+        if (!PyList_Check(variables) || PyList_Size(variables) != self->n_vars)
+          {
+            PyErr_SetString(PyExc_TypeError,
+                            "variables must be a list with one element per variable");
+            return -1;
+          }
+        Py_INCREF(variables);
+        self->variables = variables;
+        self->var_shape_info = (PyObject**)calloc(self->n_vars, sizeof(PyObject*));
+        assert(self->var_shape_info);
+        for (int i = 0; i < self->n_vars; ++i)
+          {
+            // new references, or NULL when the type has no get_shape_info
+            PyObject * type = PyObject_GetAttrString(PyList_GetItem(variables, i), "type");
+            if (type)
+              {
+                self->var_shape_info[i] = PyObject_GetAttrString(type, "get_shape_info");
+                Py_DECREF(type);
+              }
+            PyErr_Clear();
+          }
+        self->variable_shape = PyDict_New();
+        self->variable_strides = PyDict_New();
+        self->node_executed_order = PyList_New(0);
+        if (!self->variable_shape || !self->variable_strides || !self->node_executed_order)
+          return -1;
+      }
     return 0;
 }
 static void set_position_of_error(CLazyLinker * self, int owner_idx)
@@ -487,6 +572,128 @@ static void set_position_of_error(CLazyLinker * self, int owner_idx)
       self->position_of_error = owner_idx;
     }
 }
+/**
+  Record the shape and strides of the value of variable `var_idx` in
+  self->variable_shape and self->variable_strides, like Stack does.
+  */
+static int record_shape(CLazyLinker * self, Py_ssize_t var_idx)
+{
+  PyObject * value = PyList_GetItem(self->var_value_cells[var_idx], 0);
+  // refcounting - value is borrowed
+  PyObject * var = PyList_GetItem(self->variables, var_idx);
+  PyObject * sh = NULL;
+  PyObject * st = NULL;
+  int c_contiguous = 0;
+  if (self->var_shape_info[var_idx])
+    sh = PyObject_CallFunctionObjArgs(self->var_shape_info[var_idx], value, NULL);
+  else
+    sh = PyString_FromString("input no shape");
+  if (!sh) return -1;
+
+  PyObject * flags = PyObject_GetAttrString(value, "flags");
+  if (flags)
+    {
+      if (PyObject_IsTrue(flags))
+        {
+          PyObject * c = PyObject_GetAttrString(flags, "c_contiguous");
+          if (c)
+            {
+              c_contiguous = PyObject_IsTrue(c);
+              Py_DECREF(c);
+            }
+        }
+      Py_DECREF(flags);
+    }
+  else
+    {
+      PyErr_Clear();
+      if (PyObject_HasAttrString(value, "is_c_contiguous"))
+        {
+          PyObject * c = PyObject_CallMethod(value, (char*)"is_c_contiguous", NULL);
+          if (c)
+            {
+              c_contiguous = PyObject_IsTrue(c);
+              Py_DECREF(c);
+            }
+        }
+    }
+  PyErr_Clear();
+  if (c_contiguous > 0)
+    st = PyString_FromString("c");
+  else
+    {
+      st = PyObject_GetAttrString(value, "strides");
+      if (!st)
+        {
+          PyErr_Clear();
+          st = PyString_FromString("input no strides");
+        }
+    }
+  if (!st || PyDict_SetItem(self->variable_shape, var, sh)
+      || PyDict_SetItem(self->variable_strides, var, st))
+    {
+      Py_DECREF(sh);
+      Py_XDECREF(st);
+      return -1;
+    }
+  Py_DECREF(sh);
+  Py_DECREF(st);
+  return 0;
+}
+/**
+  Called after each run of the thunk of node `node_idx`: record the
+  execution order and the outputs shapes for memory profiling, and call
+  the user callback.
+  */
+static int post_thunk(CLazyLinker * self, Py_ssize_t node_idx)
+{
+  PyObject * node = PyList_GetItem(self->nodes, node_idx);
+  // refcounting - node is borrowed
+  if (self->variables)
+    {
+      if (PyList_Append(self->node_executed_order, node))
+        return -1;
+      for (int i = 0; i < self->node_n_outputs[node_idx]; ++i)
+        {
+          Py_ssize_t out_idx = self->node_outputs[node_idx][i];
+          if (PyList_GetItem(self->var_value_cells[out_idx], 0) == Py_None)
+            continue; // a lazy thunk that needs more inputs
+          if (record_shape(self, out_idx))
+            return -1;
+        }
+    }
+  if (self->callback)
+    {
+      PyObject * kwargs = PyDict_Copy(self->callback_input);
+      if (!kwargs) return -1;
+      PyObject * args = PyTuple_New(0);
+      PyObject * rval = NULL;
+      if (args
+          && !PyDict_SetItemString(kwargs, "node", node)
+          && !PyDict_SetItemString(kwargs, "thunk",
+                                   PyList_GetItem(self->thunks, node_idx)))
+        {
+          rval = PyObject_Call(self->callback, args, kwargs);
+        }
+      Py_XDECREF(args);
+      Py_DECREF(kwargs);
+      if (!rval) return -1;
+      Py_DECREF(rval);
+    }
+  return 0;
+}
+/**
+  Set var_computed[var_idx], and the python compute_map cell when a
+  callback may look at it.
+  */
+static int set_computed(CLazyLinker * self, Py_ssize_t var_idx, int val)
+{
+  self->var_computed[var_idx] = val;
+  if (self->callback)
+    return PyList_SetItem(self->var_computed_cells[var_idx], 0,
+                          PyInt_FromLong(val));
+  return 0;
+}
 static PyObject * pycall(CLazyLinker * self, Py_ssize_t node_idx, int verbose)
 {
   // call thunk to see which inputs it wants
@@ -619,6 +826,11 @@ int lazy_rec_eval(CLazyLinker * self, Py_ssize_t var_idx, PyObject*one, PyObject
           err = 1;
           goto fail;
         }
+      if (post_thunk(self, owner_idx))
+        {
+          err = 1;
+          goto pyfail;
+        }
 
       //update the computed-ness of any output cells
       for (int i = 0; i < self->node_n_outputs[owner_idx]; ++i)
@@ -708,6 +920,8 @@ int lazy_rec_eval(CLazyLinker * self, Py_ssize_t var_idx, PyObject*one, PyObject
         {
           err = c_call(self, owner_idx, verbose);
           if (err) goto fail;
+          err = post_thunk(self, owner_idx);
+          if (err) goto fail;
         }
       else
         {
@@ -718,6 +932,8 @@ int lazy_rec_eval(CLazyLinker * self, Py_ssize_t var_idx, PyObject*one, PyObject
               if (rval == Py_None)
                 {
                   Py_DECREF(rval); //ignore a return of None
+                  err = post_thunk(self, owner_idx);
+                  if (err) goto fail;
                 }
               else if (PyList_Check(rval))
                 {
@@ -745,7 +961,8 @@ int lazy_rec_eval(CLazyLinker * self, Py_ssize_t var_idx, PyObject*one, PyObject
   // loop over all outputs and mark them as computed
   for (int i = 0; i < self->node_n_outputs[owner_idx]; ++i)
     {
-      self->var_computed[self->node_outputs[owner_idx][i]] = 1;
+      err = set_computed(self, self->node_outputs[owner_idx][i], 1);
+      if (err) goto fail;
     }
 
   // Free vars that are not needed anymore
@@ -780,8 +997,9 @@ int lazy_rec_eval(CLazyLinker * self, Py_ssize_t var_idx, PyObject*one, PyObject
 
           Py_INCREF(Py_None);
           err = PyList_SetItem(self->var_value_cells[i_idx], 0, Py_None);
+          if (err) goto fail;
 //See the Stack gc implementation for why we change it to 2 and not 0.
-          self->var_computed[i_idx] = 2;
+          err = set_computed(self, i_idx, 2);
           if (err) goto fail;
         }
     }
@@ -843,6 +1061,19 @@ CLazyLinker_call(PyObject *_self, PyObject *args, PyObject *kwds)
             }
         }
 
+      if (self->variables)
+        {
+          // record the inputs, shared variables and constants.
+          PyList_SetSlice(self->node_executed_order, 0,
+                          PyList_Size(self->node_executed_order), NULL);
+          for (int i = 0; i < self->n_vars && (!err); ++i)
+            {
+              if (!self->var_has_owner[i]
+                  && PyList_GetItem(self->var_value_cells[i], 0) != Py_None)
+                err = record_shape(self, i);
+            }
+        }
+
       for (int i = 0; i < self->n_output_vars && (!err); ++i)
         {
           err = lazy_rec_eval(self, self->output_vars[i], one, zero);
@@ -973,6 +1204,14 @@ static PyMemberDef CLazyLinker_members[] = {
      (char*)"bool: nonzero means call will time thunks"},
     {(char*)"need_update_inputs", T_INT, offsetof(CLazyLinker, need_update_inputs), 0,
      (char*)"bool: nonzero means Function.__call__ must implement update mechanism"},
+    {(char*)"callback", T_OBJECT_EX, offsetof(CLazyLinker, callback), READONLY,
+     (char*)"function called after each thunk"},
+    {(char*)"variable_shape", T_OBJECT_EX, offsetof(CLazyLinker, variable_shape), READONLY,
+     (char*)"dict variable -> shape of its last value (memory profiling)"},
+    {(char*)"variable_strides", T_OBJECT_EX, offsetof(CLazyLinker, variable_strides), READONLY,
+     (char*)"dict variable -> strides of its last value (memory profiling)"},
+    {(char*)"node_executed_order", T_OBJECT_EX, offsetof(CLazyLinker, node_executed_order), READONLY,
+     (char*)"list of the nodes run by the last call (memory profiling)"},
     {NULL}  /* Sentinel */
 };
 
@@ -1024,7 +1263,7 @@ static PyTypeObject lazylinker_ext_CLazyLinkerType = {
 
 static PyObject * get_version(PyObject *dummy, PyObject *args)
 {
-  PyObject *result = PyFloat_FromDouble(0.21);
+  PyObject *result = PyFloat_FromDouble(0.211);
   return result;
 }
 
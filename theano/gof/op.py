@@ -670,6 +670,20 @@ class Op(utils.object2, PureOp, CLinkerOp):
         else:
             return NotImplemented
 
+    def make_c_linker(self, node, no_recycling):
+        """
+        Return the CLinker that `make_thunk` uses to compile `node`.
+
+        :param no_recycling: see `make_thunk`.
+        """
+        e = FunctionGraph(node.inputs, node.outputs)
+
+        e_no_recycling = [new_o
+                for (new_o, old_o) in zip(e.outputs, node.outputs)
+                if old_o in no_recycling]
+        return theano.gof.cc.CLinker().accept(e,
+                no_recycling=e_no_recycling)
+
     def make_thunk(self, node, storage_map, compute_map, no_recycling):
         """
         :param node: something previously returned by self.make_node
@@ -700,13 +714,7 @@ class Op(utils.object2, PureOp, CLinkerOp):
         #logger.debug('Compiling node %i of graph' % node_idx)
         if self._op_use_c_code:
             try:
-                e = FunctionGraph(node.inputs, node.outputs)
-
-                e_no_recycling = [new_o
-                        for (new_o, old_o) in zip(e.outputs, node.outputs)
-                        if old_o in no_recycling]
-                cl = theano.gof.cc.CLinker().accept(e,
-                        no_recycling=e_no_recycling)
+                cl = self.make_c_linker(node, no_recycling)
 
                 logger.debug('Trying CLinker.make_thunk')
                 outputs = cl.make_thunk(input_storage=node_input_storage,
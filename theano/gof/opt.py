@@ -4,6 +4,7 @@ amount of useful generic optimization tools.
 """
 
 import copy
+import heapq
 import logging
 import pdb
 import sys
@@ -75,12 +76,13 @@ class Optimizer(object):
           opt.apply(fgraph)
         """
         self.add_requirements(fgraph)
+        local = theano.tensor.basic.constant.local
         try:
-            orig = theano.tensor.basic.constant.enable
-            theano.tensor.basic.constant.enable = False
+            orig = getattr(local, 'enable', True)
+            local.enable = False
             ret = self.apply(fgraph, *args, **kwargs)
         finally:
-            theano.tensor.basic.constant.enable = orig
+            local.enable = orig
         return ret
 
     def __call__(self, fgraph):
@@ -448,6 +450,10 @@ class MergeFeature(object):
         ## For all variables
         # Set of distinct (not mergeable) nodes
         self.nodes_seen = set()
+        # inputs -> list of the nodes of nodes_seen with those inputs.
+        self.node_index = {}
+        # node -> its key in node_index
+        self.node_key = {}
 
         # Each element of scheduled is a list of list of (out, new_out) pairs.
         # Each list of pairs represent the substitution needed to replace all
@@ -460,10 +466,10 @@ class MergeFeature(object):
         #     [(node.out1, cand3.out1), (node.out2, cand3.out2)]]]
         self.scheduled = []
 
-        # List of (node, candidate) pairs, where we tried to replace node by
+        # Set of (node, candidate) pairs, where we tried to replace node by
         # candidate, but it failed. This is used to avoid infinite loops
         # during the replacement phase.
-        self.blacklist = []
+        self.blacklist = set()
 
         for node in fgraph.toposort():
             self.on_import(fgraph, node, "on_attach")
@@ -472,7 +478,7 @@ class MergeFeature(object):
         # If inputs to node change, it is not guaranteed that it is distinct
         # from the other nodes in nodes_seen
         if node in self.nodes_seen:
-            self.nodes_seen.discard(node)
+            self.forget_node(node)
             self.process_node(fgraph, node)
 
         if isinstance(new_r, graph.Constant):
@@ -486,7 +492,7 @@ class MergeFeature(object):
         self.process_node(fgraph, node)
 
     def on_prune(self, fgraph, node, reason):
-        self.nodes_seen.discard(node)
+        self.forget_node(node)
         for c in node.inputs:
             if isinstance(c, graph.Constant) and (len(c.clients) <= 1):
                 # This was the last node using this constant
@@ -513,19 +519,32 @@ class MergeFeature(object):
             self.const_sig_inv[sig] = c
             self.seen_constants.add(id(c))
 
+    def forget_node(self, node):
+        """Remove `node` from nodes_seen and from the signature index."""
+        if node not in self.nodes_seen:
+            return
+        self.nodes_seen.remove(node)
+        key = self.node_key.pop(node, None)
+        if key is not None:
+            nodes = self.node_index[key]
+            nodes.remove(node)
+            if not nodes:
+                del self.node_index[key]
+
     def process_node(self, fgraph, node):
         """Check if a node can be merged, and queue that replacement."""
         if node in self.nodes_seen:
             return
 
-        # These asserts ensure that the fgraph has set the clients field
-        # properly.
-        # The clients should at least contain `node` itself!
+        # Nodes are hash-consed on the identity of their inputs: the
+        # duplicates of a node of nodes_seen are found with one dictionary
+        # lookup. The op is not part of the key, as the hash of some ops
+        # changes when they are modified (e.g. made inplace).
+        key = None
         if node.inputs:
-            assert len(node.inputs[0].clients) > 0
-            assert (node, 0) in node.inputs[0].clients
-            merge_candidates = [c for (c, i) in node.inputs[0].clients
-                                if c in self.nodes_seen]
+            key = tuple(node.inputs)
+            merge_candidates = [c for c in self.node_index.get(key, ())
+                                if c.op == node.op]
         else:
             merge_candidates = []
 
@@ -533,33 +552,29 @@ class MergeFeature(object):
         for candidate in merge_candidates:
             if candidate is node:
                 continue
-            if len(node.inputs) != len(candidate.inputs):
+            if (node, candidate) in self.blacklist:
+                # They were already tried, and there was an error
                 continue
 
-            inputs_match = all(node_in is cand_in
-                               for node_in, cand_in in zip(node.inputs,
-                                                           candidate.inputs))
-            if inputs_match and node.op == candidate.op:
-                if (node, candidate) in self.blacklist:
-                    # They were already tried, and there was an error
-                    continue
+            # Schedule transfer of clients from node to candidate
+            pairs = zip(node.outputs, candidate.outputs)
 
-                # Schedule transfer of clients from node to candidate
-                pairs = zip(node.outputs, candidate.outputs)
+            #transfer names
+            for node_output, cand_output in pairs:
+                #clobber old name with new one
+                #it's arbitrary... one of the names has to go
+                if node_output.name:
+                    cand_output.name = node_output.name
 
-                #transfer names
-                for node_output, cand_output in pairs:
-                    #clobber old name with new one
-                    #it's arbitrary... one of the names has to go
-                    if node_output.name:
-                        cand_output.name = node_output.name
-
-                replacement_candidates.append(pairs)
+            replacement_candidates.append(pairs)
 
         if replacement_candidates:
             self.scheduled.append(replacement_candidates)
         else:
             self.nodes_seen.add(node)
+            if key is not None:
+                self.node_index.setdefault(key, []).append(node)
+                self.node_key[node] = key
 
 
 class MergeOptimizer(Optimizer):
@@ -622,7 +637,7 @@ class MergeOptimizer(Optimizer):
                 except InconsistencyError:
                     success = False
                     nb_fail += 1
-                    fgraph.merge_feature.blacklist.append(
+                    fgraph.merge_feature.blacklist.add(
                         (pairs[0][0].owner, pairs[0][1].owner))
                 if success:
                     nb_merged += len(pairs)
@@ -645,7 +660,7 @@ class MergeOptimizer(Optimizer):
             callback_time = None
             callbacks_time = {}
         # clear blacklist
-        fgraph.merge_feature.blacklist = []
+        fgraph.merge_feature.blacklist = set()
         return (nb_fail, time.time() - t0, validate_time,
                 callback_time, callbacks_time, nb_merged, nb_constant)
 
@@ -1690,12 +1705,19 @@ class ChangeTracker:
         fgraph.change_tracker = self
 
 
+theano.configparser.AddConfigVar('optdb.equilibrium_worklist',
+        "If True, after its first pass over the graph, EquilibriumOptimizer "
+        "only visits the nodes around the changes of the previous pass.",
+        theano.configparser.BoolParam(True), in_c_key=False)
+
+
 class EquilibriumOptimizer(NavigatorOptimizer):
     def __init__(self,
                  optimizers,
                  failure_callback=None,
                  ignore_newtrees=True,
-                 max_use_ratio=None):
+                 max_use_ratio=None,
+                 worklist_depth=2):
         """ Apply optimizations until equilibrium point.
 
         :param optimizers:  list or set of local or global optimizations to
@@ -1705,6 +1727,9 @@ class EquilibriumOptimizer(NavigatorOptimizer):
             (size of graph * this number) times
         :param ignore_newtrees: See EquilibriumDB ignore_newtrees
             parameter definition
+        :param worklist_depth: when config.optdb.equilibrium_worklist is
+            True, a change to a node also makes its clients up to this
+            depth visited again by the next pass.
 
         """
 
@@ -1728,6 +1753,7 @@ class EquilibriumOptimizer(NavigatorOptimizer):
         self.max_use_ratio = max_use_ratio
         assert self.max_use_ratio is not None, (
                 'max_use_ratio has to be a number')
+        self.worklist_depth = worklist_depth
 
     def get_local_optimizers(self):
         for opt in self.local_optimizers_all:
@@ -1749,6 +1775,8 @@ class EquilibriumOptimizer(NavigatorOptimizer):
             opt.add_requirements(fgraph)
 
     def apply(self, fgraph, start_from=None):
+        use_worklist = (start_from is None and
+                        config.optdb.equilibrium_worklist)
         if start_from is None:
             start_from = fgraph.outputs
         else:
@@ -1769,82 +1797,177 @@ class EquilibriumOptimizer(NavigatorOptimizer):
         time_opts = {}
         io_toposort_timing = []
         nb_nodes = []
+        attempt_count = {}
         for opt in self.global_optimizers + list(self.get_local_optimizers()):
             global_process_count.setdefault(opt, 0)
             time_opts.setdefault(opt, 0)
-
-        while changed and not max_use_abort:
-            process_count = {}
-            t0 = time.time()
-            changed = False
-
-            #apply global optimizers
-            for gopt in self.global_optimizers:
-                fgraph.change_tracker.reset()
-                t_opt = time.time()
-                gopt.apply(fgraph)
-                time_opts[gopt] += time.time() - t_opt
-                if fgraph.change_tracker.changed:
-                    process_count.setdefault(gopt, 0)
-                    process_count[gopt] += 1
-                    global_process_count[gopt] += 1
-                    changed = True
-                    if global_process_count[gopt] > max_use:
-                        max_use_abort = True
-                        opt_name = (getattr(gopt, "name", None)
-                                    or getattr(gopt, "__name__", ""))
-
-            global_opt_timing.append(float(time.time() - t0))
-
-            #apply local optimizer
-            topo_t0 = time.time()
-            q = deque(graph.io_toposort(fgraph.inputs, start_from))
-            io_toposort_timing.append(time.time() - topo_t0)
-
-            nb_nodes.append(len(q))
-            max_nb_nodes = max(max_nb_nodes, len(q))
-            max_use = max_nb_nodes * self.max_use_ratio
-
-            def importer(node):
-                if node is not current_node:
-                    q.append(node)
-
-            def pruner(node):
-                if node is not current_node:
-                    try:
-                        q.remove(node)
-                    except ValueError:
-                        pass
-
-            u = self.attach_updater(fgraph, importer, pruner)
-            try:
-                while q:
-                    node = q.pop()
-                    current_node = node
-
-                    for lopt in (self.local_optimizers_all +
-                                 self.local_optimizers_map.get(type(node.op), []) +
-                                 self.local_optimizers_map.get(node.op, [])):
-                        t_opt = time.time()
-                        lopt_change = self.process_node(fgraph, node, lopt)
-                        time_opts[lopt] += time.time() - t_opt
-                        if lopt_change:
-                            process_count.setdefault(lopt, 0)
-                            process_count[lopt] += 1
-                            global_process_count[lopt] += 1
-                            changed = True
-                            if global_process_count[lopt] > max_use:
-                                max_use_abort = True
-                                opt_name = (getattr(lopt, "name", None)
-                                            or getattr(lopt, "__name__", ""))
+            attempt_count.setdefault(opt, 0)
+
+        # With the worklist, a pass only visits the nodes that were
+        # imported or changed since they were last visited (`dirty`),
+        # their clients and the nodes around the variables whose clients
+        # changed. They are visited in the same order as in a full pass,
+        # and a node that gets dirty during a pass is visited during that
+        # pass if a full pass would visit it later. When such a pass
+        # changes nothing, a full pass checks that the equilibrium is
+        # reached, in case an optimizer looks further in the graph.
+        dirty = set()
+        # Nodes of the current pass, from its toposort, and their position
+        position = {}
+        # Heap of -position of the nodes to visit during the current pass
+        heap = []
+        queued = set()
+        current_pos = [-1]
+        full_pass = True
+
+        def mark(node, depth):
+            dirty.add(node)
+            if node not in queued:
+                pos = position.get(node)
+                if pos is not None and pos < current_pos[0]:
+                    heapq.heappush(heap, -pos)
+                    queued.add(node)
+            if depth:
+                for output in node.outputs:
+                    mark_clients(output, depth - 1)
+
+        def mark_clients(r, depth):
+            for c, i in r.clients:
+                if c != 'output':
+                    mark(c, depth)
+
+        def mark_variable(r):
+            if r.owner is not None:
+                mark(r.owner, 0)
+            mark_clients(r, self.worklist_depth)
+
+        def dirty_importer(node):
+            mark(node, self.worklist_depth)
+            for input in node.inputs:
+                mark_variable(input)
+
+        def dirty_pruner(node):
+            dirty.discard(node)
+            for input in node.inputs:
+                mark_variable(input)
+
+        def dirty_chin(node, i, r, new_r, reason):
+            if node != 'output':
+                mark(node, self.worklist_depth)
+            mark_variable(r)
+            mark_variable(new_r)
+
+        if use_worklist:
+            worklist_updater = Updater(dirty_importer, dirty_pruner,
+                                       dirty_chin)
+            fgraph.attach_feature(worklist_updater)
+        try:
+            while changed and not max_use_abort:
+                process_count = {}
+                t0 = time.time()
+                changed = False
+
+                #apply global optimizers
+                for gopt in self.global_optimizers:
+                    fgraph.change_tracker.reset()
+                    t_opt = time.time()
+                    gopt.apply(fgraph)
+                    time_opts[gopt] += time.time() - t_opt
+                    attempt_count[gopt] += 1
+                    if fgraph.change_tracker.changed:
+                        process_count.setdefault(gopt, 0)
+                        process_count[gopt] += 1
+                        global_process_count[gopt] += 1
+                        changed = True
+                        if global_process_count[gopt] > max_use:
+                            max_use_abort = True
+                            opt_name = (getattr(gopt, "name", None)
+                                        or getattr(gopt, "__name__", ""))
+
+                global_opt_timing.append(float(time.time() - t0))
+
+                #apply local optimizer
+                topo_t0 = time.time()
+                topo = graph.io_toposort(fgraph.inputs, start_from)
+                io_toposort_timing.append(time.time() - topo_t0)
+
+                max_nb_nodes = max(max_nb_nodes, len(topo))
+                max_use = max_nb_nodes * self.max_use_ratio
+
+                position.clear()
+                for pos, node in enumerate(topo):
+                    position[node] = pos
+                if full_pass:
+                    heap[:] = xrange(1 - len(topo), 1)
+                    queued = set(topo)
+                else:
+                    heap[:] = [-position[node] for node in dirty
+                               if node in position]
+                    heapq.heapify(heap)
+                    queued = set(topo[-pos] for pos in heap)
+                nb_nodes.append(len(heap))
+                q = []
+
+                def importer(node):
+                    if node is not current_node:
+                        q.append(node)
+
+                def pruner(node):
+                    if node is not current_node:
+                        try:
+                            q.remove(node)
+                        except ValueError:
+                            pass
+
+                u = self.attach_updater(fgraph, importer, pruner)
+                try:
+                    while q or heap:
+                        if q:
+                            node = q.pop()
+                        else:
+                            current_pos[0] = -heapq.heappop(heap)
+                            node = topo[current_pos[0]]
                             if node not in fgraph.apply_nodes:
-                                # go to next node
-                                break
-            finally:
-                self.detach_updater(fgraph, u)
-
-            loop_process_count.append(process_count)
-            loop_timing.append(float(time.time() - t0))
+                                continue
+                        current_node = node
+                        dirty.discard(node)
+
+                        for lopt in (self.local_optimizers_all +
+                                     self.local_optimizers_map.get(type(node.op), []) +
+                                     self.local_optimizers_map.get(node.op, [])):
+                            t_opt = time.time()
+                            lopt_change = self.process_node(fgraph, node, lopt)
+                            time_opts[lopt] += time.time() - t_opt
+                            attempt_count[lopt] += 1
+                            if lopt_change:
+                                process_count.setdefault(lopt, 0)
+                                process_count[lopt] += 1
+                                global_process_count[lopt] += 1
+                                changed = True
+                                if global_process_count[lopt] > max_use:
+                                    max_use_abort = True
+                                    opt_name = (getattr(lopt, "name", None)
+                                                or getattr(lopt, "__name__", ""))
+                                if node not in fgraph.apply_nodes:
+                                    # go to next node
+                                    break
+                finally:
+                    self.detach_updater(fgraph, u)
+                    current_pos[0] = -1
+
+                loop_process_count.append(process_count)
+                loop_timing.append(float(time.time() - t0))
+
+                if use_worklist:
+                    if changed:
+                        full_pass = False
+                    elif not full_pass:
+                        # Check the equilibrium with a full pass.
+                        full_pass = True
+                        changed = True
+        finally:
+            if use_worklist:
+                fgraph.remove_feature(worklist_updater)
 
         end_nb_nodes = len(fgraph.apply_nodes)
 
@@ -1856,7 +1979,8 @@ class EquilibriumOptimizer(NavigatorOptimizer):
 
         return (self, loop_timing, loop_process_count,
                 (start_nb_nodes, end_nb_nodes, max_nb_nodes),
-                global_opt_timing, nb_nodes, time_opts, io_toposort_timing)
+                global_opt_timing, nb_nodes, time_opts, io_toposort_timing,
+                attempt_count)
 
     def print_summary(self, stream=sys.stdout, level=0, depth=-1):
         name = getattr(self, 'name', None)
@@ -1871,7 +1995,8 @@ class EquilibriumOptimizer(NavigatorOptimizer):
     def print_profile(stream, prof, level=0):
         (opt, loop_timing, loop_process_count,
          (start_nb_nodes, end_nb_nodes, max_nb_nodes),
-         global_opt_timing, nb_nodes, time_opts, io_toposort_timing) = prof
+         global_opt_timing, nb_nodes, time_opts, io_toposort_timing,
+         attempt_count) = prof
 
         blanc = ('    ' * level)
         print >> stream, blanc, "EquilibriumOptimizer",
@@ -1915,31 +2040,35 @@ class EquilibriumOptimizer(NavigatorOptimizer):
                 process_count[o] += v
         for opt, count in process_count.iteritems():
             if count > 0:
-                count_opt.append((time_opts[opt], count, opt))
+                count_opt.append((time_opts[opt], count,
+                                  attempt_count.get(opt, 0), opt))
             else:
-                not_used.append((time_opts[opt], opt))
+                not_used.append((time_opts[opt],
+                                 attempt_count.get(opt, 0), opt))
                 not_used_time += time_opts[opt]
 
         if count_opt:
             print >> stream, blanc, \
-                    '  times - times applied - name:'
+                    '  times - times applied - times tried - name:'
             count_opt.sort()
-            for (t, count, opt) in count_opt[::-1]:
-                print >> stream, blanc, '  %.3fs - %d - %s' % (
-                    t, count, opt)
+            for (t, count, tried, opt) in count_opt[::-1]:
+                print >> stream, blanc, '  %.3fs - %d - %d - %s' % (
+                    t, count, tried, opt)
             print >> stream, blanc, '  %.3fs - in %d optimization that where not used (display only those with a runtime > 0)' % (
                 not_used_time, len(not_used))
             not_used.sort()
-            for (t, opt) in not_used[::-1]:
+            for (t, tried, opt) in not_used[::-1]:
                 if t > 0:
                     # Skip opt that have 0 times, they probably wasn't even tried.
-                    print >> stream, blanc + "  ", '  %.3fs - %s' % (t, opt)
+                    print >> stream, blanc + "  ", '  %.3fs - %d - %s' % (
+                        t, tried, opt)
             print >> stream
 
     @staticmethod
     def merge_profile(prof1, prof2):
         #(opt, loop_timing, loop_process_count, max_nb_nodes,
-        # global_opt_timing, nb_nodes, time_opts, io_toposort_timing) = prof1
+        # global_opt_timing, nb_nodes, time_opts, io_toposort_timing,
+        # attempt_count) = prof1
 
         local_optimizers = set(prof1[0].get_local_optimizers()).union(
             prof2[0].get_local_optimizers())
@@ -1985,6 +2114,10 @@ class EquilibriumOptimizer(NavigatorOptimizer):
 
         io_toposort_timing = merge_list(prof1[7], prof2[7])
 
+        attempt_count = prof1[8].copy()
+        for opt, count in prof2[8].iteritems():
+            attempt_count[opt] = attempt_count.get(opt, 0) + count
+
         assert (len(loop_timing) == len(global_opt_timing) ==
                 len(io_toposort_timing) == len(nb_nodes))
         assert len(loop_timing) == max(len(prof1[1]), len(prof2[1]))
@@ -1995,7 +2128,8 @@ class EquilibriumOptimizer(NavigatorOptimizer):
                 global_opt_timing,
                 nb_nodes,
                 time_opts,
-                io_toposort_timing)
+                io_toposort_timing,
+                attempt_count)
 
 #################
 ### Utilities ###
@@ -0,0 +1,277 @@
+"""
+Persistent on-disk cache of optimized graphs.
+
+When `config.cache_optimizations` is True, `FunctionMaker` looks up the
+graph it is about to optimize in this cache before running the optimizer.
+Entries are keyed by a structural hash of the unoptimized `FunctionGraph`
+together with a description of the optimizer and of the Theano config, so
+that the same model graph built in another process (with different Variable
+instances) maps to the same entry.
+
+Each entry is a pickled `(inputs, outputs)` pair stored in its own file in
+`config.compiledir/optimized_graphs`. Readers do not take the compile lock:
+entries are written to a temporary file and atomically renamed into place.
+Writers and the LRU eviction (based on the file modification time, which is
+updated on every hit) lock the `lock_dir` subdirectory of the cache, so they
+do not wait for the compilation of C modules.
+"""
+import cPickle
+import logging
+import os
+import tempfile
+
+import numpy
+
+import theano
+from theano import config
+from theano.gof import compilelock, graph
+from theano.gof.cc import hash_from_code
+
+_logger = logging.getLogger("theano.gof.optcache")
+
+# Bump this when the format of the entries or of the keys changes.
+_version = 1
+
+
+def _digest(obj):
+    """Return a hash of `obj` that is stable across processes.
+
+    :raise: any pickling error if `obj` can not be pickled.
+    """
+    return hash_from_code(cPickle.dumps(obj, -1))
+
+
+def constant_digest(constant):
+    """Return a process-independent hash of a Constant (type and data)."""
+    data = constant.data
+    if isinstance(data, numpy.ndarray):
+        if not data.flags["C_CONTIGUOUS"]:
+            data = numpy.ascontiguousarray(data)
+        data_hash = hash_from_code(hash_from_code(data) +
+                                   str(data.shape) + str(data.dtype))
+    else:
+        data_hash = _digest(data)
+    return hash_from_code(_digest(constant.type) + data_hash)
+
+
+def fgraph_signature(fgraph, mutable=None):
+    """Return a structural hash of `fgraph`.
+
+    The hash only depends on the ops, types and constants of the graph and on
+    the position of the inputs, not on the identity of the Variable
+    instances. Two graphs that would be optimized the same way have the same
+    signature, whichever process built them.
+
+    :param mutable: optional list of booleans, one per input, telling
+        whether that input may be destroyed by inplace operations (this
+        changes what the optimizer is allowed to do).
+
+    :return: a string, or None if some op, type or constant of the graph
+        can not be hashed (it can not be pickled).
+    """
+    if mutable is None:
+        mutable = [False] * len(fgraph.inputs)
+    var_hash = {}
+    op_hash = {}
+    parts = []
+    try:
+        for i, (inp, mut) in enumerate(zip(fgraph.inputs, mutable)):
+            h = hash_from_code('input%i|%s|%s' % (i, _digest(inp.type),
+                                                  bool(mut)))
+            var_hash[inp] = h
+            parts.append(h)
+        for node in fgraph.toposort():
+            if node.op not in op_hash:
+                op_hash[node.op] = hash_from_code(
+                    '%s.%s|%s' % (type(node.op).__module__,
+                                  type(node.op).__name__,
+                                  _digest(node.op)))
+            in_hashes = []
+            for inp in node.inputs:
+                if inp not in var_hash:
+                    # Only constants can be orphans of a FunctionGraph.
+                    var_hash[inp] = constant_digest(inp)
+                in_hashes.append(var_hash[inp])
+            node_hash = hash_from_code(op_hash[node.op] + '(' +
+                                       ','.join(in_hashes) + ')')
+            for j, out in enumerate(node.outputs):
+                var_hash[out] = hash_from_code('%s[%i]|%s' % (
+                    node_hash, j, _digest(out.type)))
+        for out in fgraph.outputs:
+            if out not in var_hash:
+                var_hash[out] = constant_digest(out)
+            parts.append('out:' + var_hash[out])
+    except Exception, e:
+        _logger.debug('Can not compute the signature of the graph: %s', e)
+        return None
+    parts.append('nodes:%i' % len(fgraph.apply_nodes))
+    return hash_from_code('\n'.join(parts))
+
+
+class OptimizationCache(object):
+    """
+    Directory of optimized graphs, one pickled file per entry.
+
+    :param dirname: directory where the entries are stored. It is created
+        if needed.
+
+    :param max_entries: maximum number of entries kept on disk. When more
+        entries are stored, the least recently used ones are deleted.
+    """
+
+    def __init__(self, dirname, max_entries=None):
+        self.dirname = dirname
+        if max_entries is None:
+            max_entries = config.cache_optimizations_max_entries
+        self.max_entries = max_entries
+
+    def key(self, fgraph, optimizer_key, mutable=None):
+        """Return the key of `fgraph` optimized by `optimizer_key`.
+
+        Return None if the graph can not be cached.
+        """
+        sig = fgraph_signature(fgraph, mutable)
+        if sig is None or optimizer_key is None:
+            return None
+        return hash_from_code('\n'.join([
+            'version:%s' % _version,
+            'theano:%s' % theano.__version__,
+            'config:%s' % theano.configparser.get_config_md5(),
+            'optimizer:%s' % optimizer_key,
+            'graph:%s' % sig]))
+
+    def _lock_dir(self):
+        # lock() creates the parent directory if needed.
+        return os.path.join(self.dirname, 'lock_dir')
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key + '.pkl')
+
+    def entries(self):
+        """Return the list of paths of the entries currently on disk."""
+        if not os.path.isdir(self.dirname):
+            return []
+        return [os.path.join(self.dirname, name)
+                for name in os.listdir(self.dirname)
+                if name.endswith('.pkl')]
+
+    def load(self, key):
+        """Return the `(inputs, outputs)` stored under `key`, or None.
+
+        This does not take the compile lock: entries are only ever replaced
+        atomically.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            f = open(path, 'rb')
+            try:
+                entry = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            # Truncated file, or unpickling of some op failed (e.g. its
+            # module can not be imported anymore). Treat it as a miss, the
+            # entry will be overwritten by the next store.
+            _logger.warning('Could not load optimized graph %s: %s', path, e)
+            return None
+        try:
+            # Mark the entry as recently used for the LRU eviction.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, inputs, outputs):
+        """Store a copy of the graph between `inputs` and `outputs`.
+
+        The inputs are stored as new Variables of the same types, without
+        their values: they are matched by position when the graph is
+        restored (see `restore_graph`), and the value of a shared variable
+        must not be written to disk.
+
+        Return True if the entry was written.
+        """
+        equiv = graph.clone_get_equiv(
+            inputs, outputs,
+            memo=dict((i, i.type(name=i.name)) for i in inputs))
+        cp_inputs = [equiv[i] for i in inputs]
+        cp_outputs = [equiv[o] for o in outputs]
+        try:
+            data = cPickle.dumps((cp_inputs, cp_outputs), -1)
+        except Exception, e:
+            _logger.debug('Can not pickle the optimized graph: %s', e)
+            return False
+        with compilelock.dir_lock_ctx(self._lock_dir()):
+            fd, tmp = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp, self._path(key))
+            self.evict()
+        return True
+
+    def evict(self):
+        """Delete the least recently used entries above `max_entries`."""
+        paths = self.entries()
+        if len(paths) <= self.max_entries:
+            return
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append((os.path.getmtime(path), path))
+            except OSError:
+                # Deleted by someone else.
+                pass
+        mtimes.sort()
+        for _, path in mtimes[:len(mtimes) - self.max_entries]:
+            _logger.debug('Evicting optimized graph %s', path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Delete all the entries."""
+        if not os.path.isdir(self.dirname):
+            return
+        with compilelock.dir_lock_ctx(self._lock_dir()):
+            for path in self.entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def get_optimization_cache():
+    """Return the cache of optimized graphs of the current compiledir."""
+    dirname = os.path.join(config.compiledir, 'optimized_graphs')
+    cache = getattr(get_optimization_cache, 'cache', None)
+    if cache is None or cache.dirname != dirname:
+        cache = OptimizationCache(dirname)
+        get_optimization_cache.cache = cache
+    return cache
+
+
+def restore_graph(fgraph, inputs, outputs):
+    """Make `fgraph` compute `outputs` (a graph rooted at `inputs`).
+
+    `inputs` are matched by position with `fgraph.inputs`. The outputs of
+    `fgraph` are replaced in place, so the features already attached to
+    `fgraph` (and the Variable instances of its inputs) are kept.
+    """
+    assert len(inputs) == len(fgraph.inputs)
+    assert len(outputs) == len(fgraph.outputs)
+    equiv = graph.clone_get_equiv(inputs, outputs,
+                                  copy_inputs_and_orphans=False,
+                                  memo=dict(zip(inputs, fgraph.inputs)))
+    for i, out in enumerate(outputs):
+        fgraph.change_input('output', i, equiv[out],
+                            reason='optimization_cache')
+    if (not hasattr(fgraph, 'destroy_handler') and
+            any(getattr(node.op, 'destroy_map', None)
+                for node in fgraph.apply_nodes)):
+        fgraph.attach_feature(theano.gof.DestroyHandler())
+    fgraph.validate()
@@ -1,3 +1,7 @@
+import heapq
+
+import numpy
+
 from theano.gof.graph import list_of_nodes
 from theano.gof.python25 import any, defaultdict
 from theano.compat import cmp
@@ -213,3 +217,173 @@ def key_to_cmp(key):
     def key_cmp(a, b):
         return cmp(key(a), key(b))
     return key_cmp
+
+
+# Length assumed for the dimensions of a variable whose length is not known
+# at compile time, when estimating its size.
+unknown_dim_length = 100
+
+
+def estimate_var_size(var, shape_of=None):
+    """ Estimate the size, in bytes, of the value of a variable
+
+    inputs:
+        var - a variable
+        shape_of - a dict mapping variables to their symbolic shape (like
+                   ShapeFeature.shape_of). Constant shape elements are used,
+                   the other dimensions count as `unknown_dim_length`.
+
+    outputs:
+        the estimated size, 0 if the type of var has no dtype or ndim.
+    """
+    dtype = getattr(var.type, 'dtype', None)
+    ndim = getattr(var.type, 'ndim', None)
+    if dtype is None or ndim is None:
+        return 0
+    try:
+        size = numpy.dtype(dtype).itemsize
+    except TypeError:
+        return 0
+    shape = None
+    if shape_of is not None:
+        shape = shape_of.get(var)
+    broadcastable = getattr(var.type, 'broadcastable', (False,) * ndim)
+    for i in xrange(ndim):
+        if broadcastable[i]:
+            continue
+        data = getattr(shape and shape[i], 'data', None)
+        if data is not None:
+            size *= int(data)
+        else:
+            size *= unknown_dim_length
+    return size
+
+
+def alias_roots(nodes):
+    """ Find the variable whose memory is used by each aliased output
+
+    inputs:
+        nodes - apply nodes, in topological order
+
+    outputs:
+        a dict mapping each output that is a view of an input (view_map) or
+        that is computed inplace in an input (destroy_map) to the variable
+        that owns its memory. The other variables are not in the dict.
+    """
+    root_of = {}
+    for node in nodes:
+        dmap = getattr(node.op, 'destroy_map', {})
+        vmap = getattr(node.op, 'view_map', {})
+        for idx, out in enumerate(node.outputs):
+            in_idx = dmap.get(idx) or vmap.get(idx)
+            if in_idx:
+                ipt = node.inputs[in_idx[0]]
+                root_of[out] = root_of.get(ipt, ipt)
+    return root_of
+
+
+def memory_schedule(fgraph, var_size=None):
+    """ Order the nodes of a FunctionGraph to lower its peak memory usage
+
+    This is a greedy list scheduler. Among the nodes that can be executed,
+    it picks the one that increases the memory in use the least: the size
+    of the outputs it allocates minus the size of the variables that are
+    not needed anymore once it is executed (as when the garbage collection
+    of the VM is enabled).
+
+    Outputs that are views of an input (view_map) or that are computed
+    inplace (destroy_map) allocate nothing, and the memory they share with
+    their input is freed only once none of them is used anymore. Inputs,
+    constants and outputs of the graph are never freed. Ties are broken by
+    the order of fgraph.toposort(), and the constraints of
+    fgraph.orderings() (like the ones of the DestroyHandler) are respected.
+
+    inputs:
+        fgraph - the FunctionGraph to schedule
+        var_size - a function returning the estimated size of a variable.
+                   By default, estimate_var_size, with the shapes of the
+                   ShapeFeature of fgraph if it has one.
+
+    outputs:
+        a list of the apply nodes of fgraph
+    """
+    if var_size is None:
+        shape_feature = getattr(fgraph, 'shape_feature', None)
+        shape_of = getattr(shape_feature, 'shape_of', None)
+        var_size = lambda var: estimate_var_size(var, shape_of)
+
+    order = fgraph.toposort()
+    position = dict((node, i) for i, node in enumerate(order))
+    orderings = fgraph.orderings()
+    graph_outputs = set(fgraph.outputs)
+
+    # Number of prerequisites of each node that are not executed yet,
+    # and nodes that wait for each node.
+    n_missing = {}
+    waiting = defaultdict(list)
+    for node in order:
+        prereqs = set(i.owner for i in node.inputs if i.owner is not None)
+        prereqs.update(orderings.get(node, ()))
+        n_missing[node] = len(prereqs)
+        for p in prereqs:
+            waiting[p].append(node)
+
+    root_of = alias_roots(order)
+    root = lambda var: root_of.get(var, var)
+
+    # For each root, the nodes that use it (through any of the variables
+    # that share its memory), and its size if it can be freed.
+    users = defaultdict(set)
+    freeable = {}
+    for node in order:
+        for ipt in node.inputs:
+            users[root(ipt)].add(node)
+        for out in node.outputs:
+            if out not in root_of:
+                freeable[out] = var_size(out)
+    for var in graph_outputs:
+        freeable.pop(root(var), None)
+    pending = dict((r, len(nodes)) for r, nodes in users.iteritems())
+
+    def score(node):
+        # Memory allocated by node, minus the memory freed after it.
+        rval = 0
+        for out in node.outputs:
+            if out in freeable:
+                rval += freeable[out]
+                if not pending.get(out):
+                    rval -= freeable[out]
+        for r in set(root(ipt) for ipt in node.inputs):
+            if r in freeable and pending[r] == 1:
+                rval -= freeable[r]
+        return rval
+
+    ready = [(score(node), position[node], node)
+             for node in order if n_missing[node] == 0]
+    heapq.heapify(ready)
+    done = set()
+    rval = []
+    while ready:
+        s, pos, node = heapq.heappop(ready)
+        if node in done:
+            continue
+        current = score(node)
+        if current != s:
+            heapq.heappush(ready, (current, pos, node))
+            continue
+        done.add(node)
+        rval.append(node)
+        for r in set(root(ipt) for ipt in node.inputs):
+            pending[r] -= 1
+            if pending[r] == 1 and r in freeable:
+                # The last user of r would now free it.
+                for user in users[r]:
+                    if user not in done and n_missing[user] == 0:
+                        heapq.heappush(ready,
+                                       (score(user), position[user], user))
+        for w in waiting[node]:
+            n_missing[w] -= 1
+            if n_missing[w] == 0:
+                heapq.heappush(ready, (score(w), position[w], w))
+    assert len(rval) == len(order)
+    return rval
@@ -4,10 +4,18 @@ But this one tests a current behavior that isn't good: the c_code isn't
 deterministic based on the input type and the op.
 
 """
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import threading
+
 import numpy
+from nose.plugins.skip import SkipTest
 
 import theano
-from theano.gof.cmodule import GCC_compiler
+from theano.gof import cmodule
+from theano.gof.cmodule import GCC_compiler, ModuleCache
 
 
 class MyOp(theano.compile.ops.DeepCopyOp):
@@ -66,3 +74,220 @@ def test_flag_detection():
     # but was not detected because that path is not usually taken,
     # so we test it here directly.
     GCC_compiler.try_flags(["-lblas"])
+
+
+def test_module_from_keys():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    try:
+        x = theano.tensor.dvector('x')
+        linkers = []
+        for fn in [theano.tensor.exp, theano.tensor.log, theano.tensor.tanh]:
+            out = fn(x)
+            fgraph = theano.gof.FunctionGraph([x], [out])
+            linkers.append(theano.gof.CLinker().accept(fgraph))
+        keys_and_linkers = [(lnk.cmodule_key(), lnk) for lnk in linkers]
+        # The same key twice must give the same module.
+        keys_and_linkers.append(keys_and_linkers[0])
+
+        cache = ModuleCache(dirname)
+        modules = cache.module_from_keys(keys_and_linkers, n_workers=2)
+        assert cache.stats[2] == 3
+        assert len(set(modules)) == 3
+        assert modules[0] is modules[3]
+
+        # Another cache on the same directory finds them on disk.
+        cache2 = ModuleCache(dirname)
+        modules2 = cache2.module_from_keys(keys_and_linkers, n_workers=2)
+        assert cache2.stats[2] == 0
+        assert [m.__file__ for m in modules] == [m.__file__ for m in modules2]
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_module_from_keys_threads():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    try:
+        x = theano.tensor.dvector('x')
+        keys_and_linkers = []
+        for fn in [theano.tensor.exp, theano.tensor.log, theano.tensor.tanh]:
+            fgraph = theano.gof.FunctionGraph([x], [fn(x)])
+            lnk = theano.gof.CLinker().accept(fgraph)
+            keys_and_linkers.append((lnk.cmodule_key(), lnk))
+        cache = ModuleCache(dirname)
+
+        # The module locks held by a thread are not held by the others.
+        held = []
+        with cache._module_lock('a_module'):
+            thread = threading.Thread(
+                target=lambda: held.append(cache._held_module_locks()))
+            thread.start()
+            thread.join()
+            assert cache._held_module_locks() == set(['a_module'])
+        assert held == [set()]
+
+        # Threads that need the same modules at the same time.
+        results = []
+
+        def worker(i):
+            # Each thread asks for the modules in a different order.
+            try:
+                modules = cache.module_from_keys(
+                    keys_and_linkers[i:] + keys_and_linkers[:i],
+                    n_workers=1)
+                results.append(modules[len(modules) - i:] +
+                               modules[:len(modules) - i])
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert cache.stats[2] == 3
+        assert len(results) == 3
+        for modules in results:
+            assert modules == results[0], modules
+    finally:
+        shutil.rmtree(dirname)
+
+
+class FailingLinker(object):
+    def get_src_code(self):
+        return 'this does not compile'
+
+    def compile_cmodule(self, location):
+        raise ValueError('compilation failed')
+
+
+def test_module_from_keys_error():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    try:
+        x = theano.tensor.dvector('x')
+        fgraph = theano.gof.FunctionGraph([x], [theano.tensor.exp(x)])
+        lnk = theano.gof.CLinker().accept(fgraph)
+        fgraph = theano.gof.FunctionGraph([x], [theano.tensor.log(x)])
+        failing_key = theano.gof.CLinker().accept(fgraph).cmodule_key()
+        cache = ModuleCache(dirname)
+        try:
+            cache.module_from_keys([(failing_key, FailingLinker()),
+                                    (lnk.cmodule_key(), lnk)], n_workers=2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The compilation error was not raised')
+        # The module that compiled is in the cache.
+        assert cache.stats[2] == 1
+        assert cache.module_from_key(lnk.cmodule_key(), lnk) is not None
+        assert cache.stats[2] == 1
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_module_index():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    try:
+        x = theano.tensor.dvector('x')
+        keys_and_linkers = []
+        for fn in [theano.tensor.exp, theano.tensor.log]:
+            fgraph = theano.gof.FunctionGraph([x], [fn(x)])
+            lnk = theano.gof.CLinker().accept(fgraph)
+            keys_and_linkers.append((lnk.cmodule_key(), lnk))
+        cache = ModuleCache(dirname)
+        modules = cache.module_from_keys(keys_and_linkers, n_workers=1)
+        index = cache._read_index()
+        assert len(index) == 2
+
+        # The key.pkl files are only loaded when needed.
+        cache2 = ModuleCache(dirname)
+        assert not cache2.loaded_key_pkl
+        assert len(cache2._index) == 2
+        key, lnk = keys_and_linkers[0]
+        assert cache2.module_from_key(key, lnk).__file__ == modules[0].__file__
+        assert cache2.stats[2] == 0
+        assert len(cache2.loaded_key_pkl) == 1
+
+        # Delayed entries are only written with the next update.
+        module_hash, entry = dict(cache2._read_index()).items()[0]
+        new_entry = entry[:2] + (frozenset(['digest']),) + entry[3:]
+        cache2._update_index({module_hash: new_entry}, [], delay=True)
+        assert 'digest' in cache2._index[module_hash][2]
+        assert dict(cache2._read_index())[module_hash] == entry
+        cache2._update_index({}, [])
+        assert not cache2._index_pending
+        digests = dict(cache2._read_index())[module_hash][2]
+        assert digests == entry[2] | frozenset(['digest'])
+
+        # Deleted modules are removed from the index.
+        shutil.rmtree(os.path.dirname(modules[1].__file__))
+        cache3 = ModuleCache(dirname)
+        assert len(cache3._read_index()) == 1
+        assert len(cache3._index) == 1
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_precompiled_header():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    if (not theano.config.cmodule.precompiled_headers or
+            cmodule.gcc_llvm()):
+        raise SkipTest("Precompiled headers are not used.")
+    x = theano.tensor.dvector('x')
+    fgraph = theano.gof.FunctionGraph([x], [theano.tensor.exp(x)])
+    lnk = theano.gof.CLinker().accept(fgraph)
+    include_dirs = lnk.header_dirs() + cmodule.std_include_dirs()
+    header = cmodule.get_precompiled_header(
+        lnk.get_src_code(), lnk.compile_args(), include_dirs)
+    assert header is not None
+    assert os.path.exists(header + '.gch')
+    # Only the system headers at the beginning of the code are precompiled.
+    assert cmodule.get_precompiled_header(
+        'int f() { return 0; }\n#include <Python.h>\n#include <vector>\n',
+        lnk.compile_args(), include_dirs) is None
+
+
+def test_load_combined():
+    if not theano.config.cxx:
+        raise SkipTest("G++ not available, so we need to skip this test.")
+    if distutils.spawn.find_executable('objcopy') is None:
+        raise SkipTest("objcopy not available.")
+    dirname = tempfile.mkdtemp(dir=theano.config.compiledir)
+    default = theano.config.cmodule.combine_modules
+    try:
+        theano.config.cmodule.combine_modules = True
+        x = theano.tensor.dvector('x')
+        keys_and_linkers = []
+        for fn in [theano.tensor.exp, theano.tensor.log]:
+            fgraph = theano.gof.FunctionGraph([x], [fn(x)])
+            lnk = theano.gof.CLinker().accept(fgraph)
+            keys_and_linkers.append((lnk.cmodule_key(), lnk))
+        cache = ModuleCache(dirname)
+        cache.module_from_keys(keys_and_linkers, n_workers=1)
+
+        cache2 = ModuleCache(dirname)
+        entries = [cache2.find_entry(key) for key, lnk in keys_and_linkers]
+        assert cache2.load_combined(entries) == 2
+        for (key, lnk), entry in zip(keys_and_linkers, entries):
+            module = cache2.module_from_key(key, lnk)
+            assert os.path.basename(module.__file__) == os.path.basename(
+                entry)
+            assert os.path.dirname(module.__file__) != os.path.dirname(entry)
+            assert hasattr(module, 'instantiate')
+        # The combined library is reused.
+        cache3 = ModuleCache(dirname)
+        assert cache3.load_combined(
+            [cache3.find_entry(key) for key, lnk in keys_and_linkers]) == 2
+        assert len(os.listdir(os.path.join(
+            dirname, ModuleCache.combined_dirname))) == 1
+    finally:
+        theano.config.cmodule.combine_modules = default
+        shutil.rmtree(dirname)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from theano.gof import compilelock
+
+
+def test_lock_non_blocking():
+    dirname = tempfile.mkdtemp()
+    try:
+        lock_dir = os.path.join(dirname, 'lock_dir')
+        assert compilelock.lock(lock_dir, min_wait=0.1)
+        try:
+            # The lock is owned by a live process (this one).
+            assert not compilelock.lock(lock_dir, min_wait=0.1,
+                                        blocking=False)
+        finally:
+            compilelock.remove_lock(lock_dir)
+        assert compilelock.lock(lock_dir, min_wait=0.1, blocking=False)
+        compilelock.remove_lock(lock_dir)
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_lock_wait_time():
+    dirname = tempfile.mkdtemp()
+    try:
+        lock_dir = os.path.join(dirname, 'lock_dir')
+        compilelock.lock(lock_dir, min_wait=0.1)
+
+        def release():
+            time.sleep(0.3)
+            compilelock.remove_lock(lock_dir)
+        thread = threading.Thread(target=release)
+        thread.start()
+        wait_time = compilelock.lock_wait_time
+        wait_count = compilelock.lock_wait_count
+        with compilelock.dir_lock_ctx(lock_dir, min_wait=0.1):
+            pass
+        thread.join()
+        assert compilelock.lock_wait_count == wait_count + 1
+        assert compilelock.lock_wait_time - wait_time >= 0.2
+    finally:
+        shutil.rmtree(dirname)
@@ -1,6 +1,8 @@
 
 import unittest
 
+import numpy
+
 from theano.gof.type import Type
 from theano.gof import graph
 from theano.gof.graph import Variable, Apply
@@ -426,3 +428,69 @@ def test_value_repl_2():
     consistent(g)
     g.replace(sy, transpose_view(MyConstant("abc")))
     consistent(g)
+
+
+def test_incremental_toposort():
+    # Compare IncrementalToposort with a cycle detection from scratch on a
+    # random sequence of edge insertions and removals.
+    rng = numpy.random.RandomState(42)
+    n = 12
+    nodes = [object() for i in xrange(n)]
+    toposort = destroyhandler.IncrementalToposort()
+    for node in nodes:
+        toposort.add_node(node)
+    edges = []
+
+    def has_cycle():
+        counts = dict((node, 0) for node in nodes)
+        for u, v in edges:
+            counts[v] += 1
+        todo = [node for node in nodes if not counts[node]]
+        visited = 0
+        while todo:
+            node = todo.pop()
+            visited += 1
+            for u, v in edges:
+                if u is node:
+                    counts[v] -= 1
+                    if not counts[v]:
+                        todo.append(v)
+        return visited != n
+
+    for step in xrange(400):
+        if edges and rng.rand() < 0.4:
+            u, v = edges.pop(rng.randint(len(edges)))
+            toposort.remove_edge(u, v)
+        else:
+            u, v = nodes[rng.randint(n)], nodes[rng.randint(n)]
+            edges.append((u, v))
+            toposort.add_edge(u, v)
+        assert toposort.has_cycle() == has_cycle()
+        if not toposort.pending:
+            for u, v in edges:
+                assert toposort.ord[u] < toposort.ord[v]
+
+
+def test_incremental_cycle_detection():
+    # The cycles found by validate() are those found from scratch.
+    x, y, z = inputs()
+    e1 = add(x, y)
+    e2 = add(y, z)
+    e3 = add(x, z)
+    g = Env([x, y, z], [dot(dot(e1, e2), dot(e3, x))])
+    dh = g.destroy_handler
+    e4 = add_in_place(x, z)
+    # The third replacement introduces a cycle, the last one removes it.
+    for old, new in [(e1, add_in_place(y, x)),
+                     (e2, add_in_place(z, y)),
+                     (e3, e4),
+                     (e4, add(x, z))]:
+        g.replace(old, new)
+        expected = destroyhandler._contains_cycle(g, dh.orderings(g))
+        try:
+            g.validate()
+            assert not expected
+        except InconsistencyError:
+            assert expected
+        assert dh.toposort is not None
+    consistent(g)
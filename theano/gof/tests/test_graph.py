@@ -3,14 +3,17 @@ import unittest
 import numpy
 from itertools import count
 
+from nose.plugins.skip import SkipTest
+
 
 from theano import (
       clone, sparse,
       shared, tensor)
+from theano.gof import graph
 from theano.gof.graph import (
         Node, Apply, Constant,
-        as_string, clone, general_toposort, inputs, io_toposort,
-        is_same_graph, Variable)
+        ancestors, as_string, clone, clone_get_equiv, general_toposort,
+        inputs, io_toposort, is_same_graph, Variable)
 from theano.gof.op import Op
 from theano.gof.type import Type
 from theano.tensor.var import TensorVariable
@@ -228,6 +231,70 @@ class TestToposort:
         all = io_toposort([], o0.outputs)
         assert all == [o0]
 
+    def test_cycle(self):
+        r1 = MyVariable(1)
+        o = MyOp.make_node(r1, r1)
+        # Make o depend on itself.
+        o.inputs[1] = o.outputs[0]
+        try:
+            general_toposort(o.outputs, prenode)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the cycle was not detected')
+
+    def test_non_deterministic_deps(self):
+        r1, r2 = MyVariable(1), MyVariable(2)
+        o = MyOp.make_node(r1, r2)
+        try:
+            general_toposort(o.outputs, lambda obj: set(prenode(obj) or []))
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('sets of dependencies were accepted')
+
+
+class TestCTraversals:
+    """Compare the C implementation of the traversals to the Python one"""
+
+    def setUp(self):
+        if graph.c_traversals is None:
+            raise SkipTest('The C graph traversals are not available')
+        self.c_traversals = graph.c_traversals
+
+    def tearDown(self):
+        graph.c_traversals = self.c_traversals
+
+    def check(self, fn):
+        c_rval = fn()
+        graph.c_traversals = None
+        try:
+            py_rval = fn()
+        finally:
+            graph.c_traversals = self.c_traversals
+        assert c_rval == py_rval
+
+    def test_same_results(self):
+        x, y = tensor.matrix('x'), tensor.vector('y')
+        h = x
+        for i in range(10):
+            h = tensor.tanh(tensor.dot(h, x) + y * i) + h[0].sum()
+        outs = [h, h.sum() * 2, x + 1, y]
+        mid = h.owner.inputs[0]
+        # h is computed after x + 1.
+        orderings = {h.owner: [outs[2].owner]}
+        self.check(lambda: io_toposort([x, y], outs))
+        self.check(lambda: io_toposort([x], outs))
+        self.check(lambda: io_toposort([x, y, mid], outs))
+        self.check(lambda: io_toposort(set([x, y, mid]), outs))
+        self.check(lambda: io_toposort(frozenset([x, y]), outs))
+        self.check(lambda: io_toposort([x, y], outs, orderings))
+        self.check(lambda: general_toposort(outs, prenode))
+        self.check(lambda: ancestors(outs))
+        self.check(lambda: ancestors(outs, [mid]))
+        self.check(lambda: inputs(outs))
+        self.check(lambda: len(clone_get_equiv([x, y], outs)))
+
 
 #################
 # is_same_graph #
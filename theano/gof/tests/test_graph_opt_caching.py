@@ -1,17 +1,14 @@
-import unittest, os
+import os
 import numpy
-import cPickle
-from theano.compat.python2x import DictMixin, OrderedDict
 floatX = 'float32'
 import theano
 import theano.tensor as T
-
+from theano.gof import optcache
 
 
 def test_graph_opt_caching():
-    opt_db_file = theano.config.compiledir+'/optimized_graphs.pkl'
-    os.system('rm %s'%opt_db_file)
-    
+    optcache.get_optimization_cache().clear()
+
     mode = theano.config.mode
     if mode in ["DEBUG_MODE", "DebugMode"]:
         mode = "FAST_RUN"
@@ -23,20 +20,109 @@ def test_graph_opt_caching():
         c = theano.shared(numpy.ones((10, 10), dtype=floatX))
         d = theano.shared(numpy.ones((10, 10), dtype=floatX))
         e = T.sum(T.sum(T.sum(a ** 2 + b) + c) + d)
-        f1 = theano.function([a, b], e, mode=mode)
+        prof1 = theano.compile.ProfileStats(atexit_print=False)
+        f1 = theano.function([a, b], e, mode=mode, profile=prof1)
+        assert prof1.optimizer_cache_miss == 1
+        assert prof1.optimizer_cache_hit == 0
 
         m = T.fmatrix('x1')
         n = T.fmatrix('x2')
-        p = theano.shared(numpy.ones((10, 10), dtype=floatX))
-        q = theano.shared(numpy.ones((10, 10), dtype=floatX))
+        p = theano.shared(numpy.ones((10, 10), dtype=floatX) * 2)
+        q = theano.shared(numpy.ones((10, 10), dtype=floatX) * 3)
         j = T.sum(T.sum(T.sum(m ** 2 + n) + p) + q)
-        f2 = theano.function([m, n], j, mode=mode)
-        
+        prof2 = theano.compile.ProfileStats(atexit_print=False)
+        f2 = theano.function([m, n], j, mode=mode, profile=prof2)
+        assert prof2.optimizer_cache_hit == 1
+        assert prof2.optimizer_cache_miss == 0
+
         in1 = numpy.ones((10, 10), dtype=floatX)
         in2 = numpy.ones((10, 10), dtype=floatX)
-        assert f1(in1, in2) == f2(in1, in2)
+        assert numpy.allclose(f1(in1, in2), 2010100)
+        # f2 must use its own shared variables, not those of f1.
+        assert numpy.allclose(f2(in1, in2), 2020300)
     finally:
         theano.config.cache_optimizations = default
-        
+
+
+def test_graph_opt_caching_different_graphs():
+    optcache.get_optimization_cache().clear()
+
+    default = theano.config.cache_optimizations
+    try:
+        theano.config.cache_optimizations = True
+        x = T.dvector('x')
+        f1 = theano.function([x], T.exp(x) + 1, mode='FAST_RUN')
+        prof = theano.compile.ProfileStats(atexit_print=False)
+        f2 = theano.function([x], T.exp(x) + 2, mode='FAST_RUN',
+                             profile=prof)
+        assert prof.optimizer_cache_miss == 1
+        val = numpy.arange(3.)
+        assert numpy.allclose(f1(val), numpy.exp(val) + 1)
+        assert numpy.allclose(f2(val), numpy.exp(val) + 2)
+
+        # Mutable inputs allow other (inplace) optimizations.
+        prof = theano.compile.ProfileStats(atexit_print=False)
+        theano.function([theano.Param(x, mutable=True)], T.exp(x) + 2,
+                        mode='FAST_RUN', profile=prof)
+        assert prof.optimizer_cache_miss == 1
+    finally:
+        theano.config.cache_optimizations = default
+
+
+def test_fgraph_signature():
+    def make(name):
+        x = T.dmatrix(name)
+        y = T.constant(numpy.arange(3.))
+        return theano.gof.FunctionGraph([x], [T.dot(x, y).sum() * 2])
+
+    sig = optcache.fgraph_signature(make('x'))
+    assert sig is not None
+    assert sig == optcache.fgraph_signature(make('z'))
+
+    x = T.dmatrix('x')
+    y = T.constant(numpy.arange(3.) + 1)
+    other = theano.gof.FunctionGraph([x], [T.dot(x, y).sum() * 2])
+    assert sig != optcache.fgraph_signature(other)
+
+
+def test_lru_eviction():
+    cache = optcache.OptimizationCache(
+        os.path.join(theano.config.compiledir, 'tmp_test_optcache'),
+        max_entries=2)
+    try:
+        x = T.dvector('x')
+        for i in range(4):
+            cache.store('key%d' % i, [x], [x + i])
+            path = cache._path('key%d' % i)
+            os.utime(path, (i, i))
+        assert sorted(os.path.basename(p) for p in cache.entries()) == [
+            'key2.pkl', 'key3.pkl']
+        inputs, outputs = cache.load('key3')
+        assert len(inputs) == 1 and len(outputs) == 1
+        assert cache.load('key0') is None
+    finally:
+        cache.clear()
+        os.rmdir(cache.dirname)
+
+
+def test_store_without_shared_values():
+    cache = optcache.OptimizationCache(
+        os.path.join(theano.config.compiledir, 'tmp_test_optcache'))
+    try:
+        x = T.dvector('x')
+        w = theano.shared(numpy.arange(5.), name='w')
+        cache.store('shared', [x, w], [x * w + 1])
+        inputs, outputs = cache.load('shared')
+        # Only the types of the inputs are stored, not the shared values.
+        assert [i.type for i in inputs] == [x.type, w.type]
+        assert not any(isinstance(i, theano.compile.SharedVariable)
+                       for i in inputs)
+        f = theano.function(inputs, outputs[0])
+        assert numpy.allclose(f(numpy.ones(2), numpy.ones(2) * 2), 3)
+    finally:
+        cache.clear()
+        os.rmdir(cache.dirname)
+
+
 if __name__ == '__main__':
     test_graph_opt_caching()
@@ -353,6 +353,19 @@ class TestMergeOptimizer:
         strg = str(g)
         assert strg == '[Op1(y, y)]' or strg == '[Op1(z, z)]'
 
+    def test_many_duplicates(self):
+        x, y, z = inputs()
+        # All the nodes are clients of x, so a scan of the clients of the
+        # first input would be quadratic.
+        outs = [op1(op2(x, y), op3(x, z)) for i in range(50)]
+        outs += [op1(op2(x, z), op3(x, y)) for i in range(50)]
+        g = Env([x, y, z], outs)
+        MergeOptimizer().optimize(g)
+        assert len(g.apply_nodes) == 6
+        assert len(set(o.owner for o in g.outputs)) == 2
+        index = g.merge_feature.node_index
+        assert sum(len(nodes) for nodes in index.values()) == 6
+
 
 class TestEquilibrium(object):
 
@@ -410,6 +423,42 @@ class TestEquilibrium(object):
         #print 'after', g
         assert str(g) == '[Op1(x, y)]'
 
+    def test_worklist(self):
+        # With the worklist, the passes after the first one only visit the
+        # nodes around the changes, and the result is the same.
+        def run(worklist):
+            x, y, z = map(MyVariable, 'xyz')
+            e = op3(x, y)
+            for i in xrange(30):
+                e = op1(e)
+            g = Env([x, y, z], [e])
+            opt = EquilibriumOptimizer(
+                [PatternSub((op3, 'x', 'y'), (op4, 'x', 'y')),
+                 PatternSub((op1, (op4, 'x', 'y')), (op4, 'x', 'y'))],
+                max_use_ratio=10)
+            default = theano.config.optdb.equilibrium_worklist
+            try:
+                theano.config.optdb.equilibrium_worklist = worklist
+                prof = opt.optimize(g)
+            finally:
+                theano.config.optdb.equilibrium_worklist = default
+            return str(g), prof
+
+        g_full, prof_full = run(False)
+        g_worklist, prof_worklist = run(True)
+        assert g_full == g_worklist == '[Op4(x, y)]'
+        # Same number of applications of each optimizer, but far fewer
+        # attempts.
+        def applied(prof):
+            counts = {}
+            for process_count in prof[2]:
+                for o, count in process_count.iteritems():
+                    counts[o] = counts.get(o, 0) + count
+            return sorted(counts.values())
+        assert applied(prof_full) == applied(prof_worklist) == [1, 30]
+        assert (sum(prof_worklist[8].values()) * 2 <
+                sum(prof_full[8].values()))
+
 
 def test_pre_constant_merge_slice():
     ms = theano.tensor.type_other.MakeSlice()(1)
@@ -1,5 +1,8 @@
+import numpy
+
 from theano.gof.sched import (make_dependence_cmp, sort_apply_nodes,
-                              reverse_dict, _toposort, posort)
+                              reverse_dict, _toposort, posort,
+                              memory_schedule, estimate_var_size)
 
 import theano
 from theano import tensor
@@ -66,3 +69,106 @@ def test_posort():
             lambda a, b: a - b]
     assert posort(l, *cmps) == \
             [10, 1, 11, 2, 12, 3, 13, 4, 14, 5, 15, 6, 16, 7, 17, 8, 18, 9, 19]
+
+
+def _peak_memory(fgraph, order):
+    """ Peak of the estimated memory of the intermediate results """
+    n_uses = {}
+    for node in order:
+        for ipt in node.inputs:
+            n_uses[ipt] = n_uses.get(ipt, 0) + 1
+    current = peak = 0
+    for node in order:
+        for out in node.outputs:
+            current += estimate_var_size(out)
+        peak = max(peak, current)
+        for ipt in node.inputs:
+            n_uses[ipt] -= 1
+            if (n_uses[ipt] == 0 and ipt.owner is not None and
+                    ipt not in fgraph.outputs):
+                current -= estimate_var_size(ipt)
+    return peak
+
+
+def test_memory_schedule():
+    x = tensor.matrix('x')
+    # fgraph.toposort() computes all the big intermediate results before
+    # reducing them.
+    y = tensor.add(*[tensor.exp(x + i).sum() for i in range(5)])
+    mode = theano.Mode(linker=theano.gof.vm.VM_Linker(
+        use_cloop=False, schedule=memory_schedule), optimizer=None)
+    f = theano.function([x], y, mode=mode)
+    fgraph = f.maker.fgraph
+    order = memory_schedule(fgraph)
+    assert set(order) == fgraph.apply_nodes
+    seen = set(fgraph.inputs)
+    for node in order:
+        assert all(ipt in seen or ipt.owner is None for ipt in node.inputs)
+        seen.update(node.outputs)
+    assert (_peak_memory(fgraph, order) <
+            _peak_memory(fgraph, fgraph.toposort()) / 2)
+
+    v = numpy.ones((2, 3), dtype=x.dtype)
+    assert numpy.allclose(f(v), 6 * sum(numpy.exp(1 + i) for i in range(5)))
+
+
+def test_memory_schedule_inplace():
+    # The orderings of the DestroyHandler are respected.
+    x = tensor.vector('x')
+    a = tensor.exp(x)
+    y = [a * 2, tensor.log(a), a + 1]
+    f = theano.function([x], y, mode=theano.Mode(linker='cvm_lowmem',
+                                                 optimizer='fast_run'))
+    fgraph = f.maker.fgraph
+    order = memory_schedule(fgraph)
+    position = dict((node, i) for i, node in enumerate(order))
+    for node, prereqs in fgraph.orderings().items():
+        for p in prereqs:
+            assert position[p] < position[node]
+    v = numpy.arange(3).astype(x.dtype)
+    for out, expected in zip(f(v), [numpy.exp(v) * 2, v,
+                                    numpy.exp(v) + 1]):
+        assert numpy.allclose(out, expected)
+
+
+def test_estimate_var_size():
+    x = tensor.matrix('x', dtype='float32')
+    assert estimate_var_size(x) == 4 * 100 * 100
+    assert estimate_var_size(tensor.row(dtype='int8')) == 100
+    assert estimate_var_size(x, {x: (tensor.constant(3), x.shape[1])}) == (
+        4 * 3 * 100)
+
+
+def test_cvm_follows_schedule():
+    x = tensor.vector('x')
+    y = [tensor.exp(x) + 1, tensor.log(x) + 2]
+
+    def log_first(fgraph):
+        return sorted(fgraph.toposort(),
+                      key=lambda node: node.op != tensor.log)
+    executed = []
+
+    def callback(node, thunk, storage_map, compute_map):
+        executed.append(node)
+    linker = theano.gof.vm.VM_Linker(use_cloop=True, callback=callback,
+                                     schedule=log_first)
+    f = theano.function([x], y, mode=theano.Mode(linker=linker,
+                                                 optimizer=None))
+    f(numpy.ones(2, dtype=x.dtype))
+    assert executed == log_first(f.maker.fgraph)
+
+
+def test_default_schedule_not_followed():
+    x = tensor.vector('x')
+    linker = theano.gof.vm.VM_Linker(use_cloop=True)
+    assert not linker.follow_schedule
+    linker.accept(theano.gof.FunctionGraph([x], [tensor.exp(x)]))
+    # accept() builds a new linker for another graph.
+    other = linker.accept(theano.gof.FunctionGraph([x], [tensor.log(x)]))
+    assert other is not linker
+    assert not other.follow_schedule
+
+    linker = theano.gof.vm.VM_Linker(schedule=lambda fgraph: [])
+    linker.accept(theano.gof.FunctionGraph([x], [tensor.exp(x)]))
+    other = linker.accept(theano.gof.FunctionGraph([x], [tensor.log(x)]))
+    assert other.follow_schedule
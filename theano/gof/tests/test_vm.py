@@ -55,6 +55,71 @@ class TestCallbacks(unittest.TestCase):
         f(1, 2, 3)
         assert self.n_callbacks['IfElse'] == 2
 
+    def test_callback_cvm(self):
+        if not theano.config.cxx:
+            raise SkipTest('G++ not available, so we need to skip this test.')
+        a, b, c = tensor.scalars('abc')
+        f = function([a, b, c], (a + b) + c,
+                mode=Mode(
+                    optimizer=None,
+                    linker=vm.VM_Linker(callback=self.callback,
+                                        use_cloop=True)))
+        assert isinstance(f.fn, vm.CVM)
+
+        f(1, 2, 3)
+        assert sum(self.n_callbacks.values()) == len(f.maker.fgraph.toposort())
+        f(1, 2, 3)
+        assert sum(self.n_callbacks.values()) == len(f.maker.fgraph.toposort()) * 2
+
+    def test_callback_cvm_compute_map(self):
+        if not theano.config.cxx:
+            raise SkipTest('G++ not available, so we need to skip this test.')
+        seen = []
+
+        def callback(node, thunk, storage_map, compute_map):
+            # The inputs of a non-lazy node are computed before it runs.
+            if not thunk.lazy:
+                assert all(compute_map[v][0] for v in node.inputs)
+            seen.append(node)
+        a, b, c = tensor.scalars('abc')
+        f = function([a, b, c], ifelse(a, 2 * b, 2 * c),
+                     mode=Mode(
+                         optimizer=None,
+                         linker=vm.VM_Linker(callback=callback,
+                                             use_cloop=True)))
+        assert f(1, 2, 3) == 4
+        assert [n.op.__class__.__name__ for n in seen].count('IfElse') == 2
+
+
+def test_cvm_profile_memory():
+    if not theano.config.cxx:
+        raise SkipTest('G++ not available, so we need to skip this test.')
+    config = theano.config
+    orig_profile, orig_profile_memory = config.profile, config.profile_memory
+    try:
+        config.profile = True
+        config.profile_memory = True
+        x = tensor.matrix('x')
+        profile = theano.compile.ProfileStats(atexit_print=False)
+        f = function([x], tensor.exp(x).sum(axis=0) * 2,
+                     mode=Mode(optimizer=None,
+                               linker=vm.VM_Linker(use_cloop=True)),
+                     profile=profile)
+        assert isinstance(f.fn, vm.CVM)
+        f(numpy.ones((3, 4), dtype=config.floatX))
+        nodes = f.maker.fgraph.toposort()
+        assert sorted(f.fn.node_executed_order) == sorted(nodes)
+        for node in nodes:
+            assert node.outputs[0] in profile.variable_shape
+        inp = f.maker.fgraph.inputs[0]
+        assert profile.variable_shape[inp] == (3, 4)
+        assert profile.variable_strides[inp] == 'c'
+        assert profile.variable_shape[f.maker.fgraph.outputs[0]] == (4,)
+        assert profile.node_executed_order == f.fn.node_executed_order
+    finally:
+        config.profile = orig_profile
+        config.profile_memory = orig_profile_memory
+
 
 def test_speed():
     if not theano.config.cxx:
@@ -343,3 +408,98 @@ def test_vm_gc():
     f = theano.function([x], [pp + pp],
                         mode=mode)
     f([1, 2, 3])
+
+
+def test_parallel_loop():
+    x = tensor.matrix('x')
+    w = [theano.shared(numpy.ones((5, 5), dtype=theano.config.floatX) * i)
+         for i in range(4)]
+    # Independent towers, with inplace ops in FAST_RUN.
+    towers = [tensor.tanh(tensor.dot(x, wi) + 1) * 2 for wi in w]
+    out = tensor.add(*[t.sum(axis=1) for t in towers])
+    f_ref = function([x], out, mode='FAST_RUN')
+    f = function([x], out, mode=Mode(linker=vm.VM_Linker(n_threads=3),
+                                     optimizer='fast_run'))
+    assert isinstance(f.fn, vm.ParallelLoop)
+
+    val = numpy.random.rand(5, 5).astype(theano.config.floatX)
+    for i in range(5):
+        assert numpy.allclose(f(val), f_ref(val))
+    # Intermediate results are garbage collected.
+    for node in f.maker.fgraph.apply_nodes:
+        if node.outputs[0] not in f.maker.fgraph.outputs:
+            assert f.fn.storage_map[node.outputs[0]][0] is None
+
+
+def test_parallel_loop_error():
+    x = tensor.vector('x')
+    y = tensor.vector('y')
+    f = function([x, y], [tensor.exp(x) + y, tensor.log(x)],
+                 mode=Mode(optimizer=None,
+                           linker=vm.VM_Linker(n_threads=2)))
+    assert isinstance(f.fn, vm.ParallelLoop)
+    f([1, 2], [3, 4])
+    try:
+        f([1, 2], [3, 4, 5])
+    except ValueError, e:
+        assert hasattr(e, '__thunk_trace__') or 'Apply node' in str(e)
+    else:
+        raise AssertionError('the shape error was not raised')
+    # The VM still works after an error.
+    assert numpy.allclose(f([1, 2], [3, 4])[1], numpy.log([1, 2]))
+
+
+def test_parallel_loop_lazy():
+    a, b, c = tensor.scalars('abc')
+    f = function([a, b, c], ifelse(a, 2 * b, 2 * c),
+                 mode=Mode(linker=vm.VM_Linker(n_threads=2)))
+    # Graphs with lazy ops do not use threads.
+    assert not isinstance(f.fn, vm.ParallelLoop)
+    assert f(1, 2, 3) == 4
+
+
+def test_reuse_storage():
+    x = tensor.matrix('x')
+    h = x
+    for i in range(5):
+        h = tensor.tanh(tensor.dot(h, x) + i)
+    out = [h.sum(), tensor.exp(x)]
+    val = numpy.random.rand(4, 4).astype(theano.config.floatX) / 4
+    f_ref = function([x], out, mode=Mode(linker=vm.VM_Linker(allow_gc=False),
+                                         optimizer='fast_run'))
+    expected = f_ref(val)
+    for use_cloop in [False, True]:
+        linker = vm.VM_Linker(allow_gc=False, use_cloop=use_cloop,
+                              reuse_storage=True)
+        f = function([x], out, mode=Mode(linker=linker,
+                                         optimizer='fast_run'))
+        storage_map = f.fn.storage_map
+        intermediates = [v for v in storage_map
+                         if v.owner and v not in f.maker.fgraph.outputs]
+        n_cells = len(set(id(storage_map[v]) for v in intermediates))
+        assert n_cells < len(intermediates)
+        for i in range(3):
+            for r, e in zip(f(val), expected):
+                assert numpy.allclose(r, e)
+        # The buffers are reused by the next calls.
+        buffers = [storage_map[v][0] for v in intermediates]
+        f(val)
+        assert all(b is storage_map[v][0]
+                   for b, v in zip(buffers, intermediates)
+                   if isinstance(b, numpy.ndarray))
+
+
+def test_reuse_storage_lazy():
+    a = tensor.scalar('a')
+    x = tensor.vector('x')
+    linker = vm.VM_Linker(allow_gc=False, use_cloop=False,
+                          reuse_storage=True)
+    f = function([a, x], ifelse(a, tensor.exp(x) * 2, tensor.log(x) * 3),
+                 mode=Mode(linker=linker, optimizer=None))
+    # The lazy nodes do not run in order: nothing is shared.
+    cells = [f.fn.storage_map[v] for v in f.maker.fgraph.variables
+             if v.owner]
+    assert len(set(map(id, cells))) == len(cells)
+    val = numpy.arange(1, 4).astype(x.dtype)
+    assert numpy.allclose(f(1, val), numpy.exp(val) * 2)
+    assert numpy.allclose(f(0, val), numpy.log(val) * 3)
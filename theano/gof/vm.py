@@ -3,19 +3,24 @@ VMs that run Theano graph computations.
 A VM is not actually different from a Linker, we just decided
 VM was a better name at some point.
 """
+import heapq
 import link
 import logging
 import os
+import Queue
 import sys
+import threading
 import time
 import warnings
 
 from theano.gof.python25 import all
 
 from theano.configparser import (config, AddConfigVar,
-                                 BoolParam, ConfigParam, _config_var_list)
+                                 BoolParam, ConfigParam, IntParam,
+                                 _config_var_list)
 
 import theano.gof.cmodule
+from theano.gof.sched import alias_roots, estimate_var_size
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +57,22 @@ AddConfigVar('vm.lazy',
              ConfigParam('None', filter_vm_lazy),
              in_c_key=False)
 
+AddConfigVar('vm.threads',
+             "Useful only for the vm linkers. Number of threads used to run"
+             " the independent nodes of a graph concurrently. 1 runs the"
+             " nodes one after the other. Graphs with lazy ops (like ifelse),"
+             " a callback or memory profiling always use one thread.",
+             IntParam(1, lambda i: i > 0),
+             in_c_key=False)
+
+AddConfigVar('vm.reuse_storage',
+             "Useful only for the vm linkers, when allow_gc is False. Let"
+             " the intermediate results whose lifetimes do not overlap share"
+             " their storage, so that the ops compute them in the same"
+             " buffers. This lowers the memory kept between calls.",
+             BoolParam(False),
+             in_c_key=False)
+
 class VM(object):
 
     """
@@ -233,6 +254,233 @@ class LoopGC(VM):
                 link.raise_with_op(node, thunk)
 
 
+# One pool of threads per number of threads, shared by all the functions.
+_thread_pools = {}
+# `active` is True in the threads of the pools while they run a thunk.
+_worker_state = threading.local()
+
+
+def get_thread_pool(n_threads):
+    """Return the shared pool of `n_threads` threads."""
+    pool = _thread_pools.get(n_threads)
+    if pool is None:
+        from multiprocessing.pool import ThreadPool
+        pool = _thread_pools.setdefault(n_threads, ThreadPool(n_threads))
+    return pool
+
+
+class ParallelLoop(VM):
+
+    """
+    Program execution in Python that runs independent nodes concurrently.
+
+    A node is given to a pool of `n_threads` threads as soon as the nodes
+    computing its inputs, and the nodes that must run before it because it
+    destroys a variable they use (the orderings of the DestroyHandler), are
+    done. C thunks and BLAS calls release the GIL, so the branches of wide
+    graphs run on several cores.
+
+    Garbage collection is possible on intermediate results. Lazy thunks are
+    not supported.
+
+    When called from a thunk that is itself run by a pool, the nodes are run
+    in the calling thread, as waiting for other threads of the pool could
+    deadlock.
+    """
+
+    def __init__(self, nodes, thunks, pre_call_clear, storage_map, fgraph,
+                 allow_gc, n_threads):
+        super(ParallelLoop, self).__init__(nodes, thunks, pre_call_clear)
+        if any(th.lazy for th in thunks):
+            raise ValueError('ParallelLoop does not support lazy thunks')
+        self.storage_map = storage_map
+        self.allow_gc = allow_gc
+        self.n_threads = n_threads
+
+        node_idx = dict((node, i) for i, node in enumerate(nodes))
+        ords = fgraph.orderings()
+        # n_prereqs[i] is the number of nodes to run before nodes[i],
+        # successors[i] the indices of the nodes that wait for nodes[i].
+        self.n_prereqs = []
+        self.successors = [[] for node in nodes]
+        for i, node in enumerate(nodes):
+            prereqs = set(node_idx[inp.owner] for inp in node.inputs
+                          if inp.owner is not None)
+            prereqs.update(node_idx[p] for p in ords.get(node, []))
+            self.n_prereqs.append(len(prereqs))
+            for p in prereqs:
+                self.successors[p].append(i)
+
+        # n_clients[var] is the number of nodes that use the intermediate
+        # result var, gc_vars[i] the ones that nodes[i] uses.
+        self.n_clients = {}
+        self.gc_vars = [[] for node in nodes]
+        if allow_gc:
+            outputs = set(fgraph.outputs)
+            for i, node in enumerate(nodes):
+                for inp in set(node.inputs):
+                    if inp.owner is not None and inp not in outputs:
+                        self.n_clients[inp] = self.n_clients.get(inp, 0) + 1
+                        self.gc_vars[i].append(inp)
+
+    def run_thunk(self, i, done):
+        """Run thunk `i` and put `(i, exc_info)` in the queue `done`."""
+        was_active = getattr(_worker_state, 'active', False)
+        _worker_state.active = True
+        exc_info = None
+        try:
+            if self.time_thunks:
+                t0 = time.time()
+                self.thunks[i]()
+                self.call_times[i] += time.time() - t0
+                self.call_counts[i] += 1
+            else:
+                self.thunks[i]()
+        except Exception:
+            exc_info = sys.exc_info()
+        finally:
+            _worker_state.active = was_active
+        done.put((i, exc_info))
+
+    def __call__(self):
+        for cont in self.pre_call_clear:
+            cont[0] = None
+        if getattr(_worker_state, 'active', False):
+            pool = None
+        else:
+            pool = get_thread_pool(self.n_threads)
+        n_prereqs = list(self.n_prereqs)
+        n_clients = self.n_clients.copy()
+        # Start the ready nodes in topological order.
+        ready = [i for i, n in enumerate(n_prereqs) if n == 0]
+        done = Queue.Queue()
+        n_running = 0
+        error = None
+        while True:
+            while ready and error is None:
+                i = heapq.heappop(ready)
+                if pool is None:
+                    self.run_thunk(i, done)
+                else:
+                    pool.apply_async(self.run_thunk, (i, done))
+                n_running += 1
+            if n_running == 0:
+                break
+            i, exc_info = done.get()
+            n_running -= 1
+            if exc_info is not None:
+                # Wait for the running thunks before raising the first error.
+                if error is None:
+                    error = (i, exc_info)
+                continue
+            for j in self.successors[i]:
+                n_prereqs[j] -= 1
+                if n_prereqs[j] == 0:
+                    heapq.heappush(ready, j)
+            for var in self.gc_vars[i]:
+                n_clients[var] -= 1
+                if n_clients[var] == 0:
+                    self.storage_map[var][0] = None
+        if error is not None:
+            i, exc_info = error
+            link.raise_with_op(self.nodes[i], self.thunks[i], exc_info)
+
+
+def set_destroy_dependencies(nodes, fgraph):
+    """Set the `destroy_dependencies` attribute of each node of `nodes`.
+
+    The destroy_dependencies is a list of variables that are implicit
+    dependencies induced by a destroy_map (compare node.inputs which are
+    *explicit* dependencies). The variables in destroy_dependencies would be
+    impossible to compute after the current `node` runs, because
+    node.thunk() is going to destroy a common input variable needed by
+    whatever node owns each variable in destroy_depenencies.
+
+    The Stack VM and the memory profiler use it.
+    """
+    # XXX: inconsistent style - why modify node here rather
+    #      than track destroy_dependencies with dictionary like
+    #      storage_map?
+    ords = fgraph.orderings()
+    for node in nodes:
+        node.destroy_dependencies = []
+        if node in ords:
+            for prereq in ords[node]:
+                node.destroy_dependencies += prereq.outputs
+
+
+def share_storage(nodes, fgraph, storage_map, no_recycling, var_size=None):
+    """Let the intermediate results of `nodes` with disjoint lifetimes
+    share their storage cell.
+
+    The nodes are assumed to run in the order of `nodes`, one after the
+    other. An intermediate result can get the cell of another one when it
+    has the same type and when the other one, and all the views of it, are
+    not used anymore at the time it is computed. The results that are
+    outputs of fgraph or in no_recycling (or whose memory is aliased by
+    such a variable), views and inplace outputs keep their own cell.
+
+    When the storage is not cleared between calls (allow_gc is False), the
+    ops that reuse the content of their output storage, like the C ops,
+    then compute each result in the buffer left by the previous one: after
+    the first call, they are computed without allocation, and there are
+    only as many buffers as the results alive at the same time.
+
+    :param var_size: function returning the estimated size of a variable.
+        Among the free cells of the right type, the one of the variable
+        with the closest size is used. By default, estimate_var_size with
+        the ShapeFeature of fgraph, if it has one.
+
+    :returns: the number of cells removed from storage_map, which is
+        modified in place.
+    """
+    if var_size is None:
+        shape_feature = getattr(fgraph, 'shape_feature', None)
+        shape_of = getattr(shape_feature, 'shape_of', None)
+        var_size = lambda var: estimate_var_size(var, shape_of)
+
+    root_of = alias_roots(nodes)
+    root = lambda var: root_of.get(var, var)
+    kept = set(root(v) for v in fgraph.outputs)
+    kept.update(root(v) for v in no_recycling)
+
+    # Position of the last node that uses the memory of each variable.
+    end = {}
+    for i, node in enumerate(nodes):
+        for var in node.inputs + node.outputs:
+            end[root(var)] = i
+
+    candidates = set()
+    released_after = {}
+    for node in nodes:
+        for out in node.outputs:
+            if (out in root_of or out in kept or
+                    getattr(out.type, 'dtype', None) is None or
+                    getattr(out.type, 'ndim', None) is None):
+                continue
+            candidates.add(out)
+            released_after.setdefault(end[out], []).append(out)
+
+    # type -> list of (size, cell) that are not used anymore
+    free_cells = {}
+    n_shared = 0
+    for i, node in enumerate(nodes):
+        for out in node.outputs:
+            if out not in candidates:
+                continue
+            cells = free_cells.get(out.type)
+            if cells:
+                size = var_size(out)
+                best = min(xrange(len(cells)),
+                           key=lambda j: abs(cells[j][0] - size))
+                storage_map[out] = cells.pop(best)[1]
+                n_shared += 1
+        for var in released_after.get(i, ()):
+            free_cells.setdefault(var.type, []).append(
+                (var_size(var), storage_map[var]))
+    return n_shared
+
+
 class Stack(VM):
 
     """
@@ -276,29 +524,9 @@ class Stack(VM):
         self.node_idx = node_idx = {}
         self.callback = callback
 
-        ords = fgraph.orderings()
-
         for i, node in enumerate(self.nodes):
             node_idx[node] = i
-
-            # XXX: inconsistent style - why modify node here rather
-            #      than track destroy_dependencies with dictionary like
-            #      storage_map?
-            #
-            # destroy_dependencies
-            # --------------------
-            # The destroy_dependencies is a list of variables that are implicit
-            # dependencies induced by a destroy_map (compare node.inputs which
-            # are *explicit* dependencies). The variables in
-            # destroy_dependencies would be impossible to compute after the
-            # current `node` runs, because node.thunk() is going to destroy a
-            # common input variable needed by whatever node owns each variable
-            # in destroy_depenencies.
-
-            node.destroy_dependencies = []
-            if node in ords:
-                for prereq in ords[node]:
-                    node.destroy_dependencies += prereq.outputs
+        set_destroy_dependencies(self.nodes, fgraph)
 
         self.dependencies = dependencies
 
@@ -591,7 +819,8 @@ class VM_Linker(link.LocalLinker):
     """
 
     def __init__(self, allow_gc=None, use_cloop=False, callback=None,
-                 lazy=None, schedule=None):
+                 lazy=None, schedule=None, n_threads=None,
+                 reuse_storage=None):
         """
         allow_gc - force the virtual machine to clean up unnecessary
             references, in order to allow garbage collection on
@@ -602,7 +831,8 @@ class VM_Linker(link.LocalLinker):
 
         callback - a callable object to call after each call to a thunk within
             the virtual machine.  It will be called with four arguments called
-            'node', 'thunk', 'storage_map', and 'compute_map'.
+            'node', 'thunk', 'storage_map', and 'compute_map'. The C-based
+            virtual machine supports it too.
 
         lazy - Useful only when use_cloop is False. When lazy is None, use the
             theano flag vm.lazy value. Then if we have a None (default) we auto
@@ -610,6 +840,17 @@ class VM_Linker(link.LocalLinker):
             version. If lazy is True or False, we force the version used
             between Loop/LoopGC and Stack.
 
+        n_threads - number of threads used to run the independent nodes of
+            the graph concurrently (with the ParallelLoop VM). If None, use
+            the Theano flag vm.threads. Graphs with lazy nodes, a callback or
+            memory profiling are always run by one thread.
+
+        reuse_storage - when allow_gc is False, let the intermediate results
+            whose lifetimes do not overlap share their storage (see
+            share_storage). If None, use the Theano flag vm.reuse_storage.
+            It is not done for graphs run by several threads, with lazy
+            nodes, a callback or memory profiling.
+
         """
         # Note: if more parameters are added to __init__, make sure to forward
         # them in the "type(self)(...)" call in the "accept" method below.
@@ -620,7 +861,15 @@ class VM_Linker(link.LocalLinker):
         self.use_cloop = use_cloop
         self.callback = callback
         self.lazy = lazy
+        self.n_threads = n_threads
+        if reuse_storage is None:
+            reuse_storage = config.vm.reuse_storage
+        self.reuse_storage = reuse_storage
         self.updated_vars = {}
+        # When the nodes are ordered by a custom schedule, the CVM runs
+        # them in that order instead of its own depth-first order.
+        self._custom_schedule = schedule
+        self.follow_schedule = bool(schedule)
         if schedule:
             self.schedule = schedule
 
@@ -658,7 +907,9 @@ class VM_Linker(link.LocalLinker):
                 use_cloop=self.use_cloop,
                 callback=self.callback,
                 lazy=self.lazy,
-                schedule=self.schedule
+                schedule=self._custom_schedule,
+                n_threads=self.n_threads,
+                reuse_storage=self.reuse_storage
             ).accept(fgraph, no_recycling)
         self.fgraph = fgraph
         self.no_recycling = no_recycling
@@ -714,19 +965,27 @@ class VM_Linker(link.LocalLinker):
                 post_thunk_clear,
                 computed,
                 compute_map,
-                updated_vars
+                updated_vars,
+                follow_order=False
                 ):
+        """
+        follow_order - the nodes must be run in the order of `nodes`, even
+            by the CVM (which otherwise runs them depth-first from the
+            outputs). It is True when they share their storage.
+        """
 
         pre_call_clear = [storage_map[v] for v in self.no_recycling]
 
-        if (self.callback is not None or
-                (config.profile and config.profile_memory)):
-
-            if self.use_cloop and self.callback is not None:
-                logger.warn('CVM does not support callback, using Stack VM.')
-            if self.use_cloop and config.profile_memory:
-                warnings.warn(
-                    'CVM does not support memory profile, using Stack VM.')
+        profile_memory = config.profile and config.profile_memory
+        n_threads = self.get_n_threads()
+        if (n_threads > 1 and self.callback is None and
+                not profile_memory and not any(th.lazy for th in thunks)):
+            vm = ParallelLoop(
+                nodes, thunks, pre_call_clear,
+                storage_map, self.fgraph, self.allow_gc,
+                n_threads)
+        elif (not self.use_cloop and
+                (self.callback is not None or profile_memory)):
             # Needed when allow_gc=True and profiling
             deps = self.compute_gc_dependencies(storage_map)
             vm = Stack(
@@ -807,6 +1066,16 @@ class VM_Linker(link.LocalLinker):
                 prereq_var_idxs = list(set(prereq_var_idxs))
                 prereq_var_idxs.sort()  # TODO: why sort?
                 node_prereqs.append(prereq_var_idxs)
+            if ((self.follow_schedule or follow_order) and
+                    not any(is_lazy_list)):
+                # Each node also waits for the node before it.
+                prev_outputs = []
+                for i, node in enumerate(nodes):
+                    if prev_outputs:
+                        node_prereqs[i] = sorted(
+                            set(node_prereqs[i]).union(prev_outputs))
+                    if node.outputs:
+                        prev_outputs = [vars_idx[v] for v in node.outputs]
 
             # Builds the list of input storage to update (according to update
             # rules) when the outputs are computed.
@@ -821,6 +1090,17 @@ class VM_Linker(link.LocalLinker):
                 if oidx in update_in_from_out:
                     update_storage.append(update_in_from_out[oidx])
 
+            # The callback and the memory profiler work on Variables, not
+            # on their index.
+            callback_input = None
+            if self.callback is not None:
+                callback_input = dict(storage_map=storage_map,
+                                      compute_map=compute_map)
+            variables = None
+            if profile_memory:
+                variables = [vars_idx_inv[i]
+                             for i in xrange(len(vars_idx_inv))]
+
             c0 = sys.getrefcount(node_n_inputs)
             vm = CVM(
                 nodes,
@@ -843,8 +1123,14 @@ class VM_Linker(link.LocalLinker):
                 node_output_size=node_output_size,
                 update_storage=update_storage,
                 dependencies=dependency_map_list,
+                callback=self.callback,
+                callback_input=callback_input,
+                variables=variables,
             )
             assert c0 == sys.getrefcount(node_n_inputs)
+            if profile_memory:
+                set_destroy_dependencies(nodes, self.fgraph)
+                vm.dependencies = dependency_map
         else:
             lazy = self.lazy
             if lazy is None:
@@ -875,6 +1161,30 @@ class VM_Linker(link.LocalLinker):
                 )
         return vm
 
+    def get_n_threads(self):
+        if self.n_threads is None:
+            return config.vm.threads
+        return self.n_threads
+
+    def can_reuse_storage(self):
+        """
+        Return True if the storage of the intermediate results can be
+        shared: they are not freed, and the VM runs the nodes in order, one
+        at a time. The graphs with lazy nodes are only known once their
+        thunks are made.
+        """
+        if (not self.reuse_storage or self.allow_gc or
+                self.callback is not None or
+                (config.profile and config.profile_memory) or
+                self.get_n_threads() > 1):
+            return False
+        if self.use_cloop:
+            return True
+        lazy = self.lazy
+        if lazy is None:
+            lazy = config.vm.lazy
+        return not lazy
+
     def make_all(self, profiler=None, input_storage=None,
                  output_storage=None,
                  ):
@@ -888,22 +1198,42 @@ class VM_Linker(link.LocalLinker):
         for k in storage_map:
             compute_map[k] = [k.owner is None]
 
-        thunks = []
-        for node in order:
-            try:
-                thunks.append(node.op.make_thunk(node,
-                                                 storage_map,
-                                                 compute_map,
-                                                 no_recycling))
-                if not hasattr(thunks[-1], 'lazy'):
-                    # We don't want all ops maker to think about lazy Ops.
-                    # So if they didn't specify that its lazy or not, it isn't.
-                    # If this member isn't present, it will crash later.
-                    thunks[-1].lazy = False
-            except Exception, e:
-                e.args = ("The following error happened while"
-                          " compiling the node", node, "\n") + e.args
-                raise
+        reuse_storage = False
+        if self.can_reuse_storage():
+            unshared_storage_map = dict(storage_map)
+            reuse_storage = share_storage(order, fgraph, storage_map,
+                                          no_recycling) > 0
+
+        theano.gof.cc.precompile_cmodules(order, no_recycling)
+        theano.gof.cc.load_combined_cmodules(order, no_recycling)
+
+        def make_thunks(storage_map):
+            thunks = []
+            for node in order:
+                try:
+                    thunks.append(node.op.make_thunk(node,
+                                                     storage_map,
+                                                     compute_map,
+                                                     no_recycling))
+                    if not hasattr(thunks[-1], 'lazy'):
+                        # We don't want all ops maker to think about lazy
+                        # Ops. So if they didn't specify that its lazy or
+                        # not, it isn't. If this member isn't present, it
+                        # will crash later.
+                        thunks[-1].lazy = False
+                except Exception, e:
+                    e.args = ("The following error happened while"
+                              " compiling the node", node, "\n") + e.args
+                    raise
+            return thunks
+
+        thunks = make_thunks(storage_map)
+        if reuse_storage and any(th.lazy for th in thunks):
+            # The lazy nodes are not run in order: make the thunks again
+            # with a storage cell per variable.
+            storage_map = unshared_storage_map
+            reuse_storage = False
+            thunks = make_thunks(storage_map)
         for node, thunk in zip(order, thunks):
             thunk.inputs = [storage_map[v] for v in node.inputs]
             thunk.outputs = [storage_map[v] for v in node.outputs]
@@ -927,7 +1257,8 @@ class VM_Linker(link.LocalLinker):
                           post_thunk_clear,
                           computed,
                           compute_map,
-                          self.updated_vars
+                          self.updated_vars,
+                          follow_order=reuse_storage
                           )
 
         vm.storage_map = storage_map
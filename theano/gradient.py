@@ -12,6 +12,7 @@ from itertools import izip
 import logging
 import time
 import warnings
+import weakref
 _logger = logging.getLogger('theano.gradient')
 
 import numpy  # for numeric_grad
@@ -709,12 +710,22 @@ def subgraph_grad(wrt, end, start=None, cost=None, details=False):
     return wrt_grads, end_grads
 
 
+# Apply node -> (op, connection pattern of the node). The patterns are kept
+# between calls to grad, as the gradients of several costs of the same graph
+# are often asked for.
+_connection_patterns = weakref.WeakKeyDictionary()
+
+
 def _node_to_pattern(node):
     """ given an apply node, obtain its connection pattern
      this is just a wrapper around Op.connection_pattern
      that does type checking and supplies the default value
      if the method is not implemented
     """
+    cached = _connection_patterns.get(node)
+    if (cached is not None and cached[0] is node.op and
+            len(cached[1]) == len(node.inputs)):
+        return cached[1]
 
     if hasattr(node.op, 'connection_pattern'):
         connection_pattern = node.op.connection_pattern(node)
@@ -745,6 +756,7 @@ def _node_to_pattern(node):
     for ii in xrange(len(node.inputs)):
         assert isinstance(connection_pattern[ii], list)
         assert len(connection_pattern[ii]) == len(node.outputs)
+    _connection_patterns[node] = (node.op, connection_pattern)
     return connection_pattern
 
 
@@ -817,6 +829,7 @@ def _populate_var_to_app_to_idx(outputs, wrt, consider_constant):
     #       different outputs of the apply node are connected to
     #       different subsets of the inputs.
     accounted_for = set([])
+    consider_constant = set(consider_constant)
 
     def account_for(var):
         # Don't visit the same variable twice
@@ -828,16 +841,23 @@ def _populate_var_to_app_to_idx(outputs, wrt, consider_constant):
         if var in consider_constant:
             return
 
-        # Recursively add the variables that this variable is
-        # a function of.
-        if var.owner is not None:
-            app = var.owner
-
-            connection_pattern = _node_to_pattern(app)
-
-            var_idx = app.outputs.index(var)
-
-            for i, ipt in enumerate(app.inputs):
+        # Add the variables that this variable is a function of. The
+        # traversal is a depth-first search, done with a stack of
+        # iterators instead of recursive calls, so that deep graphs do
+        # not exceed the recursion limit.
+        stack = []
+        while True:
+            if var is not None and var.owner is not None:
+                app = var.owner
+                connection_pattern = _node_to_pattern(app)
+                var_idx = app.outputs.index(var)
+                stack.append((app, var_idx, connection_pattern,
+                              enumerate(app.inputs)))
+            var = None
+            if not stack:
+                break
+            app, var_idx, connection_pattern, inputs = stack[-1]
+            for i, ipt in inputs:
 
                 #don't process ipt if it is not a true
                 #parent of var
@@ -858,7 +878,15 @@ def _populate_var_to_app_to_idx(outputs, wrt, consider_constant):
                 idx = app_to_idx[app]
                 if i not in idx:
                     idx.append(i)
-                account_for(ipt)
+                if ipt not in accounted_for:
+                    accounted_for.add(ipt)
+                    if ipt not in consider_constant:
+                        # Continue with the parents of ipt, then come back
+                        # to the next inputs of app.
+                        var = ipt
+                        break
+            else:
+                stack.pop()
 
     # add all variables that are true ancestors of the cost
     for output in outputs:
@@ -868,23 +896,21 @@ def _populate_var_to_app_to_idx(outputs, wrt, consider_constant):
     # ancestor. Do this with an upward pass starting from wrt,
     # following only true connections
     visited = set([])
-
-    def visit(var):
+    to_visit = [elem for elem in wrt if elem in var_to_app_to_idx]
+    while to_visit:
+        var = to_visit.pop()
         if var in visited:
-            return
-        if var not in var_to_app_to_idx:
-            return
+            continue
         visited.add(var)
         nodes = var_to_app_to_idx[var]
         for node in nodes:
             connection_pattern = _node_to_pattern(node)
             for idx in nodes[node]:
                 for ii, output in enumerate(node.outputs):
-                    if connection_pattern[idx][ii]:
-                        visit(output)
-
-    for elem in wrt:
-        visit(elem)
+                    if (connection_pattern[idx][ii] and
+                            output in var_to_app_to_idx and
+                            output not in visited):
+                        to_visit.append(output)
 
     # Remove variables that don't have wrt as a true ancestor
     orig_vars = list(var_to_app_to_idx.keys())
@@ -1231,54 +1257,86 @@ def _populate_grad_dict(var_to_app_to_idx,
     # populate grad_dict[var] and return it
     def access_grad_cache(var):
         if var not in grad_dict:
-            # If var is not in grad_dict already, we must compute it
-            if var in var_to_app_to_idx:
-                terms = []
-                node_to_idx = var_to_app_to_idx[var]
-                for node in node_to_idx:
-                    for idx in node_to_idx[node]:
-
-                        term = access_term_cache(node)[idx]
-
-                        if not isinstance(term, gof.Variable):
-                            raise TypeError(
-                                "%s.grad returned %s, expected"
-                                " Variable instance." % (str(node.op),
-                                                         type(term)))
-
-                        if isinstance(term.type, NullType):
-                            raise NullTypeGradError("tensor.grad "
-                                                    "encountered a NaN. " +
-                                                    term.type.why_null)
-
-                        #Don't try to sum up DisconnectedType placeholders
-                        if isinstance(term.type, DisconnectedType):
-                            continue
-
-                        if hasattr(var, 'ndim') and term.ndim != var.ndim:
-                            raise ValueError(
-                                ("%s.grad returned a term with"
-                                 " %d dimensions, but %d are required.") % (
-                                     str(node.op), term.ndim, var.ndim))
-
-                        terms.append(term)
-
-                # Add up the terms to get the total gradient on this variable
-                if len(terms) > 0:
-                    # the next line is like sum(terms) but doesn't add an
-                    # extraneous TensorConstant(0)
-                    grad_dict[var] = reduce(lambda x, y: x + y, terms)
-                else:
-                    grad_dict[var] = disconnected_type()
-
-                if cost_name is not None and var.name is not None:
-                    grad_dict[var].name = '(d%s/d%s)' % (cost_name, var.name)
+            # The gradient on var needs the gradients on the outputs of
+            # the nodes that use it, which are computed first, with an
+            # explicit stack so that deep graphs do not exceed the
+            # recursion limit.
+            stack = [(var, False)]
+            while stack:
+                v, ready = stack.pop()
+                if v in grad_dict:
+                    continue
+                if ready:
+                    compute_grad(v)
+                    continue
+                stack.append((v, True))
+                node_to_idx = var_to_app_to_idx.get(v, ())
+                for node in reversed(list(node_to_idx)):
+                    if node not in term_dict:
+                        for out in reversed(node.outputs):
+                            if out not in grad_dict:
+                                stack.append((out, False))
+        return grad_dict[var]
+
+    def compute_grad(var):
+        # Sets grad_dict[var], from the gradients on the outputs of the
+        # nodes that use var, which must have been computed.
+        if var in var_to_app_to_idx:
+            terms = []
+            node_to_idx = var_to_app_to_idx[var]
+            for node in node_to_idx:
+                for idx in node_to_idx[node]:
+
+                    term = access_term_cache(node)[idx]
+
+                    if not isinstance(term, gof.Variable):
+                        raise TypeError(
+                            "%s.grad returned %s, expected"
+                            " Variable instance." % (str(node.op),
+                                                     type(term)))
+
+                    if isinstance(term.type, NullType):
+                        raise NullTypeGradError("tensor.grad "
+                                                "encountered a NaN. " +
+                                                term.type.why_null)
+
+                    #Don't try to sum up DisconnectedType placeholders
+                    if isinstance(term.type, DisconnectedType):
+                        continue
+
+                    if hasattr(var, 'ndim') and term.ndim != var.ndim:
+                        raise ValueError(
+                            ("%s.grad returned a term with"
+                             " %d dimensions, but %d are required.") % (
+                                 str(node.op), term.ndim, var.ndim))
+
+                    terms.append(term)
+
+            # Add up the terms to get the total gradient on this variable
+            if len(terms) > 1 and all(
+                    isinstance(term, tensor.TensorVariable)
+                    for term in terms):
+                # Add the terms with n-ary additions rather than a chain
+                # of binary ones. Elemwise.perform uses numpy ufuncs, which
+                # are limited to 31 inputs.
+                while len(terms) > 1:
+                    terms = [tensor.add(*terms[i:i + 31])
+                             if len(terms) - i > 1 else terms[i]
+                             for i in xrange(0, len(terms), 31)]
+                grad_dict[var] = terms[0]
+            elif len(terms) > 0:
+                # the next line is like sum(terms) but doesn't add an
+                # extraneous TensorConstant(0)
+                grad_dict[var] = reduce(lambda x, y: x + y, terms)
             else:
-                # this variable isn't connected to the cost in the
-                # computational graph
                 grad_dict[var] = disconnected_type()
-        # end if cache miss
-        return grad_dict[var]
+
+            if cost_name is not None and var.name is not None:
+                grad_dict[var].name = '(d%s/d%s)' % (cost_name, var.name)
+        else:
+            # this variable isn't connected to the cost in the
+            # computational graph
+            grad_dict[var] = disconnected_type()
 
     rval = [access_grad_cache(elem) for elem in wrt]
 
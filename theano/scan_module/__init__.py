@@ -25,7 +25,7 @@ the symbolic graph.
 
 The Scan Op should typically be used by calling any of the following
 functions: ``scan()``, ``map()``, ``reduce()``, ``foldl()``,
-``foldr()``.
+``foldr()``, ``scan_checkpoints()``.
 """
 
 
@@ -41,4 +41,5 @@ __contact__ = "Razvan Pascanu <r.pascanu@gmail>"
 from theano.scan_module import scan_opt
 from theano.scan_module.scan import scan
 from theano.scan_module.scan_views import map, reduce, foldl, foldr
+from theano.scan_module.scan_checkpoints import scan_checkpoints
 from theano.scan_module.scan_utils import clone, until
@@ -0,0 +1,206 @@
+"""
+This module provides ``scan_checkpoints``, a version of ``scan`` whose
+gradient uses less memory.
+
+The gradient of a Scan keeps the states of every step of the forward
+pass (and the intermediate results of the inner function it needs), so
+its memory grows linearly with the number of steps. ``scan_checkpoints``
+splits the steps in segments: an outer Scan loops over the segments and
+an inner Scan over the steps of each segment. Only the states at the
+end of each segment (the checkpoints) are kept by the forward pass. The
+backward pass of each segment computes its forward pass again from its
+checkpoint, so it only keeps the states of one segment at a time. With
+segments of sqrt(n_steps) steps, the memory is O(sqrt(n_steps)) instead
+of O(n_steps), for one more forward pass.
+
+See scan.py for details on scan.
+"""
+
+__docformat__ = 'restructedtext en'
+
+
+import logging
+
+import numpy
+
+from theano import tensor
+from theano.scan_module import scan
+
+_logger = logging.getLogger('theano.scan_module.scan_checkpoints')
+
+
+def _as_list(x):
+    if x is None:
+        return []
+    if isinstance(x, (list, tuple)):
+        return list(x)
+    return [x]
+
+
+def segment_length(n_steps, outputs_info, save_every_N=None,
+                   memory_budget=None):
+    """
+    Return the number of steps of the segments of ``scan_checkpoints``,
+    as a symbolic int64 scalar.
+
+    :param n_steps: symbolic number of steps of the loop.
+
+    :param outputs_info: the initial states, as in ``scan`` (None for the
+        outputs that are not fed back).
+
+    :param save_every_N: if not None, the segment length.
+
+    :param memory_budget: if not None (and save_every_N is None), the
+        number of bytes that the checkpoints may use. The segments are
+        then the shortest ones whose checkpoints fit in it. Shorter
+        segments keep more checkpoints, but the backward pass of each one
+        keeps the states and intermediate results of fewer steps.
+        If both are None, the segments have ceil(sqrt(n_steps)) steps.
+    """
+    n_steps = tensor.cast(n_steps, 'int64')
+    if save_every_N is not None:
+        k = tensor.as_tensor_variable(save_every_N)
+    elif memory_budget is not None:
+        if memory_budget <= 0:
+            raise ValueError('memory_budget must be positive', memory_budget)
+        state_bytes = 0
+        for init in outputs_info:
+            if init is not None:
+                itemsize = numpy.dtype(init.dtype).itemsize
+                state_bytes = state_bytes + init.size * itemsize
+        # Number of checkpoints that fit in the budget.
+        n_checkpoints = tensor.maximum(
+            memory_budget // tensor.maximum(state_bytes, 1), 1)
+        k = tensor.ceil(n_steps / tensor.cast(n_checkpoints, 'float64'))
+    else:
+        k = tensor.ceil(tensor.sqrt(n_steps))
+    k = tensor.clip(tensor.cast(k, 'int64'), 1, tensor.maximum(n_steps, 1))
+    return k
+
+
+def scan_checkpoints(fn,
+                     sequences=None,
+                     outputs_info=None,
+                     non_sequences=None,
+                     n_steps=None,
+                     save_every_N=None,
+                     memory_budget=None,
+                     mode=None,
+                     name=None):
+    """
+    Similar to ``scan``, but the gradient keeps only the states at the end
+    of segments of steps (the checkpoints), and computes the other states
+    again during the backward pass, one segment at a time.
+
+    Only the values at the end of each segment are returned, so the last
+    value of each output is the value at the last step, as for ``scan``.
+    Taps, ``until`` conditions, ``truncate_gradient`` and ``go_backwards``
+    are not supported.
+
+    :param fn: See ``scan``.
+
+    :param sequences: List of tensors over which ``scan_checkpoints``
+                      iterates (taps are not supported).
+
+    :param outputs_info: List of initial states (or dictionaries with only
+                         the key 'initial'), with None for the outputs
+                         that are not fed back (see ``scan``).
+
+    :param non_sequences: See ``scan``.
+
+    :param n_steps: See ``scan``. By default, the length of the shortest
+                    sequence.
+
+    :param save_every_N: Number of steps of each segment. If None, it is
+                         computed from ``memory_budget`` and the number of
+                         steps at run time, see ``segment_length``.
+
+    :param memory_budget: Number of bytes that the checkpoints may use. By
+                          default, the segments have ceil(sqrt(n_steps))
+                          steps, which minimizes the memory used.
+
+    :param mode: See ``scan``.
+
+    :param name: See ``scan``.
+
+    :returns: like ``scan``, the outputs (with one value per segment) and
+              the updates.
+    """
+    sequences = [tensor.as_tensor_variable(s)
+                 for s in _as_list(sequences)]
+    non_sequences = _as_list(non_sequences)
+    outputs_info = _as_list(outputs_info)
+    for i, init in enumerate(outputs_info):
+        if isinstance(init, dict):
+            if 'taps' in init and init['taps'] not in ([-1], None):
+                raise ValueError('scan_checkpoints does not support taps',
+                                 init)
+            init = init.get('initial')
+        if init is not None:
+            init = tensor.as_tensor_variable(init)
+        outputs_info[i] = init
+    if name is None:
+        name = 'scan_checkpoints_fn'
+
+    if n_steps is None:
+        if not sequences:
+            raise ValueError('scan_checkpoints needs n_steps or sequences')
+        n_steps = sequences[0].shape[0]
+        for s in sequences[1:]:
+            n_steps = tensor.minimum(n_steps, s.shape[0])
+    n_steps = tensor.cast(n_steps, 'int64')
+    k = segment_length(n_steps, outputs_info, save_every_N, memory_budget)
+
+    # Number of steps of the outer scan, and of each inner scan (the last
+    # segment can be shorter).
+    o_n_steps = (n_steps + k - 1) // k
+    i_n_steps = tensor.alloc(k, o_n_steps)
+    i_n_steps = tensor.set_subtensor(i_n_steps[-1],
+                                     n_steps - (o_n_steps - 1) * k)
+
+    # Pad the sequences to a multiple of k steps, and split them in
+    # segments.
+    o_sequences = []
+    for s in sequences:
+        s = s[:n_steps]
+        padding = tensor.zeros(
+            [o_n_steps * k - n_steps] + [s.shape[i]
+                                         for i in xrange(1, s.ndim)],
+            dtype=s.dtype)
+        s = tensor.concatenate([s, padding])
+        o_sequences.append(s.reshape(
+            [o_n_steps, k] + [s.shape[i] for i in xrange(1, s.ndim)],
+            ndim=s.ndim + 1))
+    o_sequences.append(i_n_steps)
+    n_states = len([init for init in outputs_info if init is not None])
+
+    def outer_step(*args):
+        n_seqs = len(o_sequences)
+        i_sequences = list(args[:n_seqs - 1])
+        i_states = list(args[n_seqs:n_seqs + n_states])
+        i_non_sequences = list(args[n_seqs + n_states:])
+        i_outputs_info = []
+        for init in outputs_info:
+            if init is None:
+                i_outputs_info.append(None)
+            else:
+                i_outputs_info.append(i_states.pop(0))
+        results, updates = scan(fn,
+                                sequences=i_sequences,
+                                outputs_info=i_outputs_info,
+                                non_sequences=i_non_sequences,
+                                n_steps=args[n_seqs - 1],
+                                mode=mode,
+                                name=name + '_inner')
+        if not isinstance(results, (list, tuple)):
+            results = [results]
+        return [r[-1] for r in results], updates
+
+    return scan(outer_step,
+                sequences=o_sequences,
+                outputs_info=outputs_info,
+                non_sequences=non_sequences,
+                n_steps=o_n_steps,
+                mode=mode,
+                name=name + '_outer',
+                allow_gc=True)
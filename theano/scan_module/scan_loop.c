@@ -0,0 +1,786 @@
+/*
+ * The loop of Scan, in C.
+ *
+ * perform() does what perform() in scan_perform.pyx does, with the same
+ * arguments, but each step only does what the inner function needs: the
+ * slices given to it are views made directly from the data pointer of
+ * the buffers, the storage cells of the inner function are looked up
+ * once, and the outputs are copied with memcpy when they have the layout
+ * of the buffer. The inner function is the C VM, called without going
+ * through Python.
+ *
+ * It returns NotImplemented, before changing anything, when the
+ * sequences or the buffers of the outputs are not numpy ndarrays (e.g.
+ * on the GPU). scan_op.py then uses scan_perform.pyx.
+ *
+ * See scan_perform.pyx for the description of the arguments and of the
+ * layout of the inputs and outputs.
+ */
+#include <Python.h>
+#include <sys/time.h>
+#include "numpy/arrayobject.h"
+
+#if PY_VERSION_HEX < 0x02050000
+typedef int Py_ssize_t;
+#endif
+
+static double now(void)
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (double)tv.tv_sec + (double)tv.tv_usec / 1000000.0;
+}
+
+/* Python modulo: the result has the sign of b. */
+static long pymod(long a, long b)
+{
+    long r = a % b;
+    if (r != 0 && ((r < 0) != (b < 0)))
+        r += b;
+    return r;
+}
+
+#define I1(arr, i) (*(npy_int32 *)PyArray_GETPTR1((PyArrayObject *)(arr), (i)))
+#define I2(arr, i, j) \
+    (*(npy_int32 *)PyArray_GETPTR2((PyArrayObject *)(arr), (i), (j)))
+
+/* cell[0], borrowed. */
+#define CELL(cell) PyList_GET_ITEM((cell), 0)
+
+/* cell[0] = value, stealing the reference to value. */
+static void set_cell(PyObject *cell, PyObject *value)
+{
+    PyObject *old = PyList_GET_ITEM(cell, 0);
+    PyList_SET_ITEM(cell, 0, value);
+    Py_XDECREF(old);
+}
+
+static void set_cell_none(PyObject *cell)
+{
+    Py_INCREF(Py_None);
+    set_cell(cell, Py_None);
+}
+
+/*
+ * Return a new view of a on the axis 0 range [start, stop) (like
+ * a[start:stop] with 0 <= start <= stop), or of a[start] if stop < 0.
+ */
+static PyObject *view(PyArrayObject *a, npy_intp start, npy_intp stop)
+{
+    PyArray_Descr *descr = PyArray_DESCR(a);
+    npy_intp dims[NPY_MAXDIMS];
+    int nd = PyArray_NDIM(a);
+    PyObject *rval;
+    int drop = stop < 0;
+    memcpy(dims, PyArray_DIMS(a), nd * sizeof(npy_intp));
+    if (!drop)
+        dims[0] = stop - start;
+    Py_INCREF(descr);
+    rval = PyArray_NewFromDescr(
+        &PyArray_Type, descr, nd - drop, dims + drop,
+        PyArray_STRIDES(a) + drop,
+        PyArray_BYTES(a) + start * PyArray_STRIDES(a)[0],
+        PyArray_FLAGS(a) & NPY_ARRAY_WRITEABLE, NULL);
+    if (!rval)
+        return NULL;
+    Py_INCREF(a);
+    if (PyArray_SetBaseObject((PyArrayObject *)rval, (PyObject *)a) < 0) {
+        Py_DECREF(rval);
+        return NULL;
+    }
+    return rval;
+}
+
+/* a[start:stop], with the semantics of Python slices. */
+static PyObject *slice(PyArrayObject *a, npy_intp start, npy_intp stop)
+{
+    npy_intp n = PyArray_DIMS(a)[0];
+    if (start < 0)
+        start = start + n < 0 ? 0 : start + n;
+    if (stop < 0)
+        stop = stop + n < 0 ? 0 : stop + n;
+    if (stop > n)
+        stop = n;
+    if (start > stop)
+        start = stop;
+    return view(a, start, stop);
+}
+
+#define END NPY_MAX_INTP
+
+/* dst[...] = src, with the casting and broadcasting of numpy. */
+static int copy_into(PyObject *dst, PyObject *src)
+{
+    int rval;
+    if (PyArray_Check(src))
+        return PyArray_CopyInto((PyArrayObject *)dst, (PyArrayObject *)src);
+    src = PyArray_FROM_O(src);
+    if (!src)
+        return -1;
+    rval = PyArray_CopyInto((PyArrayObject *)dst, (PyArrayObject *)src);
+    Py_DECREF(src);
+    return rval;
+}
+
+/* buf[idx] = value */
+static int assign_row(PyArrayObject *buf, npy_intp idx, PyObject *value)
+{
+    PyObject *row;
+    int rval;
+    if (idx < 0 || idx >= PyArray_DIMS(buf)[0]) {
+        PyErr_Format(PyExc_IndexError,
+                     "index %ld is out of bounds for axis 0 with size %ld",
+                     (long)idx, (long)PyArray_DIMS(buf)[0]);
+        return -1;
+    }
+    if (PyArray_Check(value)) {
+        PyArrayObject *v = (PyArrayObject *)value;
+        int nd = PyArray_NDIM(buf) - 1;
+        /* Fast path: the value has exactly the layout of the row. */
+        if (PyArray_NDIM(v) == nd &&
+            PyArray_EquivTypes(PyArray_DESCR(v), PyArray_DESCR(buf)) &&
+            PyArray_ISCONTIGUOUS(v) && PyArray_ISWRITEABLE(buf) &&
+            (nd == 0 || PyArray_STRIDES(buf)[nd] == PyArray_ITEMSIZE(buf)) &&
+            !memcmp(PyArray_DIMS(v), PyArray_DIMS(buf) + 1,
+                    nd * sizeof(npy_intp))) {
+            char *dst = PyArray_BYTES(buf) + idx * PyArray_STRIDES(buf)[0];
+            int contiguous = 1;
+            npy_intp size = PyArray_ITEMSIZE(buf);
+            int k;
+            for (k = nd; k >= 1; --k) {
+                if (PyArray_DIMS(buf)[k] != 1 &&
+                    PyArray_STRIDES(buf)[k] != size) {
+                    contiguous = 0;
+                    break;
+                }
+                size *= PyArray_DIMS(buf)[k];
+            }
+            if (contiguous) {
+                if (dst != PyArray_BYTES(v))
+                    memmove(dst, PyArray_BYTES(v), size);
+                return 0;
+            }
+        }
+    }
+    row = view(buf, idx, -1);
+    if (!row)
+        return -1;
+    rval = copy_into(row, value);
+    Py_DECREF(row);
+    return rval;
+}
+
+static int is_array(PyObject *o)
+{
+    return PyArray_CheckExact(o) && PyArray_NDIM((PyArrayObject *)o) > 0;
+}
+
+/* node.outputs[idx].type.value_zeros((n,) + tail) */
+static PyObject *value_zeros(PyObject *node, Py_ssize_t idx, npy_intp n,
+                             int nd_tail, npy_intp *tail)
+{
+    PyObject *shape, *outputs, *type, *rval;
+    int k;
+    shape = PyTuple_New(nd_tail + 1);
+    if (!shape)
+        return NULL;
+    PyTuple_SET_ITEM(shape, 0, PyInt_FromSsize_t(n));
+    for (k = 0; k < nd_tail; ++k)
+        PyTuple_SET_ITEM(shape, k + 1, PyInt_FromSsize_t(tail[k]));
+    outputs = PyObject_GetAttrString(node, "outputs");
+    if (!outputs) {
+        Py_DECREF(shape);
+        return NULL;
+    }
+    type = PyObject_GetAttrString(PySequence_Fast_GET_ITEM(outputs, idx),
+                                  "type");
+    Py_DECREF(outputs);
+    if (!type) {
+        Py_DECREF(shape);
+        return NULL;
+    }
+    rval = PyObject_CallMethod(type, (char *)"value_zeros", (char *)"(O)",
+                               shape);
+    Py_DECREF(type);
+    Py_DECREF(shape);
+    if (rval && !is_array(rval)) {
+        Py_DECREF(rval);
+        PyErr_SetString(PyExc_TypeError,
+                        "scan: value_zeros must return an ndarray");
+        return NULL;
+    }
+    return rval;
+}
+
+/* dst[...] = src for two arrays, dst and src being new references that
+ * are released. */
+static int copy_and_release(PyObject *dst, PyObject *src)
+{
+    int rval = -1;
+    if (dst && src)
+        rval = PyArray_CopyInto((PyArrayObject *)dst, (PyArrayObject *)src);
+    Py_XDECREF(dst);
+    Py_XDECREF(src);
+    return rval;
+}
+
+/* Re-raise the error of the inner function with the information on the
+ * node that failed, like scan_perform.pyx. */
+static void raise_with_op(PyObject *fn)
+{
+    PyObject *type, *value, *tb, *pos, *nodes, *node, *link, *exc_info;
+    long position;
+    if (!PyObject_HasAttrString(fn, "position_of_error"))
+        return;
+    PyErr_Fetch(&type, &value, &tb);
+    PyErr_NormalizeException(&type, &value, &tb);
+    pos = PyObject_GetAttrString(fn, "position_of_error");
+    nodes = PyObject_GetAttrString(fn, "nodes");
+    position = pos ? PyInt_AsLong(pos) : -1;
+    if (!pos || !nodes || position < 0 || PyErr_Occurred()) {
+        Py_XDECREF(pos);
+        Py_XDECREF(nodes);
+        PyErr_Clear();
+        PyErr_Restore(type, value, tb);
+        return;
+    }
+    node = PySequence_GetItem(nodes, position);
+    link = PyImport_ImportModule("theano.gof.link");
+    exc_info = Py_BuildValue("(OOO)", type, value ? value : Py_None,
+                             tb ? tb : Py_None);
+    Py_XDECREF(type);
+    Py_XDECREF(value);
+    Py_XDECREF(tb);
+    if (node && link && exc_info) {
+        PyObject *r = PyObject_CallMethod(link, (char *)"raise_with_op",
+                                          (char *)"OOO", node, Py_None,
+                                          exc_info);
+        /* raise_with_op always raises. */
+        Py_XDECREF(r);
+    }
+    Py_XDECREF(node);
+    Py_XDECREF(link);
+    Py_XDECREF(exc_info);
+    Py_DECREF(pos);
+    Py_DECREF(nodes);
+}
+
+/* Return a new list of the storage cells of the list of Containers
+ * fnct.<name>. */
+static PyObject *storage_cells(PyObject *fnct, const char *name)
+{
+    PyObject *containers = PyObject_GetAttrString(fnct, name);
+    Py_ssize_t k, n;
+    PyObject *rval;
+    if (!containers)
+        return NULL;
+    n = PySequence_Size(containers);
+    rval = n < 0 ? NULL : PyList_New(n);
+    if (!rval) {
+        Py_DECREF(containers);
+        return NULL;
+    }
+    for (k = 0; k < n; ++k) {
+        PyObject *c = PySequence_GetItem(containers, k);
+        PyObject *s = c ? PyObject_GetAttrString(c, "storage") : NULL;
+        Py_XDECREF(c);
+        if (s && (!PyList_Check(s) || PyList_GET_SIZE(s) != 1)) {
+            PyErr_SetString(PyExc_TypeError,
+                            "container storage must be a list of length 1");
+            Py_CLEAR(s);
+        }
+        if (!s) {
+            Py_DECREF(containers);
+            Py_DECREF(rval);
+            return NULL;
+        }
+        PyList_SET_ITEM(rval, k, s);
+    }
+    Py_DECREF(containers);
+    return rval;
+}
+
+static int check_int32(PyObject *a, int nd, const char *name)
+{
+    if (!PyArray_Check(a) || PyArray_NDIM((PyArrayObject *)a) != nd ||
+        PyArray_TYPE((PyArrayObject *)a) != NPY_INT32) {
+        PyErr_Format(PyExc_TypeError, "%s must be an int32 array with %d"
+                     " dimensions", name, nd);
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+perform(PyObject *self_, PyObject *pyargs)
+{
+    unsigned int n_shared_outs, n_mit_mot_outs, n_seqs, n_mit_mot;
+    unsigned int n_mit_sot, n_sit_sot, n_nit_sot;
+    PyObject *n_steps_obj;
+    int as_while;
+    PyObject *mintaps, *tap_array, *tap_array_len, *vector_seqs;
+    PyObject *vector_outs, *mit_mot_out_slices, *mit_mot_out_nslices;
+    PyObject *fn, *fnct, *destroy_map, *args, *outs, *self, *node;
+
+    PyObject *in_cells = NULL, *out_cells = NULL;
+    PyObject **prealloc = NULL;
+    long *store_steps = NULL, *pos = NULL;
+    PyObject *zero = NULL;
+    PyObject *rval = NULL;
+    Py_ssize_t n_outs, lenpos, seqs_arg_offset, shared_arg_offset;
+    Py_ssize_t nit_sot_arg_offset, offset, offset_out, idx, j, n_args;
+    long n_steps, i;
+    int cond;
+    double t_fn = 0;
+
+    if (!PyArg_ParseTuple(pyargs, "IIIIIIIOiOOOOOOOOOOOOOO",
+                          &n_shared_outs, &n_mit_mot_outs, &n_seqs,
+                          &n_mit_mot, &n_mit_sot, &n_sit_sot, &n_nit_sot,
+                          &n_steps_obj, &as_while, &mintaps, &tap_array,
+                          &tap_array_len, &vector_seqs, &vector_outs,
+                          &mit_mot_out_slices, &mit_mot_out_nslices, &fn,
+                          &fnct, &destroy_map, &args, &outs, &self, &node))
+        return NULL;
+    if (check_int32(mintaps, 1, "mintaps") ||
+        check_int32(tap_array, 2, "tap_array") ||
+        check_int32(tap_array_len, 1, "tap_array_len") ||
+        check_int32(vector_seqs, 1, "vector_seqs") ||
+        check_int32(vector_outs, 1, "vector_outs") ||
+        check_int32(mit_mot_out_slices, 2, "mit_mot_out_slices") ||
+        check_int32(mit_mot_out_nslices, 1, "mit_mot_out_nslices") ||
+        check_int32(destroy_map, 1, "destroy_map"))
+        return NULL;
+    if (!PyList_Check(args) || !PyList_Check(outs)) {
+        PyErr_SetString(PyExc_TypeError, "args and outs must be lists");
+        return NULL;
+    }
+
+    n_outs = n_mit_mot + n_mit_sot + n_sit_sot;
+    lenpos = n_outs + n_nit_sot;
+    seqs_arg_offset = n_seqs + 1;
+    shared_arg_offset = 1 + n_seqs + n_outs;
+    nit_sot_arg_offset = shared_arg_offset + n_shared_outs;
+    n_args = PyList_GET_SIZE(args);
+    if (n_args < nit_sot_arg_offset + n_nit_sot ||
+        PyList_GET_SIZE(outs) < lenpos + n_shared_outs) {
+        PyErr_SetString(PyExc_ValueError, "scan: wrong number of arguments");
+        return NULL;
+    }
+
+    /* Only numpy arrays are handled here. */
+    for (idx = 0; idx < n_seqs + n_outs; ++idx) {
+        if (!is_array(PyList_GET_ITEM(args, 1 + idx)))
+            goto not_implemented;
+    }
+    for (idx = 0; idx < lenpos; ++idx) {
+        PyObject *cell = PyList_GET_ITEM(outs, idx);
+        if (!PyList_Check(cell) || PyList_GET_SIZE(cell) != 1 ||
+            (CELL(cell) != Py_None && !is_array(CELL(cell))))
+            goto not_implemented;
+    }
+
+    /* 1. Check the number of steps and the length of the sequences. */
+    n_steps = PyInt_AsLong(n_steps_obj);
+    if (n_steps == -1 && PyErr_Occurred())
+        return NULL;
+    if (n_steps < 0) {
+        PyErr_Format(PyExc_IndexError,
+                     "Scan was asked to run for negative number of step %ld",
+                     n_steps);
+        return NULL;
+    }
+    else if (n_steps == 0) {
+        PyErr_SetString(PyExc_NotImplementedError,
+                        "We didn't implemented yet the case where scan do 0"
+                        " iteration");
+        return NULL;
+    }
+    for (idx = 0; idx < n_seqs; ++idx) {
+        PyArrayObject *seq = (PyArrayObject *)PyList_GET_ITEM(args, 1 + idx);
+        if (PyArray_DIMS(seq)[0] < n_steps) {
+            PyObject *shape = PyObject_GetAttrString((PyObject *)seq,
+                                                     "shape");
+            PyObject *err = Py_BuildValue(
+                "(sOOO)", "Sequence is shorter then the required number of"
+                " steps : (n_steps, seq, seq.shape):", n_steps_obj, seq,
+                shape ? shape : Py_None);
+            Py_XDECREF(shape);
+            if (err) {
+                PyErr_SetObject(PyExc_ValueError, err);
+                Py_DECREF(err);
+            }
+            return NULL;
+        }
+    }
+
+    /* 2. Length and current position of the buffer of each output. */
+    store_steps = (long *)calloc(lenpos + 1, sizeof(long));
+    pos = (long *)calloc(lenpos + 1, sizeof(long));
+    prealloc = (PyObject **)calloc(lenpos + 1, sizeof(PyObject *));
+    if (!store_steps || !pos || !prealloc) {
+        PyErr_NoMemory();
+        goto fail;
+    }
+    for (idx = 0; idx < n_outs; ++idx)
+        store_steps[idx] = PyArray_DIMS(
+            (PyArrayObject *)PyList_GET_ITEM(args, idx + n_seqs + 1))[0];
+    for (idx = 0; idx < n_nit_sot; ++idx) {
+        store_steps[idx + n_outs] = PyInt_AsLong(PyList_GET_ITEM(
+            args, idx + n_outs + n_shared_outs + n_seqs + 1));
+        if (store_steps[idx + n_outs] == -1 && PyErr_Occurred())
+            goto fail;
+    }
+    for (idx = 0; idx < lenpos; ++idx) {
+        if (store_steps[idx] == 0) {
+            PyErr_SetString(PyExc_ZeroDivisionError,
+                            "integer division or modulo by zero");
+            goto fail;
+        }
+        pos[idx] = pymod(-I1(mintaps, idx), store_steps[idx]);
+    }
+
+    /* 2.1 Create the buffers of the outputs. */
+    for (idx = 0; idx < n_outs; ++idx) {
+        PyObject *cell = PyList_GET_ITEM(outs, idx);
+        PyArrayObject *init = (PyArrayObject *)PyList_GET_ITEM(
+            args, seqs_arg_offset + idx);
+        PyArrayObject *old = (PyArrayObject *)CELL(cell);
+        if (I1(destroy_map, idx) != 0) {
+            /* The output is computed inplace of its initial state. */
+            Py_INCREF(init);
+            set_cell(cell, (PyObject *)init);
+        }
+        else if ((PyObject *)old != Py_None &&
+                 PyArray_NDIM(old) == PyArray_NDIM(init) &&
+                 !memcmp(PyArray_DIMS(old) + 1, PyArray_DIMS(init) + 1,
+                         (PyArray_NDIM(old) - 1) * sizeof(npy_intp)) &&
+                 PyArray_DIMS(old)[0] >= store_steps[idx]) {
+            /* Reuse the buffer, and put in it the initial state. */
+            PyObject *buf = slice(old, 0, store_steps[idx]);
+            if (!buf)
+                goto fail;
+            set_cell(cell, buf);
+            if (idx > n_mit_mot) {
+                long l = -I1(mintaps, idx);
+                if (copy_and_release(slice((PyArrayObject *)buf, 0, l),
+                                     slice(init, 0, l)))
+                    goto fail;
+            }
+            else if (PyArray_CopyInto((PyArrayObject *)buf, init))
+                goto fail;
+        }
+        else {
+            PyObject *buf = PyArray_NewCopy(init, NPY_CORDER);
+            if (!buf)
+                goto fail;
+            set_cell(cell, buf);
+        }
+    }
+
+    in_cells = storage_cells(fnct, "input_storage");
+    out_cells = in_cells ? storage_cells(fnct, "output_storage") : NULL;
+    if (!in_cells || !out_cells)
+        goto fail;
+
+    /* The other arguments are the same at each step. */
+    offset = n_seqs;
+    for (idx = 0; idx < n_outs; ++idx)
+        offset += I1(tap_array_len, idx);
+    offset += n_shared_outs;
+    for (idx = nit_sot_arg_offset + n_nit_sot; idx < n_args; ++idx) {
+        PyObject *a = PyList_GET_ITEM(args, idx);
+        Py_INCREF(a);
+        set_cell(PyList_GET_ITEM(in_cells, offset++), a);
+    }
+
+    zero = PyInt_FromLong(0);
+    if (!zero)
+        goto fail;
+
+    /* The main loop. */
+    i = 0;
+    cond = 1;
+    while (i < n_steps && cond == 1) {
+        double t0_fn;
+        PyObject *r;
+
+        /* 3. Collect the input slices. */
+        for (idx = 0; idx < n_seqs; ++idx) {
+            PyObject *s = view((PyArrayObject *)PyList_GET_ITEM(args, 1 + idx),
+                               i, -1);
+            if (!s)
+                goto fail;
+            set_cell(PyList_GET_ITEM(in_cells, idx), s);
+        }
+        offset = n_seqs;
+        for (idx = 0; idx < n_outs; ++idx) {
+            PyArrayObject *buf = (PyArrayObject *)CELL(
+                PyList_GET_ITEM(outs, idx));
+            int tdx;
+            for (tdx = 0; tdx < I1(tap_array_len, idx); ++tdx) {
+                long tap = I2(tap_array, idx, tdx);
+                PyObject *s = view(buf, pymod(pos[idx] + tap,
+                                              store_steps[idx]), -1);
+                if (!s)
+                    goto fail;
+                set_cell(PyList_GET_ITEM(in_cells, offset++), s);
+            }
+        }
+        for (j = 0; j < n_shared_outs; ++j) {
+            PyObject *a = (i == 0 ?
+                           PyList_GET_ITEM(args, shared_arg_offset + j) :
+                           CELL(PyList_GET_ITEM(outs, lenpos + j)));
+            Py_INCREF(a);
+            set_cell(PyList_GET_ITEM(in_cells, offset++), a);
+        }
+
+        /* 4. Where the outputs should be stored. */
+        for (idx = 0; idx < n_mit_mot_outs; ++idx)
+            set_cell_none(PyList_GET_ITEM(out_cells, idx));
+        offset = n_mit_mot_outs;
+        for (idx = 0; idx < lenpos - n_mit_mot; ++idx) {
+            Py_ssize_t k = idx + n_mit_mot;
+            PyObject *cell = PyList_GET_ITEM(out_cells, idx + offset);
+            PyArrayObject *buf = (PyArrayObject *)CELL(
+                PyList_GET_ITEM(outs, k));
+            Py_CLEAR(prealloc[k]);
+            /* The inner function computes the output in its buffer, if
+             * the view is not also an input of the step, and the buffer
+             * of a nit_sot output exists (see scan_perform.pyx). */
+            if ((PyObject *)buf != Py_None &&
+                store_steps[k] > -I1(mintaps, k) &&
+                PyArray_DIMS(buf)[0] >= store_steps[k]) {
+                prealloc[k] = view(buf, pos[k], -1);
+                if (!prealloc[k])
+                    goto fail;
+                Py_INCREF(prealloc[k]);
+                set_cell(cell, prealloc[k]);
+            }
+            else
+                set_cell_none(cell);
+        }
+        offset += lenpos - n_mit_mot;
+        for (idx = 0; idx < n_shared_outs; ++idx)
+            set_cell_none(PyList_GET_ITEM(out_cells, idx + offset));
+        if (as_while)
+            set_cell_none(PyList_GET_ITEM(out_cells, offset + n_shared_outs));
+
+        /* 5. Compute the outputs. */
+        t0_fn = now();
+        r = PyObject_CallObject(fn, NULL);
+        if (!r) {
+            raise_with_op(fn);
+            goto fail;
+        }
+        Py_DECREF(r);
+        t_fn += now() - t0_fn;
+        if (as_while) {
+            PyObject *c = CELL(PyList_GET_ITEM(out_cells,
+                                               offset + n_shared_outs));
+            PyObject *eq = PyObject_RichCompare(c, zero, Py_EQ);
+            if (!eq)
+                goto fail;
+            cond = PyObject_IsTrue(eq);
+            Py_DECREF(eq);
+            if (cond < 0)
+                goto fail;
+        }
+
+        /* 5.1 Copy the values of the mit_mot outputs. */
+        offset_out = 0;
+        for (j = 0; j < n_mit_mot; ++j) {
+            PyArrayObject *buf = (PyArrayObject *)CELL(
+                PyList_GET_ITEM(outs, j));
+            int kdx;
+            for (kdx = 0; kdx < I1(mit_mot_out_nslices, j); ++kdx) {
+                long k = I2(mit_mot_out_slices, j, kdx);
+                if (assign_row(buf, k + pos[j], CELL(PyList_GET_ITEM(
+                        out_cells, offset_out))))
+                    goto fail;
+                offset_out++;
+            }
+        }
+
+        /* 5.2 Copy the values of the mit_sot/sit_sot outputs. */
+        offset_out -= n_mit_mot;
+        for (j = n_mit_mot; j < n_outs; ++j) {
+            PyObject *v = CELL(PyList_GET_ITEM(out_cells, offset_out + j));
+            if (v != prealloc[j] &&
+                assign_row((PyArrayObject *)CELL(PyList_GET_ITEM(outs, j)),
+                           pos[j], v))
+                goto fail;
+        }
+
+        /* 5.3 Copy the values of the nit_sot outputs. */
+        for (j = n_outs; j < lenpos; ++j) {
+            PyObject *cell = PyList_GET_ITEM(outs, j);
+            PyObject *v = CELL(PyList_GET_ITEM(out_cells, offset_out + j));
+            if (i == 0) {
+                PyArrayObject *va, *buf;
+                if (!PyArray_Check(v)) {
+                    PyErr_SetString(PyExc_TypeError,
+                                    "scan: the nit_sot outputs of the inner"
+                                    " function must be ndarrays");
+                    goto fail;
+                }
+                va = (PyArrayObject *)v;
+                if (PyArray_NDIM(va) == 0)
+                    I1(vector_outs, j) = 1;
+                buf = (PyArrayObject *)CELL(cell);
+                if ((PyObject *)buf == Py_None ||
+                    PyArray_DIMS(buf)[0] < store_steps[j] ||
+                    PyArray_NDIM(buf) != PyArray_NDIM(va) + 1 ||
+                    memcmp(PyArray_DIMS(buf) + 1, PyArray_DIMS(va),
+                           PyArray_NDIM(va) * sizeof(npy_intp)) ||
+                    !PyArray_EquivTypes(PyArray_DESCR(buf),
+                                        PyArray_DESCR(va))) {
+                    PyObject *z = value_zeros(node, j, store_steps[j],
+                                              PyArray_NDIM(va),
+                                              PyArray_DIMS(va));
+                    if (!z)
+                        goto fail;
+                    set_cell(cell, z);
+                }
+                else if (PyArray_DIMS(buf)[0] != store_steps[j]) {
+                    PyObject *s = slice(buf, 0, store_steps[j]);
+                    if (!s)
+                        goto fail;
+                    set_cell(cell, s);
+                }
+            }
+            if (v != prealloc[j] &&
+                assign_row((PyArrayObject *)CELL(cell), pos[j], v))
+                goto fail;
+        }
+
+        /* 5.4 Copy the values of the outputs of the shared variables. */
+        for (j = lenpos; j < lenpos + n_shared_outs; ++j) {
+            PyObject *v = CELL(PyList_GET_ITEM(out_cells, offset_out + j));
+            Py_INCREF(v);
+            set_cell(PyList_GET_ITEM(outs, j), v);
+        }
+
+        for (idx = 0; idx < lenpos; ++idx)
+            pos[idx] = pymod(pos[idx] + 1, store_steps[idx]);
+        i++;
+    }
+
+    /* 6. Put the buffers back in order, if needed. */
+    for (idx = n_mit_mot; idx < lenpos; ++idx) {
+        PyObject *cell = PyList_GET_ITEM(outs, idx);
+        PyArrayObject *buf = (PyArrayObject *)CELL(cell);
+        long steps = store_steps[idx];
+        long used = i - I1(mintaps, idx);
+        if (steps < used && pos[idx] < steps) {
+            long pdx = pos[idx];
+            PyObject *tmp;
+            if (pdx >= steps / 2) {
+                /* Copying the bigger part over and back is the only way
+                 * that nothing is overwritten before it is read. */
+                tmp = value_zeros(node, idx, pdx, PyArray_NDIM(buf) - 1,
+                                 PyArray_DIMS(buf) + 1);
+                if (!tmp ||
+                    copy_and_release((Py_INCREF(tmp), tmp),
+                                     slice(buf, 0, pdx)) ||
+                    copy_and_release(slice(buf, 0, steps - pdx),
+                                     slice(buf, pdx, END)) ||
+                    copy_and_release(slice(buf, steps - pdx, END),
+                                     (Py_INCREF(tmp), tmp))) {
+                    Py_XDECREF(tmp);
+                    goto fail;
+                }
+            }
+            else {
+                tmp = value_zeros(node, idx, steps - pdx,
+                                 PyArray_NDIM(buf) - 1,
+                                 PyArray_DIMS(buf) + 1);
+                if (!tmp ||
+                    copy_and_release((Py_INCREF(tmp), tmp),
+                                     slice(buf, pdx, END)) ||
+                    copy_and_release(slice(buf, steps - pdx, END),
+                                     slice(buf, 0, pdx)) ||
+                    copy_and_release(slice(buf, 0, steps - pdx),
+                                     (Py_INCREF(tmp), tmp))) {
+                    Py_XDECREF(tmp);
+                    goto fail;
+                }
+            }
+            Py_DECREF(tmp);
+        }
+        else if (steps > used) {
+            /* Truncated backpropagation through time: the entries for
+             * which the gradient was not computed are 0. */
+            PyObject *rest = slice(buf, used, END);
+            if (!rest || PyArray_FillWithScalar((PyArrayObject *)rest, zero)) {
+                Py_XDECREF(rest);
+                goto fail;
+            }
+            Py_DECREF(rest);
+            /* With a condition, the outputs have the length of the loop
+             * that was done. */
+            if (i < n_steps) {
+                PyObject *s = slice(buf, 0,
+                                    PyArray_DIMS(buf)[0] - (n_steps - i));
+                if (!s)
+                    goto fail;
+                set_cell(cell, s);
+            }
+        }
+    }
+
+    /* The storage of the inner function is never reused: clear it. */
+    for (idx = 0; idx < PyList_GET_SIZE(in_cells); ++idx)
+        set_cell_none(PyList_GET_ITEM(in_cells, idx));
+    for (idx = 0; idx < PyList_GET_SIZE(out_cells); ++idx)
+        set_cell_none(PyList_GET_ITEM(out_cells, idx));
+
+    rval = PyFloat_FromDouble(t_fn);
+    goto done;
+
+not_implemented:
+    Py_INCREF(Py_NotImplemented);
+    return Py_NotImplemented;
+
+fail:
+    rval = NULL;
+done:
+    if (prealloc) {
+        for (idx = 0; idx < lenpos; ++idx)
+            Py_XDECREF(prealloc[idx]);
+        free(prealloc);
+    }
+    free(store_steps);
+    free(pos);
+    Py_XDECREF(in_cells);
+    Py_XDECREF(out_cells);
+    Py_XDECREF(zero);
+    return rval;
+}
+
+static PyObject *
+get_version(PyObject *dummy, PyObject *args)
+{
+    return PyFloat_FromDouble(0.2);
+}
+
+static PyMethodDef scan_loop_methods[] = {
+    {"perform", perform, METH_VARARGS,
+     "perform(n_shared_outs, n_mit_mot_outs, n_seqs, n_mit_mot, n_mit_sot,"
+     " n_sit_sot, n_nit_sot, n_steps, as_while, mintaps, tap_array,"
+     " tap_array_len, vector_seqs, vector_outs, mit_mot_out_slices,"
+     " mit_mot_out_nslices, fn, fnct, destroy_map, args, outs, self, node)\n"
+     "Run the loop of a Scan node. Return the time spent in fn, or"
+     " NotImplemented if the values are not numpy arrays."},
+    {"get_version", get_version, METH_VARARGS, "Get extension version."},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+initscan_loop(void)
+{
+    PyObject *m = Py_InitModule3("scan_loop", scan_loop_methods,
+                                 "The loop of Scan, in C.");
+    if (!m)
+        return;
+    import_array();
+}
@@ -0,0 +1,133 @@
+"""
+Load (compiling it if needed) the C implementation of the loop of Scan.
+
+See scan_loop.c. It is used instead of scan_perform_ext when
+config.scan.c_loop is True.
+"""
+import errno
+import logging
+import os
+import sys
+import time
+
+import theano
+from theano import config
+from theano.compat import reload
+from theano.gof.compilelock import get_lock, release_lock
+from theano.gof import cmodule
+
+_logger = logging.getLogger('theano.scan_module.scan_loop_ext')
+
+version = 0.2  # must match constant returned in function get_version()
+
+
+def try_import():
+    global scan_loop
+    sys.path[0:0] = [config.compiledir]
+    import scan_loop
+    del sys.path[0]
+
+
+def try_reload():
+    sys.path[0:0] = [config.compiledir]
+    reload(scan_loop)
+    del sys.path[0]
+
+# See lazylinker_c.py for why the module is put in a package of the
+# compiledir, with an __init__.py file.
+location = os.path.join(config.compiledir, 'scan_loop')
+if not os.path.exists(location):
+    try:
+        os.mkdir(location)
+    except OSError, e:
+        assert e.errno == errno.EEXIST
+        assert os.path.isdir(location)
+
+if not os.path.exists(os.path.join(location, '__init__.py')):
+    open(os.path.join(location, '__init__.py'), 'w').close()
+
+try:
+    _need_reload = False
+    try_import()
+    _need_reload = True
+    if version != getattr(scan_loop, '_version', None):
+        raise ImportError()
+except ImportError:
+    get_lock()
+    try:
+        # Maybe someone else already finished compiling it while we were
+        # waiting for the lock?
+        try:
+            if _need_reload:
+                try_reload()
+            else:
+                try_import()
+                _need_reload = True
+            if version != getattr(scan_loop, '_version', None):
+                raise ImportError()
+        except ImportError:
+            if not theano.config.cxx:
+                raise ImportError("no c compiler, can't compile the loop"
+                                  " of scan")
+            cfile = os.path.join(theano.__path__[0], 'scan_module',
+                                 'scan_loop.c')
+            if not os.path.exists(cfile):
+                raise ImportError("The file scan_loop.c is not available.")
+            _logger.info("Compiling the C loop of scan")
+            code = open(cfile).read()
+            args = cmodule.GCC_compiler.compile_args()
+            cmodule.GCC_compiler.compile_str('scan_loop', code,
+                                             location=location,
+                                             preargs=args)
+            # Save version into the __init__.py file.
+            init_py = os.path.join(location, '__init__.py')
+            open(init_py, 'w').write('_version = %s\n' % version)
+            # Do not reload an outdated __init__.pyc below.
+            init_pyc = os.path.join(location, '__init__.pyc')
+            if os.path.isfile(init_pyc):
+                os.remove(init_pyc)
+            try_import()
+            try_reload()
+            from scan_loop import scan_loop as scan_c
+            assert scan_loop._version == scan_c.get_version()
+    finally:
+        release_lock()
+
+from scan_loop import scan_loop as _scan_loop
+assert version == _scan_loop.get_version()
+
+
+def perform(n_shared_outs, n_mit_mot_outs, n_seqs, n_mit_mot, n_mit_sot,
+            n_sit_sot, n_nit_sot, n_steps, as_while, mintaps, tap_array,
+            tap_array_len, vector_seqs, vector_outs, mit_mot_out_slices,
+            mit_mot_out_nslices, fn, fnct, destroy_map, args, outs, self,
+            node):
+    """
+    Run the loop of the Scan `self`, like `scan_perform.perform` (it
+    takes the same arguments).
+
+    Return NotImplemented, without doing anything, if the values are not
+    all numpy ndarrays. `scan_perform.perform` must be used then.
+    """
+    t0_call = time.time()
+    t_fn = _scan_loop.perform(
+        n_shared_outs, n_mit_mot_outs, n_seqs, n_mit_mot, n_mit_sot,
+        n_sit_sot, n_nit_sot, n_steps, as_while, mintaps, tap_array,
+        tap_array_len, vector_seqs, vector_outs, mit_mot_out_slices,
+        mit_mot_out_nslices, fn, fnct, destroy_map, args, outs, self, node)
+    if t_fn is NotImplemented:
+        return NotImplemented
+    t_call = time.time() - t0_call
+
+    if hasattr(fnct.maker, 'profile'):
+        profile = fnct.maker.profile
+        if type(profile) is not bool and profile:
+            profile.vm_call_time += t_fn
+            profile.callcount += 1
+            profile.nbsteps += n_steps
+            profile.call_time += t_call
+            if hasattr(fn, 'update_profile'):
+                fn.update_profile(profile)
+
+    self.t_call = t_call
+    self.t_fn = t_fn
@@ -12,6 +12,7 @@ __authors__ = ("Razvan Pascanu "
 __copyright__ = "(c) 2010, Universite de Montreal"
 __contact__ = "Razvan Pascanu <r.pascanu@gmail>"
 
+import copy
 import itertools
 import logging
 import time
@@ -37,12 +38,26 @@ from theano.scan_module.scan_utils import safe_new, forced_replace
 _logger = logging.getLogger('theano.scan_module.scan_op')
 
 
-from theano.configparser import AddConfigVar, BoolParam
+from theano.configparser import AddConfigVar, BoolParam, IntParam
 
 AddConfigVar('scan.allow_gc',
              "Allow/disallow gc inside of Scan (default: False)",
              BoolParam(False))
 
+AddConfigVar('scan.c_loop',
+             "Run the loop of Scan in C, when its values are numpy arrays."
+             " If False, or for other values (e.g. on the GPU), the loop is"
+             " run by the Cython code (default: True)",
+             BoolParam(True))
+
+AddConfigVar('scan.threads',
+             "Number of threads that run the iterations of the Scan ops whose"
+             " iterations are independent (only sequences and outputs that"
+             " are not fed back, like theano.map). 1 runs them one after"
+             " the other (default: 1)",
+             IntParam(1, lambda i: i > 0),
+             in_c_key=False)
+
 
 class Scan(PureOp):
     def __init__(self,
@@ -534,8 +549,15 @@ class Scan(PureOp):
                   self.n_mit_sot +
                   self.n_sit_sot +
                   self.n_nit_sot)
-        wrapped_inputs = [Param(x, borrow=True) for x in self.inputs]
-        wrapped_outputs = [Out(x, borrow=False) for x in
+        # The loops set the storage of these outputs before each step (to
+        # the view of their buffer in which they can be computed, or None)
+        # and copy their values, so they are borrowed. Otherwise the inner
+        # function would clear the storage, and allocate them at each step.
+        # The inputs are not: an output that is a view of an input (e.g. of
+        # a tap, which is a view of a buffer) is still copied, as the loops
+        # may overwrite that input before they copy the output.
+        wrapped_inputs = [Param(x, borrow=False) for x in self.inputs]
+        wrapped_outputs = [Out(x, borrow=True) for x in
                            self.outputs[:slices]]
         wrapped_outputs += self.outputs[slices:]
         profile = None
@@ -600,30 +622,42 @@ class Scan(PureOp):
             cython_destroy_map = numpy.asarray(cython_destroy_map,
                                                dtype='int32')
             import scan_perform_ext
-            p = lambda node, args, outs:\
-                    scan_perform_ext.perform(
-                        self.n_shared_outs,
-                        self.n_mit_mot_outs,
-                        self.n_seqs,
-                        self.n_mit_mot,
-                        self.n_mit_sot,
-                        self.n_sit_sot,
-                        self.n_nit_sot,
-                        args[0],
-                        self.as_while,
-                        cython_mintaps,
-                        cython_tap_array,
-                        cython_tap_array_len,
-                        cython_vector_seqs,
-                        cython_vector_outs,
-                        cython_mit_mot_out_slices,
-                        cython_mit_mot_out_nslices,
-                        self.fn.fn,
-                        self.fn,
-                        cython_destroy_map,
-                        args,
-                        outs,
-                        self, node)
+            perform_fns = [scan_perform_ext.perform]
+            if config.scan.c_loop:
+                try:
+                    import scan_loop_ext
+                    perform_fns.insert(0, scan_loop_ext.perform)
+                except (ImportError, theano.gof.cmodule.MissingGXX):
+                    _logger.warning("The C loop of scan could not be"
+                                    " compiled, the Cython one is used.")
+
+            def p(node, args, outs):
+                for perform in perform_fns:
+                    r = perform(
+                            self.n_shared_outs,
+                            self.n_mit_mot_outs,
+                            self.n_seqs,
+                            self.n_mit_mot,
+                            self.n_mit_sot,
+                            self.n_sit_sot,
+                            self.n_nit_sot,
+                            args[0],
+                            self.as_while,
+                            cython_mintaps,
+                            cython_tap_array,
+                            cython_tap_array_len,
+                            cython_vector_seqs,
+                            cython_vector_outs,
+                            cython_mit_mot_out_slices,
+                            cython_mit_mot_out_nslices,
+                            self.fn.fn,
+                            self.fn,
+                            cython_destroy_map,
+                            args,
+                            outs,
+                            self, node)
+                    if r is not NotImplemented:
+                        return r
         except (ImportError, theano.gof.cmodule.MissingGXX):
             p = self.execute
         # default arguments are stored in the closure of `rval`
@@ -632,6 +666,9 @@ class Scan(PureOp):
         # for the englobing function.
         allow_gc = config.allow_gc and not self.allow_gc
 
+        if config.scan.threads > 1 and self.is_map():
+            p = self.make_parallel_perform(p, config.scan.threads, allow_gc)
+
         def rval(p=p, i=node_input_storage, o=node_output_storage, n=node,
                  allow_gc=allow_gc):
             r = p(n, [x[0] for x in i], o)
@@ -646,6 +683,124 @@ class Scan(PureOp):
         rval.lazy = False
         return rval
 
+    def is_map(self):
+        """
+        Return True if the iterations of this Scan are independent: it has
+        only sequences and nit_sot outputs, no condition, and the inner
+        function has no op with an inner function of its own (their
+        storage would be shared by the threads of
+        `make_parallel_perform`).
+        """
+        if (self.n_mit_mot or self.n_mit_sot or self.n_sit_sot or
+                self.n_shared_outs or self.as_while or not self.n_nit_sot):
+            return False
+        return not any(type(nd.op) in gof.op.ops_with_inner_function
+                       for nd in self.fn.maker.fgraph.apply_nodes)
+
+    def make_parallel_perform(self, perform, n_threads, allow_gc):
+        """
+        Return a version of `perform` (see make_thunk) that runs the
+        iterations of a Scan for which `is_map` is True on a pool of
+        `n_threads` threads.
+
+        The first iteration is run by `perform`, which allocates the
+        outputs. The others are split in `n_threads` ranges, each run with
+        its own copy of the inner function, and write their outputs in
+        place. The C thunks release the GIL around BLAS calls, so inner
+        functions that spend their time there use several cores.
+
+        `perform` runs all the iterations when the sequences are not numpy
+        ndarrays (e.g. on the GPU), when not all of them are kept (the
+        outputs are then circular buffers), or when called from a thread of
+        the pool (waiting for the other threads could deadlock).
+        """
+        fns = []
+        n_seqs = self.n_seqs
+
+        def parallel_perform(node, args, outs):
+            n_steps = int(args[0])
+            store_steps = args[1 + n_seqs:1 + n_seqs + self.n_nit_sot]
+            if (n_steps < 2 or
+                    getattr(gof.vm._worker_state, 'active', False) or
+                    any(s != n_steps for s in store_steps) or
+                    any(type(s) is not numpy.ndarray
+                        for s in args[1:1 + n_seqs])):
+                return perform(node, args, outs)
+            perform(node, [1] + list(args[1:]), outs)
+            if any(type(o[0]) is not numpy.ndarray or len(o[0]) != n_steps
+                   for o in outs[:self.n_nit_sot]):
+                return perform(node, args, outs)
+
+            while len(fns) < n_threads:
+                fns.append(copy.copy(self.fn))
+            bounds = numpy.linspace(1, n_steps, n_threads + 1).astype(int)
+            pool = gof.vm.get_thread_pool(n_threads)
+            results = [pool.apply_async(self.run_steps,
+                                        (fn, begin, end, args, outs))
+                       for fn, begin, end in zip(fns, bounds[:-1],
+                                                 bounds[1:])
+                       if begin < end]
+            # Wait for all the threads before raising the first error.
+            errors = []
+            for r in results:
+                try:
+                    r.get()
+                except Exception, e:
+                    errors.append(e)
+            if allow_gc:
+                for fn in fns:
+                    fn.free()
+            if errors:
+                raise errors[0]
+        return parallel_perform
+
+    def run_steps(self, fn, begin, end, args, outs):
+        """
+        Run the iterations `begin` to `end` - 1 of a Scan for which
+        `is_map` is True, with `fn`, a copy of the inner function. The
+        outputs are written in place in the buffers `outs`.
+        """
+        def row(a, i):
+            if a.ndim == 1:
+                return a[i:i + 1].reshape(())
+            return a[i]
+
+        n_seqs = self.n_seqs
+        seqs = args[1:1 + n_seqs]
+        bufs = [o[0] for o in outs[:self.n_nit_sot]]
+        input_storage = [c.storage for c in fn.input_storage]
+        output_storage = [c.storage for c in fn.output_storage]
+        for cell, arg in zip(input_storage[n_seqs:],
+                             args[1 + n_seqs + self.n_nit_sot:]):
+            cell[0] = arg
+        vm = fn.fn
+        try:
+            for i in xrange(begin, end):
+                for cell, seq in izip(input_storage, seqs):
+                    cell[0] = row(seq, i)
+                # Let the inner function compute the outputs in place.
+                views = [row(buf, i) for buf in bufs]
+                for cell, view in izip(output_storage, views):
+                    cell[0] = view
+                try:
+                    vm()
+                except Exception:
+                    if hasattr(vm, 'position_of_error'):
+                        if hasattr(vm, 'thunks'):
+                            gof.link.raise_with_op(
+                                vm.nodes[vm.position_of_error],
+                                vm.thunks[vm.position_of_error])
+                        else:
+                            gof.vm.raise_with_op(
+                                vm.nodes[vm.position_of_error])
+                    raise
+                for cell, view, buf in izip(output_storage, views, bufs):
+                    if cell[0] is not view:
+                        buf[i] = cell[0]
+        finally:
+            for cell in input_storage + output_storage:
+                cell[0] = None
+
     def inner_seqs(self, list_inputs):
         # Given the list of inner inputs this function grabs those
         # corresponding to sequences
@@ -62,7 +62,7 @@ import copy
 
 
 def get_version():
-    return 0.284
+    return 0.285
 
 @cython.boundscheck(False)
 def perform(
@@ -171,9 +171,15 @@ def perform(
                                             n_shared_outs)
     cdef unsigned int offset_out
     cdef unsigned int lenpos = n_outs + n_nit_sot
-    cdef int pos[500] # put a maximum of 500 outputs
-    cdef unsigned int len_store_steps = n_mit_mot + n_mit_sot + n_sit_sot + n_nit_sot
-    cdef int store_steps[500]
+    # Length of the buffer of each output, and position in it of the
+    # current step (the buffers are used as ring buffers).
+    cdef numpy.ndarray[numpy.int32_t,ndim=1] pos = \
+            numpy.zeros(lenpos, dtype='int32')
+    cdef numpy.ndarray[numpy.int32_t,ndim=1] store_steps = \
+            numpy.zeros(lenpos, dtype='int32')
+    # The views of the buffers in which the inner function computes the
+    # outputs of the current step, see 4.
+    preallocated = [None] * lenpos
     cdef unsigned int l
     cdef unsigned int offset
     cdef int tap
@@ -307,19 +313,26 @@ def perform(
         for idx in range(n_mit_mot_outs):
             output_storage[idx].storage[0] = None
 
+        # The other outputs are given the view of their buffer at the
+        # current position, so that the ops that reuse their output
+        # storage (most C ops) compute them there, and they do not have to
+        # be allocated and copied at each step. This is not done if the
+        # view is also one of the inputs of the step, or if the buffer of
+        # a nit_sot output does not exist yet (it is allocated after the
+        # first step, from the shape of its value).
         offset = n_mit_mot_outs
-        if i !=0 and n_nit_sot >0:
-            for idx in range(n_outs + n_nit_sot - n_mit_mot):
-                if ( store_steps[<unsigned int>(idx+n_mit_mot)] == 1 or
-                    vector_outs[<unsigned int>(idx+n_mit_mot)] == 1):
-                    output_storage[<unsigned int>(idx+offset)].storage[0] = None
-                else:
-                    output_storage[<unsigned int>(idx+offset)].storage[0] =\
-                        outs[<unsigned int>(idx+n_mit_mot)][0][pos[\
-                                            <unsigned int>(idx+n_mit_mot)]]
-        else:
-            for idx in range(n_outs + n_nit_sot - n_mit_mot):
-                output_storage[<unsigned int>(idx+offset)].storage[0] = None
+        for idx in range(n_outs + n_nit_sot - n_mit_mot):
+            j = idx + n_mit_mot
+            buf = outs[j][0]
+            if (buf is None or store_steps[j] <= -mintaps[j] or
+                    buf.shape[0] < store_steps[j]):
+                preallocated[j] = None
+            elif vector_outs[j] == 1:
+                preallocated[j] = buf[pos[j]:<unsigned int>(pos[j]+1)].reshape(())
+            else:
+                preallocated[j] = buf[pos[j]]
+            output_storage[<unsigned int>(idx+offset)].storage[0] = \
+                    preallocated[j]
 
         offset += n_outs+n_nit_sot - n_mit_mot
         for idx in range(n_shared_outs):
@@ -363,9 +376,8 @@ def perform(
         offset_out -= n_mit_mot
 
         for j in range(begin, end):
-            if ( store_steps[j] == 1 or vector_outs[j] ==1 or
-                outs[j][0][pos[j]] is not output_storage[<unsigned int>(offset_out+j)].storage[0]):
-
+            if (output_storage[<unsigned int>(offset_out+j)].storage[0] is not
+                    preallocated[j]):
                 outs[j][0][pos[j]] = output_storage[<unsigned int>(offset_out+j)].storage[0]
 
         # 5.3 Copy over the values for nit_sot outputs
@@ -385,9 +397,7 @@ def perform(
                     outs[j][0] = node.outputs[j].type.value_zeros(shape)
                 elif outs[j][0].shape[0] != store_steps[j]:
                     outs[j][0] = outs[j][0][:store_steps[j]]
-                outs[j][0][pos[j]] = output_storage[jout].storage[0]
-            elif (store_steps[j] == 1 or vector_outs[j] == 1 or
-                  outs[j][0][pos[j]] is not output_storage[j+offset_out].storage[0]):
+            if output_storage[j+offset_out].storage[0] is not preallocated[j]:
                 outs[j][0][pos[j]] = output_storage[j+offset_out].storage[0]
 
 
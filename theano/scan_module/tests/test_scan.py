@@ -4279,3 +4279,259 @@ def test_constant_folding_n_steps():
         theano.function([], res)()
     finally:
         theano.config.on_opt_error = on_opt_error
+
+
+def check_c_loop(inputs, outputs, values, updates=None):
+    """
+    Check that the C loop of scan computes the same values as the Cython
+    one.
+    """
+    if not theano.config.cxx:
+        raise SkipTest('The C loop of scan needs a C compiler')
+    c_loop = theano.config.scan.c_loop
+    results = []
+    try:
+        for flag in (True, False):
+            theano.config.scan.c_loop = flag
+            f = theano.function(inputs, outputs, updates=updates,
+                                mode=mode_with_opt)
+            shared = [(s, s.get_value()) for s in updates or []]
+            # Run twice, the second time with the buffers of the first.
+            f(*values)
+            results.append(f(*values))
+            for s, v in shared:
+                results[-1].append(s.get_value())
+                s.set_value(v)
+    finally:
+        theano.config.scan.c_loop = c_loop
+    for r_c, r_cython in zip(*results):
+        utt.assert_allclose(r_c, r_cython)
+
+
+def test_c_loop_taps():
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    x = tensor.matrix('x')
+    y0 = tensor.matrix('y0')
+    z0 = tensor.vector('z0')
+    W = theano.shared(asarrayX(rng.uniform(size=(3, 3))), name='W')
+    count = theano.shared(asarrayX(0), name='count')
+
+    def step(x_t, y_tm3, y_tm1, z_tm1, count, W):
+        y_t = tensor.tanh(tensor.dot(y_tm1, W) + y_tm3 + x_t)
+        z_t = z_tm1 + y_t.sum()
+        return [y_t, z_t, y_t * 2], {count: count + 1}
+
+    [y, z, w], updates = theano.scan(
+        step, sequences=x,
+        outputs_info=[dict(initial=y0, taps=[-3, -1]), z0, None],
+        non_sequences=[count, W])
+    check_c_loop([x, y0, z0], [y, z, w, y[-1], z[-2]],
+                 [asarrayX(rng.uniform(size=(7, 3))),
+                  asarrayX(rng.uniform(size=(3, 3))),
+                  asarrayX(rng.uniform(size=(2,)))],
+                 updates=updates)
+
+
+def test_c_loop_grad():
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    x = tensor.matrix('x')
+    h0 = tensor.vector('h0')
+    W = theano.shared(asarrayX(rng.uniform(size=(4, 4)) - .5), name='W')
+
+    h, _ = theano.scan(lambda x_t, h_tm1: tensor.tanh(
+        tensor.dot(h_tm1, W) + x_t), sequences=x, outputs_info=h0)
+    cost = (h[-3:] ** 2).sum()
+    gW, gx, gh0 = tensor.grad(cost, [W, x, h0])
+    check_c_loop([x, h0], [h, gW, gx, gh0],
+                 [asarrayX(rng.uniform(size=(6, 4))),
+                  asarrayX(rng.uniform(size=(4,)))])
+
+
+def test_c_loop_until():
+    x = tensor.vector('x')
+
+    def step(x_t, s_tm1):
+        s_t = s_tm1 + x_t
+        return [s_t, x_t * 3], theano.scan_module.until(s_t > 10)
+
+    [s, w], _ = theano.scan(step, sequences=x,
+                            outputs_info=[tensor.constant(asarrayX(0)),
+                                          None])
+    check_c_loop([x], [s, w, s[-1]],
+                 [asarrayX(numpy.arange(20))])
+
+
+def check_scan_loops(inputs, outputs, calls, mode=mode_with_opt):
+    """
+    Check the values computed by the C loop and the Cython loop of scan.
+
+    `calls` is a list of `(values, expected)` pairs. The calls are done in
+    that order with the same function, so each one reuses the buffers of
+    the previous one. The values returned by a call must not change during
+    the next ones.
+    """
+    if not theano.config.cxx:
+        raise SkipTest('The loops of scan need a C compiler')
+    c_loop = theano.config.scan.c_loop
+    try:
+        for flag in (True, False):
+            theano.config.scan.c_loop = flag
+            f = theano.function(inputs, outputs, mode=mode)
+            results = [f(*values) for values, expected in calls]
+            for r_call, (values, expected) in zip(results, calls):
+                assert len(r_call) == len(expected)
+                for r, e in zip(r_call, expected):
+                    utt.assert_allclose(r, e)
+    finally:
+        theano.config.scan.c_loop = c_loop
+
+
+def test_scan_loops_many_outputs():
+    # The loops used to have room for 500 outputs only.
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    x = tensor.matrix('x')
+    a = [tensor.scalar('a%d' % i) for i in xrange(501)]
+    outputs, _ = theano.map(
+        lambda x_t, *a: [x_t * a_i for a_i in a] + [x_t.sum()],
+        sequences=x, non_sequences=a)
+    assert len(outputs) == 502
+    x_val = asarrayX(rng.uniform(size=(4, 3)))
+    a_val = [asarrayX(i) for i in xrange(501)]
+    # The optimization of such a graph is slow, and not what is tested.
+    check_scan_loops([x] + a, outputs,
+                     [([x_val] + a_val,
+                       [x_val * i for i in xrange(501)] +
+                       [x_val.sum(axis=1)])],
+                     mode=theano.Mode(linker='cvm', optimizer=None))
+
+
+def test_scan_loops_short_buffer():
+    # When only the last values are used, the buffer of a mit_sot output
+    # is not longer than its furthest tap, and the inner function can not
+    # compute the output in the buffer, as it is read by the same step (in
+    # another order for z).
+    y0 = tensor.vector('y0')
+    z0 = tensor.matrix('z0')
+    n = tensor.iscalar('n')
+    y, _ = theano.scan(lambda y_tm2, y_tm1: y_tm2 + y_tm1,
+                       outputs_info=dict(initial=y0, taps=[-2, -1]),
+                       n_steps=n)
+    z, _ = theano.scan(lambda z_tm3, z_tm1: tensor.tanh(z_tm3[::-1] + z_tm1),
+                       outputs_info=dict(initial=z0, taps=[-3, -1]),
+                       n_steps=n)
+
+    def numpy_scan(init, taps, fn, n_steps):
+        values = list(init)
+        for i in xrange(n_steps):
+            values.append(fn(*[values[len(values) + t] for t in taps]))
+        return numpy.asarray(values[len(init):])
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    y0_val = asarrayX([1, 1])
+    z0_val = asarrayX(rng.uniform(size=(3, 4)))
+    calls = []
+    for n_steps in [1, 2, 7]:
+        y_val = numpy_scan(y0_val, [-2, -1], lambda a, b: a + b, n_steps)
+        z_val = numpy_scan(z0_val, [-3, -1],
+                           lambda a, b: numpy.tanh(a[::-1] + b), n_steps)
+        calls.append(([y0_val, z0_val, n_steps],
+                      [y_val[-1], y_val[-2:], z_val[-1], y_val, z_val]))
+    check_scan_loops([y0, z0, n], [y[-1], y[-2:], z[-1]],
+                     [(values, expected[:3]) for values, expected in calls])
+    # With the whole buffers.
+    check_scan_loops([y0, z0, n], [y, z],
+                     [(values, expected[3:]) for values, expected in calls])
+
+
+def test_scan_loops_shape_change():
+    # The buffers of the nit_sot outputs of a call are reused by the next
+    # one, even if the shapes changed.
+    x = tensor.matrix('x')
+    h0 = tensor.vector('h0')
+
+    def step(x_t, h_tm1):
+        h_t = tensor.tanh(h_tm1 + x_t)
+        return h_t, x_t * 2, h_t.sum()
+    [h, w, s], _ = theano.scan(step, sequences=x,
+                               outputs_info=[h0, None, None])
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    calls = []
+    for shape in [(5, 3), (5, 4), (3, 4), (7, 4), (7, 1)]:
+        x_val = asarrayX(rng.uniform(size=shape))
+        h0_val = asarrayX(rng.uniform(size=shape[1:]))
+        h_val = []
+        h_tm1 = h0_val
+        for x_t in x_val:
+            h_tm1 = numpy.tanh(h_tm1 + x_t)
+            h_val.append(h_tm1)
+        h_val = numpy.asarray(h_val)
+        calls.append(([x_val, h0_val],
+                      [h_val, x_val * 2, h_val.sum(axis=1), x_val[-1:] * 2]))
+    check_scan_loops([x, h0], [h, w, s, w[-1:]], calls)
+
+
+def test_scan_checkpoints():
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    x = tensor.matrix('x')
+    h0 = tensor.vector('h0')
+    W = theano.shared(asarrayX(rng.uniform(-.5, .5, size=(4, 4))), name='W')
+
+    def step(x_t, h_tm1):
+        h_t = tensor.tanh(tensor.dot(h_tm1, W) + x_t)
+        return h_t, h_t.sum()
+
+    [h, s], _ = theano.scan(step, sequences=x, outputs_info=[h0, None])
+    cost = h[-1].sum() + s[-1]
+    grads = tensor.grad(cost, [W, x, h0])
+    outputs = [h[-1], s[-1]] + grads
+    for kwargs in [{}, {'save_every_N': 3}, {'memory_budget': 40}]:
+        [hc, sc], _ = theano.scan_checkpoints(
+            step, sequences=x, outputs_info=[h0, None], **kwargs)
+        cost_c = hc[-1].sum() + sc[-1]
+        outputs += [hc[-1], sc[-1]] + tensor.grad(cost_c, [W, x, h0])
+    f = theano.function([x, h0], outputs)
+    # With and without a shorter last segment.
+    for n_steps in [1, 7, 9]:
+        out = f(asarrayX(rng.uniform(size=(n_steps, 4))),
+                asarrayX(rng.uniform(size=(4,))))
+        for i in xrange(5, len(out)):
+            utt.assert_allclose(out[i % 5], out[i])
+
+
+def test_scan_checkpoints_taps():
+    x = tensor.vector('x')
+    y0 = tensor.vector('y0')
+    try:
+        theano.scan_checkpoints(lambda x_t, y_tm2: x_t + y_tm2,
+                                sequences=x,
+                                outputs_info=dict(initial=y0, taps=[-2]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('scan_checkpoints accepted taps')
+
+
+def test_map_threads():
+    rng = numpy.random.RandomState(utt.fetch_seed())
+    v = tensor.vector('v')
+    m = tensor.matrix('m')
+    W = theano.shared(asarrayX(rng.uniform(size=(3, 4))), name='W')
+    [a, b, c], _ = theano.map(
+        lambda v_t, m_t: [v_t * 2 + 1, tensor.dot(m_t, W), m_t.sum()],
+        sequences=[v, m])
+    outputs = [a, b, c, b[-2:]]
+    threads = theano.config.scan.threads
+    try:
+        theano.config.scan.threads = 1
+        f = theano.function([v, m], outputs, mode=mode_with_opt)
+        theano.config.scan.threads = 3
+        f_threads = theano.function([v, m], outputs, mode=mode_with_opt)
+    finally:
+        theano.config.scan.threads = threads
+    scan_nodes = [node for node in f_threads.maker.fgraph.toposort()
+                  if isinstance(node.op, Scan)]
+    assert scan_nodes and all(node.op.is_map() for node in scan_nodes)
+    for n_steps in [1, 2, 10]:
+        v_val = asarrayX(rng.uniform(size=(n_steps,)))
+        m_val = asarrayX(rng.uniform(size=(n_steps, 3)))
+        for r, r_threads in zip(f(v_val, m_val), f_threads(v_val, m_val)):
+            utt.assert_allclose(r, r_threads)
@@ -3,6 +3,7 @@
 __docformat__ = "restructuredtext en"
 
 import sys
+import threading
 import warnings
 from itertools import izip
 
@@ -419,7 +420,7 @@ def constant(x, name=None, ndim=None, dtype=None):
     # So we cache integer with dtype [u]int and float where the value is
     # between -10 and 10
     # We want to cache all broadcast pattern for scalar.
-    if not constant.enable:
+    if not constant.enable or not getattr(constant.local, 'enable', True):
         return ret
     sig = ret.signature()
     if (sig not in constant_cache and ret.data.size == 1 and
@@ -432,6 +433,9 @@ def constant(x, name=None, ndim=None, dtype=None):
 
     return constant_cache.get(sig, ret)
 constant.enable = True
+# `Optimizer.optimize` disables the cache in the thread that optimizes, as
+# other threads can build or optimize other graphs at the same time.
+constant.local = threading.local()
 constant_cache = {}
 
 
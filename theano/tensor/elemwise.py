@@ -2116,3 +2116,287 @@ class ProdWithoutZeros(CAReduceDtype):
     def __init__(self, axis=None, dtype=None, acc_dtype=None):
         CAReduceDtype.__init__(self, mul_without_zeros, axis=axis,
                                dtype=dtype, acc_dtype=acc_dtype)
+
+
+class ElemwiseCAReduce(Op):
+    """
+    Reduces the result of an elementwise operation, without storing it.
+
+    ElemwiseCAReduce(scalar_op, reduce_op)(*inputs) computes
+    reduce_op(Elemwise(scalar_op)(*inputs)), but its C code applies
+    scalar_op inside the loop of the reduction. This saves the
+    allocation of the intermediate array and a pass over it. It is
+    introduced by the optimization local_careduce_fusion.
+
+    The gradient is not defined: this op is only meant to be introduced
+    after the gradient is computed.
+    """
+
+    def __init__(self, scalar_op, reduce_op):
+        """
+        :param scalar_op: a scalar op with only one output (often a
+            Composite).
+
+        :param reduce_op: a CAReduce (e.g. Sum) whose C code is the one of
+            CAReduce, and whose scalar op has an identity or is maximum or
+            minimum.
+        """
+        if scalar_op.nout != 1:
+            raise NotImplementedError(
+                "ElemwiseCAReduce only supports scalar ops with a single"
+                " output.")
+        self.scalar_op = scalar_op
+        self.reduce_op = reduce_op
+
+    def __eq__(self, other):
+        return (type(self) == type(other)
+                and self.scalar_op == other.scalar_op
+                and self.reduce_op == other.reduce_op)
+
+    def __hash__(self):
+        return hash(type(self)) ^ hash(self.scalar_op) ^ hash(self.reduce_op)
+
+    def __str__(self):
+        return "%s{%s}" % (self.reduce_op, self.scalar_op)
+
+    def make_node(self, *inputs):
+        inputs = map(as_tensor_variable, inputs)
+        elemwise_out = Elemwise(self.scalar_op)(*inputs)
+        reduce_node = self.reduce_op.make_node(elemwise_out)
+        if reduce_node.op == self.reduce_op:
+            op = self
+        else:
+            # The reduce op normalizes its axis and dtypes.
+            op = self.__class__(self.scalar_op, reduce_node.op)
+        return Apply(op, inputs, [reduce_node.outputs[0].type()])
+
+    def inner_nodes(self, node):
+        """
+        Return the Elemwise and the reduction nodes that `node` fuses.
+        """
+        elemwise_node = Elemwise(self.scalar_op).make_node(
+            *[input.type() for input in node.inputs])
+        reduce_node = self.reduce_op.make_node(elemwise_node.outputs[0])
+        return elemwise_node, reduce_node
+
+    def perform(self, node, inputs, output_storage):
+        elemwise_node, reduce_node = self.inner_nodes(node)
+        storage = [None]
+        elemwise_node.op.perform(elemwise_node, inputs, [storage])
+        reduce_node.op.perform(reduce_node, storage, output_storage)
+
+    def infer_shape(self, node, shapes):
+        elemwise_node, reduce_node = self.inner_nodes(node)
+        elemwise_shape = []
+        for dim, dims in enumerate(izip(*shapes)):
+            for input, shape in izip(node.inputs, dims):
+                if not input.type.broadcastable[dim]:
+                    elemwise_shape.append(shape)
+                    break
+            else:
+                elemwise_shape.append(1)
+        return self.reduce_op.infer_shape(reduce_node, [elemwise_shape])
+
+    def _c_all(self, node, name, inames, onames, sub):
+        _inames = inames
+        inames = gof.utils.uniq(inames)
+        inputs = gof.utils.uniq(node.inputs)
+        assert len(inames) == len(inputs)
+        elemwise_node, reduce_node = self.inner_nodes(node)
+        output = node.outputs[0]
+        oname = onames[0]
+
+        idtypes = [input.type.dtype_specs()[1] for input in inputs]
+        edtype_name = elemwise_node.outputs[0].type.dtype
+        edtype = elemwise_node.outputs[0].type.dtype_specs()[1]
+        odtype = output.type.dtype_specs()[1]
+        if getattr(self.reduce_op, 'acc_dtype', None) is not None:
+            acc_type = TensorType(broadcastable=output.broadcastable,
+                                  dtype=self.reduce_op.acc_dtype)
+            adtype = acc_type.dtype_specs()[1]
+        else:
+            adtype = odtype
+
+        ndim = node.inputs[0].type.ndim
+        axis = self.reduce_op.axis
+        if axis is None:
+            axis = range(ndim)
+        order1 = [i for i in xrange(ndim) if i not in axis]
+        order = order1 + list(axis)
+        nnested = len(order1)
+        # Same as order for each input, with 'x' at its broadcastable
+        # dimensions (see Elemwise._c_all).
+        orders = [[input.type.broadcastable[i] and 'x' or i for i in order]
+                  for input in inputs]
+
+        sub = dict(sub)
+        for i, iname in enumerate(inames):
+            sub['lv%i' % i] = iname
+
+        decl = ""
+        if adtype != odtype:
+            # Create an accumulator variable different from the output
+            aname = "acc"
+            decl = acc_type.c_declare(aname, sub)
+            decl += acc_type.c_init(aname, sub)
+        else:
+            aname = oname
+
+        decl += cgen.make_declare(orders, idtypes, sub)
+        checks = cgen.make_checks(orders, idtypes, sub)
+
+        # Allocate the output, with the dimensions of the inputs that are
+        # not reduced.
+        i = len(inames)
+        sub['lv%i' % i] = oname
+        sub['olv'] = oname
+        out_order = range(nnested) + ['x'] * len(axis)
+        alloc = cgen.make_declare([out_order], [odtype],
+                                  dict(sub, lv0=oname))
+        alloc += cgen.make_alloc([o[:nnested] for o in orders], odtype, sub)
+        alloc += cgen.make_checks([out_order], [odtype],
+                                  dict(sub, lv0=oname))
+        if adtype != odtype:
+            sub['lv%i' % i] = aname
+            sub['olv'] = aname
+            alloc += cgen.make_declare([out_order], [adtype],
+                                       dict(sub, lv0=aname))
+            alloc += cgen.make_alloc([o[:nnested] for o in orders], adtype,
+                                     sub)
+            alloc += cgen.make_checks([out_order], [adtype],
+                                      dict(sub, lv0=aname))
+
+        reduce_scalar_op = self.reduce_op.scalar_op
+        if hasattr(reduce_scalar_op, 'identity'):
+            identity = reduce_scalar_op.identity
+        elif reduce_scalar_op in [scalar.maximum, scalar.minimum]:
+            if reduce_scalar_op == scalar.maximum:
+                scal_name = 'maximum'
+                if edtype_name in ["float32", "float64"]:
+                    identity = "-__builtin_inf()"
+                elif edtype_name.startswith("uint"):
+                    identity = "0"
+                else:
+                    identity = "NPY_MIN_" + edtype_name.upper()
+            else:
+                scal_name = 'minimum'
+                if edtype_name in ["float32", "float64"]:
+                    identity = "__builtin_inf()"
+                else:
+                    identity = "NPY_MAX_" + edtype_name.upper()
+            # The elementwise result has a zero-size reduced dimension if
+            # one of the inputs that is not broadcasted on it does.
+            fail = sub["fail"]
+            for iname, input in izip(inames, inputs):
+                for i in axis:
+                    if input.type.broadcastable[i]:
+                        continue
+                    alloc += """
+if (PyArray_DIMS(%(iname)s)[%(i)s] == 0) {
+    PyErr_Format(PyExc_ValueError,
+         "Input of CAReduce{%(scal_name)s} has zero-size on axis %%d",
+         %(i)s);
+    %(fail)s;
+}
+                    """ % locals()
+        else:
+            raise TypeError(
+                    "The CAReduce.scalar_op must have an identity field.")
+
+        task0_decl = (
+                "%(dtype)s& %(name)s_i = *%(name)s_iter;\n"
+                "%(name)s_i = %(identity)s;"
+                % dict(dtype=adtype, name=aname, identity=identity))
+
+        task1_decl = "".join(["%s& %s_i = *%s_iter;\n" % (dtype, iname, iname)
+                              for iname, dtype in izip(inames, idtypes)])
+        task1_decl += "%s elemwise_i;\n" % edtype
+        elemwise_code = self.scalar_op.c_code(
+                Apply(self.scalar_op,
+                      [get_scalar_type(dtype=input.type.dtype).make_variable()
+                       for input in node.inputs],
+                      [get_scalar_type(dtype=edtype_name).make_variable()]),
+                name + '_scalar_',
+                ["%s_i" % s for s in _inames],
+                ["elemwise_i"],
+                sub)
+        reduce_code = reduce_scalar_op.c_code(
+                Apply(reduce_scalar_op,
+                      [get_scalar_type(dtype=edtype_name).make_variable()
+                       for i in xrange(2)],
+                      [get_scalar_type(dtype=output.type.dtype
+                                       ).make_variable()]),
+                None,
+                ["%s_i" % aname, "elemwise_i"],
+                ["%s_i" % aname],
+                sub)
+        code1 = """
+        {
+            %(task1_decl)s
+            %(elemwise_code)s
+            %(reduce_code)s
+        }
+        """ % locals()
+
+        if len(axis) == 1:
+            all_code = [("", "")] * nnested + [(task0_decl, code1), ""]
+        else:
+            all_code = ([("", "")] * nnested
+                        + [(task0_decl, "")]
+                        + [("", "")] * (len(axis) - 2)
+                        + [("", code1), ""])
+        loop = cgen.make_loop_careduce(
+                orders + [out_order], idtypes + [adtype], all_code, sub)
+
+        end = ""
+        if adtype != odtype:
+            end = """
+            PyArray_CopyInto(%(oname)s, %(aname)s);
+            """ % dict(oname=oname, aname=aname)
+            end += acc_type.c_cleanup(aname, sub)
+
+        return decl, checks, alloc, loop, end
+
+    def c_code(self, node, name, inames, onames, sub):
+        if node.inputs[0].type.ndim == 0 or self.reduce_op.axis == ():
+            # There is no loop to fuse, use perform.
+            raise NotImplementedError()
+        return "\n".join(self._c_all(node, name, inames, onames, sub))
+
+    def c_headers(self):
+        return ['<vector>', '<algorithm>']
+
+    def c_compile_args(self):
+        # Do not let the compiler fuse the elementwise operation and the
+        # accumulation (e.g. in a fused multiply-add instruction): the
+        # result would not be rounded like the one of the unfused graph.
+        return ['-ffp-contract=off']
+
+    def c_support_code(self):
+        return self.scalar_op.c_support_code()
+
+    def c_support_code_apply(self, node, name):
+        return self.scalar_op.c_support_code_apply(node, name + '_scalar_')
+
+    def c_code_cache_version_apply(self, node):
+        version = [1]  # the version corresponding to the c code in this Op
+
+        # now we insert versions for the ops on which we depend...
+        elemwise_node, reduce_node = self.inner_nodes(node)
+        for op, inputs, outputs in [
+                (self.scalar_op, node.inputs, elemwise_node.outputs),
+                (self.reduce_op.scalar_op, elemwise_node.outputs * 2,
+                 node.outputs)]:
+            scalar_node = Apply(op,
+                    [get_scalar_type(dtype=input.type.dtype).make_variable()
+                     for input in inputs],
+                    [get_scalar_type(dtype=output.type.dtype).make_variable()
+                     for output in outputs])
+            version.append(op.c_code_cache_version_apply(scalar_node))
+        for i in node.inputs + node.outputs:
+            version.append(
+                get_scalar_type(dtype=i.type.dtype).c_code_cache_version())
+        if all(version):
+            return tuple(version)
+        else:
+            return ()
@@ -756,17 +756,43 @@ class ShapeFeature(object):
     non-constant... or are integer literals sometimes Theano
     constants?? That would be confusing.
 
+    Shape elements that are known at compile time (the shape of constants,
+    of `SpecifyShape` with a constant shape, or of ops like ConvOp with a
+    given image_shape) are always the same int64 Constant for a given value,
+    see `int_constant`, and no `Shape_i` node is created for them.
+
+    The results of `infer_shape` are memoized in `infer_shape_cache`, keyed
+    by the op, the inputs and the input shapes of the node, so that nodes
+    rebuilt by optimizations (and then merged or reverted) do not build
+    their shape graph again.
+
     """
 
+    def int_constant(self, value):
+        """Return the int64 Constant of the shape element `value`.
+
+        The same object is always returned for a given value, so that the
+        shape graphs do not need to be merged.
+        """
+        value = int(value)
+        try:
+            return self.int_constants[value]
+        except KeyError:
+            c = self.int_constants[value] = T.constant(value, dtype='int64')
+            return c
+
     def shape_ir(self, i, r):
         """Return symbolic r.shape[i] for tensor variable r, int i"""
         if hasattr(r.type, "broadcastable") and r.type.broadcastable[i]:
             return self.lscalar_one
+        elif (isinstance(r, Constant) and
+              isinstance(r.data, numpy.ndarray)):
+            return self.int_constant(r.data.shape[i])
         else:
             # Do not call make_node for test_value
             s = Shape_i(i)(r)
             try:
-                s = get_scalar_constant_value(s)
+                s = self.int_constant(get_scalar_constant_value(s))
             except NotScalarConstantError:
                 pass
             return s
@@ -809,7 +835,7 @@ class ShapeFeature(object):
             (isinstance(s_i, numpy.ndarray) and s_i.ndim == 0)):
             # this shape is a constant
             assert s_i >= 0
-            return T.constant(s_i, dtype='int64')
+            return self.int_constant(s_i)
         if type(s_i) in (tuple, list):
             # this dimension is the same as many of the inputs
             # which tells us that if one of the inputs is known,
@@ -843,6 +869,18 @@ class ShapeFeature(object):
         if s_i.type.dtype[:3] in ('int', 'uint'):
             if getattr(s_i.type, 'ndim', 0):
                 raise TypeError('Shape element must be scalar', s_i)
+            if (s_i.owner is not None and
+                    not isinstance(s_i.owner.op, Shape_i)):
+                # Propagate the shapes known at compile time, like
+                # the ones given to SpecifyShape.
+                try:
+                    val = get_scalar_constant_value(s_i, elemwise=False)
+                    if val >= 0:
+                        return self.int_constant(val)
+                except NotScalarConstantError:
+                    pass
+            elif isinstance(s_i, Constant):
+                return self.int_constant(s_i.data)
             return s_i
         else:
             raise TypeError('Unsupported shape element',
@@ -879,6 +917,7 @@ class ShapeFeature(object):
                     shape_vars.append(self.unpack(s[i]))
             assert all([not hasattr(r.type, "broadcastable") or
                         not r.type.broadcastable[i] or
+                        shape_vars[i] is self.lscalar_one or
                         # The two following comparison are a speed optimization
                         # But we never timed this speed optimization!
                         self.lscalar_one.equals(shape_vars[i]) or
@@ -955,6 +994,7 @@ class ShapeFeature(object):
         assert all([(not hasattr(r.type, "broadcastable") or
                      not r.type.broadcastable[i] and
                      not other_r.type.broadcastable[i]) or
+                    merged_shape[i] is self.lscalar_one or
                     # The two following comparison are a speed optimization
                     # But we never timed this speed optimization!
                     self.lscalar_one.equals(merged_shape[i]) or
@@ -979,6 +1019,7 @@ class ShapeFeature(object):
                 new_shape.append(s_j)
         assert all([not hasattr(r.type, "broadcastable") or
                     not r.type.broadcastable[idx] or
+                    new_shape[idx] is self.lscalar_one or
                     # The two following comparison are a speed optimization
                     # But we never timed this speed optimization!
                     self.lscalar_one.equals(new_shape[idx]) or
@@ -1010,6 +1051,11 @@ class ShapeFeature(object):
         # variable for multiple fgraph!
         self.lscalar_one = T.constant(1, dtype='int64')
         assert self.lscalar_one.type == T.lscalar
+        self.int_constants = {1: self.lscalar_one}
+        # int -> int64 Constant
+
+        self.infer_shape_cache = {}
+        # (op, inputs, input shapes) -> output shapes
 
         self.shape_of = {}
         # Variable -> tuple(scalars) or None  (All tensor vars map to tuple)
@@ -1034,17 +1080,32 @@ class ShapeFeature(object):
             # make sure we have shapes for the inputs
             self.init_r(r)
 
+        i_shapes = [self.shape_of[r] for r in node.inputs]
+        cache_key = (node.op, tuple(node.inputs), tuple(i_shapes))
+        try:
+            o_shapes = self.infer_shape_cache.get(cache_key)
+        except TypeError:
+            # Unhashable op.
+            cache_key = None
+            o_shapes = None
+        if o_shapes is not None:
+            for r, s in izip(node.outputs, o_shapes):
+                self.set_shape(r, s)
+            return
+
         try:
             shape_infer = node.op.infer_shape
         except AttributeError:
             shape_infer = self.default_infer_shape
+            # The default shapes are Shape_i of the outputs of this node.
+            cache_key = None
 
         try:
-            o_shapes = shape_infer(node,
-                                   [self.shape_of[r] for r in node.inputs])
+            o_shapes = shape_infer(node, i_shapes)
         except ShapeError:
             o_shapes = self.default_infer_shape(node, [self.shape_of[r] for
                                                        r in node.inputs])
+            cache_key = None
         except NotImplementedError, e:
             raise NotImplementedError(
                     'Code called by infer_shape failed raising a '
@@ -1064,6 +1125,7 @@ class ShapeFeature(object):
                 _logger.warning(msg)
             o_shapes = self.default_infer_shape(
                 node, [self.shape_of[r] for r in node.inputs])
+            cache_key = None
 
         # this is packed information
         # an element of o_shapes is either None or a tuple
@@ -1105,6 +1167,23 @@ class ShapeFeature(object):
         for r, s in izip(node.outputs, o_shapes):
             self.set_shape(r, s)
 
+        if cache_key is not None:
+            # Only memoize the shapes that do not depend on the outputs of
+            # this node, as other nodes will reuse them.
+            o_shapes = [self.shape_of[r] for r in node.outputs]
+            shape_vars = [sv for sh in o_shapes if sh for sv in sh
+                          if isinstance(sv, Variable)]
+            outputs = set(node.outputs)
+            # The input shapes are not built by infer_shape, only look
+            # at the new expressions.
+            blockers = list(node.inputs)
+            for sh in i_shapes:
+                if sh:
+                    blockers.extend(sh)
+            if not any(v in outputs for v in
+                       graph.ancestors(shape_vars, blockers=blockers)):
+                self.infer_shape_cache[cache_key] = o_shapes
+
     def on_change_input(self, fgraph, node, i, r, new_r, reason):
         if new_r not in self.shape_of:
             # It happen that the fgraph didn't called on_import for some
@@ -5521,6 +5600,33 @@ def local_add_mul_fusion(node):
             l.remove(inp)
             return [node.op(*(l + inp.owner.inputs))]
 
+
+def local_careduce_fusion(node):
+    """Fuse a reduction with the Elemwise that computes its input.
+
+    CAReduce(Elemwise{scalar_op}(x, y, ...)) ->
+        ElemwiseCAReduce{scalar_op, CAReduce}(x, y, ...)
+
+    The fused op computes the elementwise result inside the loop of the
+    reduction, so the result is never stored, e.g. for sum((x - y) ** 2).
+    This is only done when the reduction is the only client of the
+    Elemwise.
+
+    """
+    if (type(node.op) not in ALL_REDUCE or
+        not (hasattr(node.op.scalar_op, 'identity') or
+             node.op.scalar_op in [scalar.maximum, scalar.minimum])):
+        return False
+    inp = node.inputs[0]
+    if (inp.ndim == 0 or node.op.axis == () or
+        not inp.owner or type(inp.owner.op) is not Elemwise or
+        len(inp.owner.outputs) != 1 or
+        inp.owner.op.inplace_pattern or
+        len(inp.clients) != 1):
+        return False
+    fused_op = T.elemwise.ElemwiseCAReduce(inp.owner.op.scalar_op, node.op)
+    return [fused_op(*inp.owner.inputs)]
+
 if config.tensor.local_elemwise_fusion:
     _logger.debug("enabling optimization fusion elemwise in fast_run")
     #Must be after gpu(48.5) and before AddDestroyHandler(49.5)
@@ -5531,6 +5637,9 @@ if config.tensor.local_elemwise_fusion:
     fuse_seqopt.register('composite_elemwise_fusion',
                          FusionOptimizer(local_elemwise_fusion),
                          1, 'fast_run', 'fusion')
+    fuse_seqopt.register('local_careduce_fusion',
+                         FusionOptimizer(local_careduce_fusion),
+                         2, 'fast_run', 'fusion')
     compile.optdb.register('elemwise_fusion',
                            fuse_seqopt, 49,
                            'fast_run', 'fusion', 'local_elemwise_fusion',
@@ -2601,6 +2601,19 @@ def test_nan_inf_constant_signature():
     assert f(numpy.nan) == 0
 
 
+def test_constant_signature_cache():
+    x = constant(numpy.arange(6.).reshape(2, 3))
+    sig = x.signature()
+    assert x.signature() is sig
+    assert hash(sig) == hash(constant(numpy.arange(6.).reshape(2, 3)).signature())
+    # A new data array gets a new signature.
+    x.data = numpy.zeros((2, 3))
+    assert x.signature() is not sig
+    assert not x.signature() == sig
+    # The cached signature is not pickled.
+    assert '_signature' not in x.__getstate__()
+
+
 class T_Shape(unittest.TestCase):
     def test_basic0(self):
         s = shape(numpy.ones((5, 3)))
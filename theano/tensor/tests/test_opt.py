@@ -1141,7 +1141,7 @@ class test_fusion(unittest.TestCase):
         #the canonicalize is needed to merge multiplication/addition by constant.
         mode._optimizer = mode._optimizer.including(
             'local_elemwise_fusion', 'composite_elemwise_fusion',
-            'canonicalize')
+            'canonicalize').excluding('local_careduce_fusion')
         self.do(mode, shared, shp)
 
     @attr('slow')
@@ -1152,7 +1152,7 @@ class test_fusion(unittest.TestCase):
         #the canonicalize is needed to merge multiplication/addition by constant.
         mode._optimizer = mode._optimizer.including(
             'local_elemwise_fusion', 'composite_elemwise_fusion',
-            'canonicalize')
+            'canonicalize').excluding('local_careduce_fusion')
         self.do(mode, shared, shp)
 
     def test_gpu_fusion(self):
@@ -1291,6 +1291,54 @@ class test_fusion(unittest.TestCase):
         f(numpy.random.random((5, 5)), numpy.random.random((5, 5)),
             numpy.random.random((5, 5)))
 
+    def test_careduce_fusion(self):
+        mode = compile.mode.get_default_mode().including(
+            'local_elemwise_fusion', 'local_careduce_fusion')
+        mode_nofusion = mode.excluding('local_careduce_fusion')
+        rng = numpy.random.RandomState(utt.fetch_seed())
+        x, y = fmatrices('xy')
+        r = tensor.frow('r')
+        m = imatrix('m')
+        xv = rng.rand(5, 6).astype('float32')
+        yv = rng.rand(5, 6).astype('float32')
+        rv = rng.rand(1, 6).astype('float32')
+        mv = rng.randint(-5, 5, (5, 6)).astype('int32')
+        for out, inputs, values in [
+                (tensor.sum((x - y) ** 2), [x, y], [xv, yv]),
+                (tensor.sum(tensor.exp(x) * y, axis=0), [x, y], [xv, yv]),
+                (tensor.sum(x * y + x, axis=1), [x, y], [xv, yv]),
+                (tensor.sum((x - r) ** 2, axis=0), [x, r], [xv, rv]),
+                (tensor.sum(tensor.exp(x.T) * y.T, axis=0), [x, y],
+                 [xv, yv]),
+                (tensor.mean(tensor.exp(x)), [x], [xv]),
+                (tensor.prod(x + 1, axis=0), [x], [xv]),
+                (tensor.max(x * y, axis=1), [x, y], [xv, yv]),
+                (tensor.min(abs(x - y)), [x, y], [xv, yv]),
+                (tensor.sum(m * 3 - 1), [m], [mv]),
+                (tensor.max(m * 3, axis=0), [m], [mv])]:
+            f = function(inputs, out, mode=mode)
+            topo = f.maker.fgraph.toposort()
+            assert len([node for node in topo if isinstance(
+                node.op, tensor.elemwise.ElemwiseCAReduce)]) == 1
+            assert not [node for node in topo if isinstance(
+                node.op, (tensor.Elemwise, tensor.CAReduce)) and
+                node.outputs[0].ndim == 2]
+            f_nofusion = function(inputs, out, mode=mode_nofusion)
+            assert out.dtype == f(*values).dtype
+            utt.assert_allclose(f(*values), f_nofusion(*values))
+
+        # The elementwise result is used elsewhere: it is not fused.
+        f = function([x, y], [tensor.sum(x * y), x * y], mode=mode)
+        assert not [node for node in f.maker.fgraph.toposort()
+                    if isinstance(node.op, tensor.elemwise.ElemwiseCAReduce)]
+
+        # Reductions of arrays of size zero.
+        f = function([x], tensor.sum(x * 2, axis=0), mode=mode)
+        assert f(numpy.zeros((0, 3), dtype='float32')).tolist() == [0] * 3
+        f = function([x], tensor.max(x * 2, axis=0), mode=mode)
+        self.assertRaises(ValueError, f, numpy.zeros((0, 3), dtype='float32'))
+        assert f(numpy.zeros((3, 0), dtype='float32')).shape == (0,)
+
     def speed_fusion_gpu(self):
         import theano.sandbox.cuda as cuda
         self.speed_fusion(shared_fn=cuda.
@@ -3250,6 +3298,53 @@ class test_shapeoptimizer(unittest.TestCase):
         assert identity_noshape not in h_ops
         assert identity_shape not in h_ops
 
+    def test_static_shapes(self):
+        # Shapes known at compile time are int64 constants, and the same
+        # Constant object is used for a given value.
+        x = T.matrix('x')
+        c = T.constant(numpy.zeros((3, 5), dtype=config.floatX))
+        y = T.specify_shape(x, (3, 5))
+        fgraph = gof.FunctionGraph([x], [c + 1, T.exp(y)])
+        shape_feature = opt.ShapeFeature()
+        fgraph.attach_feature(shape_feature)
+        shape_of = shape_feature.shape_of
+        for out in fgraph.outputs:
+            assert all(isinstance(s, gof.Constant) for s in shape_of[out])
+            assert [s.data for s in shape_of[out]] == [3, 5]
+        assert shape_of[fgraph.outputs[0]][0] is shape_of[fgraph.outputs[1]][0]
+        assert (shape_feature.int_constant(3) is
+                shape_feature.int_constant(numpy.int64(3)))
+
+    def test_infer_shape_cache(self):
+        x = T.matrix('x')
+        fgraph = gof.FunctionGraph([x], [T.exp(x), T.exp(x) * 2])
+        shape_feature = opt.ShapeFeature()
+        fgraph.attach_feature(shape_feature)
+        # An equivalent node reuses the shapes of the first one.
+        x, = fgraph.inputs
+        y = fgraph.outputs[0]
+        y2 = T.exp(x)
+        fgraph.replace(y, y2)
+        assert shape_feature.shape_of[y2] == shape_feature.shape_of[y]
+
+        # The default shapes depend on the outputs, they are not reused.
+        class NoShape(gof.Op):
+            def __eq__(self, other):
+                return type(self) == type(other)
+
+            def __hash__(self):
+                return hash(type(self))
+
+            def make_node(self, x):
+                return gof.Apply(self, [x], [x.type()])
+        fgraph = gof.FunctionGraph([x], [NoShape()(x)])
+        shape_feature = opt.ShapeFeature()
+        fgraph.attach_feature(shape_feature)
+        z = fgraph.outputs[0]
+        z2 = NoShape()(fgraph.inputs[0])
+        fgraph.replace(z, z2)
+        assert shape_feature.shape_of[z2][0].owner.inputs[0] is z2
+
     def test_no_shapeopt(self):
         # Test that a basic example works even when ShapeOpt is excluded
         X = T.matrix()
@@ -4350,7 +4445,8 @@ class T_local_reduce(unittest.TestCase):
         self.mode = theano.compile.get_default_mode().including(
             'canonicalize',
             'specialize',
-            'uncanonicalize', 'local_max_and_argmax')
+            'uncanonicalize', 'local_max_and_argmax').excluding(
+            'local_careduce_fusion')
 
     def test_local_reduce_broadcast_all_0(self):
         for fct in [tensor.sum, tensor.all, tensor.any, tensor.prod,
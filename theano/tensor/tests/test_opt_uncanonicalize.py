@@ -37,7 +37,7 @@ class T_min_max(unittest.TestCase):
     def setUp(self):
         utt.seed_rng()
         self.mode = theano.compile.mode.get_default_mode().including(
-            'canonicalize', 'fast_run')
+            'canonicalize', 'fast_run').excluding('local_careduce_fusion')
 
     def test_optimization_max(self):
         data = numpy.asarray(numpy.random.rand(2, 3), dtype=config.floatX)
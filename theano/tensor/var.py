@@ -672,8 +672,13 @@ class TensorConstantSignature(tuple):
             return (self.sum == other.sum) and numpy.all(d0 == d1)
 
     def __hash__(self):
-        t, d = self
-        return hashtype(self) ^ hash(t) ^ hash(d.shape) ^ hash(self.sum)
+        try:
+            return self._hash
+        except AttributeError:
+            t, d = self
+            self._hash = (hashtype(self) ^ hash(t) ^ hash(d.shape) ^
+                          hash(self.sum))
+            return self._hash
 
     def theano_hash(self):
         _, d = self
@@ -750,7 +755,18 @@ class TensorConstant(_tensor_py_operators, Constant):
         return "TensorConstant{%s}" % name
 
     def signature(self):
-        return TensorConstantSignature((self.type, self.data))
+        # The signature caches the sum and the hash of the data, so it is
+        # kept to compute them only once per constant.
+        sig = getattr(self, '_signature', None)
+        if sig is None or sig[1] is not self.data:
+            sig = TensorConstantSignature((self.type, self.data))
+            self._signature = sig
+        return sig
+
+    def __getstate__(self):
+        d = Constant.__getstate__(self)
+        d.pop('_signature', None)
+        return d
 
     def equals(self, other):
         # Override Contant.equals to allow to compare with numpy.ndarray
@@ -2,6 +2,7 @@
 #
 # UNIT TEST
 #
+import sys
 import unittest
 
 import numpy as np
@@ -659,5 +660,27 @@ def test_grad_clip():
     assert np.allclose(out, (1, 4))
     assert not np.allclose(out[0], out[1])
 
+
+def test_grad_deep_graph():
+    # The graph is deeper than the recursion limit.
+    x = theano.tensor.dscalar()
+    y = x
+    for i in xrange(sys.getrecursionlimit() + 100):
+        y = y * 0.5 + 1
+    g = theano.tensor.grad(y, x)
+    assert isinstance(g, theano.Variable)
+
+
+def test_grad_many_clients():
+    # The gradient terms on x are added with a few n-ary additions.
+    x = theano.tensor.dvector()
+    cost = theano.tensor.add(*[(x * i).sum() for i in xrange(100)])
+    g = theano.tensor.grad(cost, x)
+    assert isinstance(g.owner.op, theano.tensor.Elemwise)
+    assert isinstance(g.owner.op.scalar_op, theano.scalar.Add)
+    assert 1 < len(g.owner.inputs) <= 31
+    f = theano.function([x], g, mode='FAST_COMPILE')
+    assert np.allclose(f(np.ones(3)), 4950)
+
 if __name__ == '__main__':
     unittest.main()